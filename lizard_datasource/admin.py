@@ -31,19 +31,69 @@ class DatasourceModelAdmin(admin.ModelAdmin):
                 }),
         ('Cache script', {
                 'fields': ['script_times_to_run_per_day',
+                           'script_initial_lookback_days',
                            'script_last_run_started',
-                           'script_run_next_opportunity'
+                           'script_run_next_opportunity',
+                           'script_lease_owner',
+                           'script_lease_expires',
+                           'history_retention_days'
                            ]
+                }),
+        ('Layer discovery', {
+                'fields': ['rediscovery_interval_hours',
+                           'layers_discovered_at']
                 }))
     readonly_fields = [
-        'originating_app', 'identifier', 'script_last_run_started']
+        'originating_app', 'identifier', 'script_last_run_started',
+        'script_lease_owner', 'layers_discovered_at']
 
 
 class DatasourceLayerAdmin(admin.ModelAdmin):
     list_display = [
-        'nickname', 'unit_cache', 'choices_made', 'datasource_model']
+        'nickname', 'unit_cache', 'cache_latest_values',
+        'script_refresh_minutes', 'script_last_refreshed', 'choices_made',
+        'datasource_model', 'discovered_at']
     list_display_links = ['choices_made', 'datasource_model']
-    list_editable = ['nickname', 'unit_cache']
+    list_editable = [
+        'nickname', 'unit_cache', 'cache_latest_values',
+        'script_refresh_minutes']
+
+
+class CacheRunLayerInline(admin.TabularInline):
+    model = models.CacheRunLayer
+    fields = readonly_fields = [
+        'datasource_layer', 'started', 'finished', 'locations_processed',
+        'locations_fetched', 'locations_updated', 'locations_empty',
+        'backend_seconds', 'db_seconds', 'locations_per_second', 'error']
+    extra = 0
+    can_delete = False
+
+    def has_add_permission(self, request):
+        return False
+
+
+class CacheRunAdmin(admin.ModelAdmin):
+    """Reports of cache script runs, they can only be looked at."""
+    list_display = [
+        'started', 'datasource_model', 'duration_seconds',
+        'schedule_margin_seconds', 'layers_refreshed',
+        'locations_processed', 'locations_updated', 'failed', 'owner']
+    list_filter = ['datasource_model', 'targeted']
+    # The schedule margin needs the datasource model of each run
+    list_select_related = True
+    date_hierarchy = 'started'
+    readonly_fields = [
+        'datasource_model', 'owner', 'targeted', 'started', 'finished',
+        'layers_refreshed', 'locations_processed', 'locations_updated',
+        'error']
+    inlines = [CacheRunLayerInline]
+
+    def failed(self, cache_run):
+        return bool(cache_run.error)
+    failed.boolean = True
+
+    def has_add_permission(self, request):
+        return False
 
 
 class ColorFromLatestValueInline(admin.TabularInline):
@@ -85,6 +135,7 @@ class IdentifierMappingAdmin(admin.ModelAdmin):
 
 admin.site.register(models.DatasourceModel, DatasourceModelAdmin)
 admin.site.register(models.DatasourceLayer, DatasourceLayerAdmin)
+admin.site.register(models.CacheRun, CacheRunAdmin)
 admin.site.register(models.AugmentedDataSource, AugmentedDataSourceAdmin)
 admin.site.register(models.ColorMap, ColorMapAdmin)
 admin.site.register(models.IdentifierMapping, IdentifierMappingAdmin)
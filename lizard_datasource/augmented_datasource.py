@@ -21,7 +21,9 @@ import logging
 from lizard_map import coordinates
 
 from lizard_datasource import datasource
+from lizard_datasource import location
 from lizard_datasource import models
+from lizard_datasource import timeseries_cache
 
 logger = logging.getLogger(__name__)
 
@@ -87,18 +89,16 @@ class AugmentedDataSource(datasource.DataSource):
 
         criteria = self.chooseable_criteria()
 
-        colorfroms = models.ColorFromLatestValue.objects.filter(
-            augmented_source=self.config_object,
-            hide_from_layer=True)
-        percentiles = models.PercentileLayer.objects.filter(
-            augmented_source=self.config_object,
-            hide_from_layer=True)
-
-        forbidden_choices_json = [
-            colorfrom.layer_to_get_color_from.choices_made
-            for colorfrom in colorfroms] + [
-            percentile.layer_to_get_percentile_from.choices_made
-            for percentile in percentiles]
+        # The choices of the layers are fetched in the same query
+        forbidden_choices_json = list(
+            models.ColorFromLatestValue.objects.filter(
+                augmented_source=self.config_object,
+                hide_from_layer=True).values_list(
+                'layer_to_get_color_from__choices_made', flat=True)) + list(
+            models.PercentileLayer.objects.filter(
+                augmented_source=self.config_object,
+                hide_from_layer=True).values_list(
+                'layer_to_get_percentile_from__choices_made', flat=True))
 
         clean_criteria = []
 
@@ -142,41 +142,46 @@ class AugmentedDataSource(datasource.DataSource):
     def _colorfrom(self):
         """Returns the used colorfromlatestvalue object, if any."""
         try:
-            return models.ColorFromLatestValue.objects.get(
+            return models.ColorFromLatestValue.objects.select_related(
+                'colormap', 'layer_to_get_color_from').get(
                 layer_to_add_color_to=self.datasource_layer)
         except models.ColorFromLatestValue.DoesNotExist:
             return None
 
-    def locations(self, bare=False):
-        locations = self.original_datasource.locations(bare=bare)
+    # Filtering is left to the original datasource, so that only the
+    # remaining locations are colored
+    FILTERS_LOCATIONS = True
+
+    def locations(self, bare=False, bbox=None, max_points=None):
+        locations = self.original_datasource.locations(
+            bare=bare, bbox=bbox, max_points=max_points)
 
         if not bare:
             colorfrom = self._colorfrom()
 
         if bare or not colorfrom:
-            for location in locations:
-                yield location
+            for loc in locations:
+                yield loc
             return
 
         cached_values = dict()
 
         colormap = colorfrom.colormap
-        if colorfrom.layer_to_get_color_from:
-            for cached_value in models.DatasourceCache.objects.filter(
-                datasource_layer=colorfrom.layer_to_get_color_from):
-                cached_values[cached_value.locationid] = (
-                    cached_value.value)
+        if colorfrom.layer_to_get_color_from_id is not None:
+            cached_values = dict(models.DatasourceCache.objects.filter(
+                    datasource_layer=colorfrom.layer_to_get_color_from_id,
+                    value__isnull=False).values_list('locationid', 'value'))
 
-        for location in locations:
+        for loc in locations:
             color = "888888"  # Default is gray
-            if location.identifier in cached_values:
-                value = cached_values[location.identifier]
+            if loc.identifier in cached_values:
+                value = cached_values[loc.identifier]
                 color = colormap.color_for(value)
                 if color.startswith("#"):
                     color = color[1:]
 
-            location.color = color
-            yield location
+            loc.color = color
+            yield loc
 
     def location_annotations(self):
         """If we have colors, we should have a legend for them."""
@@ -191,12 +196,26 @@ class AugmentedDataSource(datasource.DataSource):
 
         return annotations
 
-    def timeseries(self, location_id, start_datetime=None, end_datetime=None):
-        timeseries = self.original_datasource.timeseries(
+    @timeseries_cache.cached
+    def timeseries(self, location_id, start_datetime=None, end_datetime=None,
+                   max_points=None):
+        """The timeseries of the original datasource, with the
+        configured extra graph lines added. Downsampling to max_points
+        is done here, after the lines are combined, so the original
+        datasources don't need to support it.
+
+        If the cache script keeps the history of this layer and it
+        covers the window, that is used instead of asking the original
+        datasource."""
+        timeseries = self.history_timeseries(
             location_id, start_datetime, end_datetime)
+        if timeseries is None:
+            timeseries = self.original_datasource.timeseries(
+                location_id, start_datetime, end_datetime)
 
         for extra_graph_line in models.ExtraGraphLine.objects.filter(
-            layer_to_add_line_to=self.datasource_layer):
+            layer_to_add_line_to=self.datasource_layer).select_related(
+            'layer_to_get_line_from__datasource_model'):
 
             extra_identifier = extra_graph_line.map_identifier(location_id)
             if not extra_identifier:
@@ -212,6 +231,9 @@ class AugmentedDataSource(datasource.DataSource):
             if extra_timeseries:
                 timeseries.add(extra_timeseries)
 
+        if timeseries is not None and max_points:
+            timeseries = timeseries.downsample(max_points)
+
         return timeseries
 
     def has_percentiles(self):
@@ -243,6 +265,23 @@ def factory():
             for config_object in models.AugmentedDataSource.objects.all()]
 
 
+def _rd_coordinates(ds):
+    """Return a dict of the RD coordinates of the locations of ds,
+    keyed on identifier. Uses the stored locations of the layer if
+    there are any."""
+    rd_coordinates = ds.datasource_layer.catalogue_rd_coordinates()
+    if rd_coordinates is not None:
+        return rd_coordinates
+
+    locations = ds.locations()
+    if not isinstance(locations, location.LocationSet):
+        locations = location.LocationSet.from_locations(locations)
+    rd_xs, rd_ys = locations.projected(coordinates.wgs84_to_rd)
+    return dict(
+        (identifier, (rd_x, rd_y)) for identifier, rd_x, rd_y in
+        zip(locations.identifiers, rd_xs, rd_ys))
+
+
 def fill_mapping_with_closest_locations(augmented_datasource_model):
     for extra_graph_line in (
         augmented_datasource_model.extragraphline_set.all()):
@@ -255,15 +294,8 @@ def fill_mapping_with_closest_locations(augmented_datasource_model):
         datasource_from = datasource.get_datasource_by_layer(
             extra_graph_line.layer_to_get_line_from)
 
-        location_dict_to = dict(
-            (l.identifier,
-             coordinates.wgs84_to_rd(l.latitude, l.longitude))
-            for l in datasource_to.locations())
-
-        location_dict_from = dict(
-            (l.identifier,
-             coordinates.wgs84_to_rd(l.latitude, l.longitude))
-            for l in datasource_from.locations())
+        location_dict_to = _rd_coordinates(datasource_to)
+        location_dict_from = _rd_coordinates(datasource_from)
 
         # To add data FROM layer X to another layer Y, we need to be
         # able to translate identifiers FROM layer Y TO layer X. So
@@ -0,0 +1,285 @@
+"""Benchmarks of the hot paths of lizard-datasource, on a synthetic
+datasource of a configurable size (see synthetic_datasource.py).
+
+Benchmark sets up a synthetic datasource and an augmented datasource
+on top of it, that colors one layer by the cached latest values of
+its locations and adds the line of another layer to its graphs
+through an identifier mapping. It then times each scenario `repeat`
+times:
+
+- chooseable_criteria and visible_criteria, with the first level
+  chosen;
+- locations_coloring: the colored locations of the augmented layer;
+- proximity_mapping: filling the identifier mapping with the closest
+  locations;
+- timeseries_with_extras: a graph of the augmented layer, without the
+  timeseries cache, and timeseries_with_extras_cached with it (if it
+  is configured);
+- cache_latest_values: the cache script for one layer, from scratch.
+
+For each scenario the result has the minimum, median and maximum wall
+time in seconds, and the number of database queries and calls to the
+synthetic backend of the last run. Scenarios that happen during a web
+request run inside a request_memo() context, like they would there.
+
+Everything is done in a transaction that is rolled back at the end, so
+the benchmark can be run against a real database."""
+
+# Python 3 is coming to town
+from __future__ import print_function, unicode_literals
+from __future__ import absolute_import, division
+
+import collections
+import datetime
+import time
+
+import numpy
+
+from django.db import connection
+from django.db import reset_queries
+from django.db import transaction
+
+from lizard_datasource import augmented_datasource
+from lizard_datasource import datasource
+from lizard_datasource import dates
+from lizard_datasource import models
+from lizard_datasource import request_memo
+from lizard_datasource import scripts
+from lizard_datasource import synthetic_datasource
+from lizard_datasource import timeseries_cache
+
+# (minvalue, maxvalue, color) of the lines of the benchmark's colormap
+COLORMAP_LINES = (
+    (None, 5.0, '0000ff'),
+    (5.0, 10.0, '00ff00'),
+    (10.0, 15.0, 'ffff00'),
+    (15.0, None, 'ff0000'),
+    )
+
+# Prepare is called before each run, and isn't timed. If in_request
+# is True, each run has its own request_memo().
+Scenario = collections.namedtuple('Scenario', 'name prepare run in_request')
+
+
+def _backend_calls():
+    return synthetic_datasource.SyntheticDataSource.backend_calls
+
+
+class Benchmark(object):
+    def __init__(self, levels=3, fanout=4, locations=1000,
+                 series_length=24 * 7, latency=0.0, repeat=5):
+        if levels < 1 or fanout < 2:
+            raise ValueError(
+                "The benchmark needs at least one level, with at least "
+                "two options.")
+        self.levels = levels
+        self.fanout = fanout
+        self.locations = locations
+        self.series_length = series_length
+        self.latency = latency
+        self.repeat = repeat
+
+    def parameters(self):
+        return collections.OrderedDict((
+                ('levels', self.levels),
+                ('fanout', self.fanout),
+                ('locations', self.locations),
+                ('series_length', self.series_length),
+                ('latency', self.latency),
+                ('repeat', self.repeat),
+                ))
+
+    def synthetic_options(self):
+        return {
+            'levels': self.levels,
+            'fanout': self.fanout,
+            'locations_per_layer': self.locations,
+            'series_length': self.series_length,
+            'latency': self.latency,
+            'identifier': 'synthetic_benchmark',
+            }
+
+    def layer_choices(self, option):
+        """ChoicesMade of the layer that has this option at each
+        level."""
+        return datasource.ChoicesMade(dict=dict(
+                ('level_{0}'.format(level),
+                 'level_{0}_{1}'.format(level, option))
+                for level in range(self.levels)))
+
+    def setup(self):
+        """Create the configuration the scenarios use."""
+        self.ds = synthetic_datasource.SyntheticDataSource(
+            **self.synthetic_options())
+
+        # Locations are colored by the latest values of this layer...
+        self.ds.set_choices_made(self.layer_choices(0))
+        self.color_layer = self.ds.datasource_layer
+        identifiers = self.ds.locations().identifiers
+
+        # ... and graphs get the line of this one
+        self.ds.set_choices_made(self.layer_choices(1))
+        self.line_layer = self.ds.datasource_layer
+
+        now = dates.utc_now()
+        random = numpy.random.RandomState(0)
+        models.bulk_create_in_batches(models.DatasourceCache, (
+                models.DatasourceCache(
+                    datasource_layer=self.color_layer,
+                    locationid=identifier,
+                    timestamp=now,
+                    value=float(value),
+                    last_checked=now)
+                for identifier, value in zip(
+                    identifiers, random.uniform(0, 20, len(identifiers)))))
+
+        colormap = models.ColorMap.objects.create(
+            name='benchmark', defaultcolor='888888')
+        for minvalue, maxvalue, color in COLORMAP_LINES:
+            models.ColorMapLine.objects.create(
+                colormap=colormap, minvalue=minvalue, maxvalue=maxvalue,
+                color=color)
+
+        self.config = models.AugmentedDataSource.objects.create(
+            augmented_source=self.ds.datasource_model, name='benchmark')
+        self.augmented = augmented_datasource.AugmentedDataSource(
+            self.config)
+        self.augmented.set_choices_made(self.layer_choices(0))
+        augmented_layer = self.augmented.datasource_layer
+
+        models.ColorFromLatestValue.objects.create(
+            augmented_source=self.config,
+            layer_to_add_color_to=augmented_layer,
+            layer_to_get_color_from=self.color_layer,
+            colormap=colormap)
+        models.ExtraGraphLine.objects.create(
+            augmented_source=self.config,
+            layer_to_add_line_to=augmented_layer,
+            layer_to_get_line_from=self.line_layer,
+            identifier_mapping=models.IdentifierMapping.objects.create(
+                name='benchmark-{0}'.format(int(time.time()))))
+
+    def scenarios(self):
+        """The scenarios, in the order they are run. Timeseries with
+        extras come after proximity_mapping, which fills the mapping
+        they need."""
+        end_datetime = dates.utc_now()
+        start_datetime = end_datetime - datetime.timedelta(
+            hours=self.series_length)
+        first_level_chosen = datasource.ChoicesMade(
+            dict={'level_0': 'level_0_0'})
+
+        def choose(ds, choices_made):
+            return lambda: ds.set_choices_made(choices_made)
+
+        def augmented_timeseries():
+            return self.augmented.timeseries(
+                'loc_0', start_datetime, end_datetime)
+
+        def uncached_augmented_timeseries():
+            with timeseries_cache.disabled():
+                return augmented_timeseries()
+
+        def clear_line_layer_cache():
+            self.ds.set_choices_made(self.layer_choices(1))
+            models.DatasourceCache.objects.filter(
+                datasource_layer=self.line_layer).delete()
+
+        return (
+            Scenario(
+                'chooseable_criteria',
+                choose(self.ds, first_level_chosen),
+                lambda: self.ds.chooseable_criteria(), True),
+            Scenario(
+                'visible_criteria',
+                choose(self.ds, first_level_chosen),
+                lambda: self.ds.visible_criteria(), True),
+            Scenario(
+                'locations_coloring',
+                choose(self.augmented, self.layer_choices(0)),
+                lambda: list(self.augmented.locations()), True),
+            Scenario(
+                'proximity_mapping',
+                None,
+                lambda: (augmented_datasource.
+                         fill_mapping_with_closest_locations(self.config)),
+                False),
+            Scenario(
+                'timeseries_with_extras',
+                choose(self.augmented, self.layer_choices(0)),
+                uncached_augmented_timeseries, True),
+            Scenario(
+                'timeseries_with_extras_cached',
+                choose(self.augmented, self.layer_choices(0)),
+                augmented_timeseries, True),
+            Scenario(
+                'cache_latest_values',
+                clear_line_layer_cache,
+                lambda: scripts._cache_layer(self.ds, self.line_layer),
+                False),
+            )
+
+    def measure(self, scenario):
+        seconds = []
+        for run in range(self.repeat):
+            if scenario.prepare is not None:
+                scenario.prepare()
+
+            reset_queries()
+            backend_calls = _backend_calls()
+
+            if scenario.in_request:
+                with request_memo.request_memo():
+                    started = time.time()
+                    scenario.run()
+                    seconds.append(time.time() - started)
+            else:
+                started = time.time()
+                scenario.run()
+                seconds.append(time.time() - started)
+
+            queries = len(connection.queries)
+            backend_calls = _backend_calls() - backend_calls
+
+        seconds.sort()
+        return collections.OrderedDict((
+                ('min_seconds', seconds[0]),
+                ('median_seconds', seconds[len(seconds) // 2]),
+                ('max_seconds', seconds[-1]),
+                ('queries', queries),
+                ('backend_calls', backend_calls),
+                ))
+
+    def run(self):
+        """Run all scenarios, and return the results as a dict that
+        can be dumped as JSON."""
+        started_at = dates.utc_now()
+        results = collections.OrderedDict()
+
+        options = self.synthetic_options()
+        synthetic_datasource.register(options)
+        use_debug_cursor = connection.use_debug_cursor
+        seconds_between_fetches = scripts.SECONDS_BETWEEN_FETCHES
+        # Needed to count queries
+        connection.use_debug_cursor = True
+        scripts.SECONDS_BETWEEN_FETCHES = 0
+        try:
+            with transaction.commit_manually():
+                try:
+                    self.setup()
+                    for scenario in self.scenarios():
+                        results[scenario.name] = self.measure(scenario)
+                finally:
+                    transaction.rollback()
+        finally:
+            synthetic_datasource.unregister(options)
+            connection.use_debug_cursor = use_debug_cursor
+            scripts.SECONDS_BETWEEN_FETCHES = seconds_between_fetches
+
+        return collections.OrderedDict((
+                ('started_at', started_at.isoformat()),
+                ('parameters', self.parameters()),
+                ('timeseries_cache',
+                 timeseries_cache.cache_settings()['BACKEND']),
+                ('scenarios', results),
+                ))
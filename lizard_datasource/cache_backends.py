@@ -0,0 +1,89 @@
+"""Cache backends for the caches in lizard_datasource.
+
+Both have the same small interface: get(key, default=None) and
+set(key, value). Keys are tuples of strings, numbers and None."""
+
+# Python 3 is coming to town
+from __future__ import print_function, unicode_literals
+from __future__ import absolute_import, division
+
+import collections
+import hashlib
+import threading
+import time
+
+
+class LRUCache(object):
+    """In-process cache that holds at most max_entries values (None
+    for no limit), and forgets values after ttl_seconds (if given). If
+    it is full, the least recently used value is evicted. Thread safe.
+
+    Every process has its own, so this works best for values that
+    are requested repeatedly by the same process."""
+
+    def __init__(self, max_entries, ttl_seconds=None, timer=time.time):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.timer = timer
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                expires, value = self._entries.pop(key)
+            except KeyError:
+                return default
+            if expires is not None and expires <= self.timer():
+                return default
+            # Put it back at the most recently used end
+            self._entries[key] = (expires, value)
+            return value
+
+    def set(self, key, value):
+        if self.ttl_seconds is None:
+            expires = None
+        else:
+            expires = self.timer() + self.ttl_seconds
+
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (expires, value)
+            while (self.max_entries is not None and
+                   len(self._entries) > self.max_entries):
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class DjangoCache(object):
+    """Stores values in one of the caches configured in Django's
+    CACHES setting, so that they are shared between processes (if that
+    cache is, e.g., memcached). Values are pickled by Django."""
+
+    def __init__(self, alias='default', ttl_seconds=None,
+                 prefix='lizard_datasource'):
+        # Imported here, so that only users of this backend need it
+        from django.core.cache import get_cache
+
+        self.cache = get_cache(alias)
+        self.ttl_seconds = ttl_seconds
+        self.prefix = prefix
+
+    def _key(self, key):
+        """Memcached keys can't be too long or contain spaces, so we
+        use a hash of the key."""
+        return '{0}:{1}'.format(
+            self.prefix,
+            hashlib.md5(repr(key).encode('utf-8')).hexdigest())
+
+    def get(self, key, default=None):
+        return self.cache.get(self._key(key), default)
+
+    def set(self, key, value):
+        self.cache.set(self._key(key), value, self.ttl_seconds)
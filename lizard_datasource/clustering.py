@@ -0,0 +1,97 @@
+"""Server-side clustering of locations.
+
+At low zoom levels, a layer with thousands of locations is unreadable
+and slow to draw. Clustering puts the locations in a grid whose cells
+are about CLUSTER_CELL_PIXELS pixels wide at the given zoom level (of
+the usual 256 pixel web map tiles), and replaces the locations of each
+cell that has more than one by a single location at their centroid.
+
+Clusters have the extra arguments count (the number of locations in
+it) and cluster (True), and the most common color of their locations.
+Cells with a single location keep that location as it is.
+
+The clusters of a layer are cached per zoom level for
+CLUSTER_CACHE_SECONDS, in each process. They aren't stored with the
+DatasourceLayer: their colors come from the latest values of other
+layers, which change with every cache run, so stored clusters would
+go stale without anyone noticing. Cached ones are at most
+CLUSTER_CACHE_SECONDS old."""
+
+# Python 3 is coming to town
+from __future__ import print_function, unicode_literals
+from __future__ import absolute_import, division
+
+import collections
+
+from lizard_datasource import cache_backends
+from lizard_datasource import location
+from lizard_datasource import timeseries_cache
+
+CLUSTER_CELL_PIXELS = 60
+TILE_PIXELS = 256
+
+# At this zoom level and higher, locations aren't clustered
+MAX_CLUSTER_ZOOM = 15
+
+CLUSTER_CACHE_ENTRIES = 256
+CLUSTER_CACHE_SECONDS = 300
+
+_cluster_cache = cache_backends.LRUCache(
+    CLUSTER_CACHE_ENTRIES, ttl_seconds=CLUSTER_CACHE_SECONDS)
+
+
+def cell_size_degrees(zoom, cell_pixels=CLUSTER_CELL_PIXELS):
+    """Width in degrees of longitude of cell_pixels pixels at this
+    zoom level."""
+    return 360 / (TILE_PIXELS * 2 ** zoom) * cell_pixels
+
+
+def _most_common_color(colors):
+    colors = [color for color in colors if color is not None]
+    if not colors:
+        return None
+    return collections.Counter(colors).most_common(1)[0][0]
+
+
+def cluster_locations(locations, zoom, cell_pixels=CLUSTER_CELL_PIXELS):
+    """Return a LocationSet of the clusters of the locations (an
+    iterable of Locations) at this zoom level."""
+    if not isinstance(locations, location.LocationSet):
+        locations = location.LocationSet.from_locations(locations)
+
+    index = location.GridIndex(
+        locations.longitudes, locations.latitudes,
+        cell_size_degrees(zoom, cell_pixels))
+
+    clusters = []
+    for (column, row), positions in sorted(index.cells.items()):
+        if len(positions) == 1:
+            single = locations[int(positions[0])]
+            # A copy, so that the cache doesn't keep all locations alive
+            clusters.append(location.Location(
+                    single.identifier, single.latitude, single.longitude,
+                    color=single.color, **single.extra_args()))
+            continue
+
+        clusters.append(location.Location(
+                'cluster_{0}_{1}_{2}'.format(zoom, column, row),
+                float(locations.latitudes[positions].mean()),
+                float(locations.longitudes[positions].mean()),
+                color=_most_common_color(
+                    locations.colors[i] for i in positions),
+                count=len(positions),
+                cluster=True))
+
+    return location.LocationSet.from_locations(clusters)
+
+
+def layer_clusters(ds, zoom):
+    """Return the clusters of the locations of datasource ds at this
+    zoom level, from the cache if possible. The locations aren't
+    bare, so that the clusters get their colors."""
+    key = (timeseries_cache.layer_key(ds), zoom)
+    clusters = _cluster_cache.get(key)
+    if clusters is None:
+        clusters = cluster_locations(ds.locations(bare=False), zoom)
+        _cluster_cache.set(key, clusters)
+    return clusters
@@ -4,18 +4,47 @@
 from __future__ import print_function, unicode_literals
 from __future__ import absolute_import, division
 
+import contextlib
+import datetime
 import itertools
 import logging
 import pkg_resources
+import threading
+import types
+
+import pandas
+
+from functools import wraps
 
 from django.utils import simplejson
 
 from lizard_datasource import models
+from lizard_datasource import clustering
 from lizard_datasource import criteria
+from lizard_datasource import dates
+from lizard_datasource import instrumentation
+from lizard_datasource import location
+from lizard_datasource import request_memo
+from lizard_datasource import timeseries
 from lizard_datasource.functools import memoize
 
 logger = logging.getLogger(__name__)
 
+_history_state = threading.local()
+
+
+@contextlib.contextmanager
+def history_disabled():
+    """Within this context, DataSource.history_timeseries() finds
+    nothing in this thread, so timeseries() asks the backend. The
+    cache script uses this, the history is what it is filling."""
+    previous = getattr(_history_state, 'disabled', False)
+    _history_state.disabled = True
+    try:
+        yield
+    finally:
+        _history_state.disabled = previous
+
 
 class ChoicesMade(object):
     """Represents a set of choices made. Dict-like.
@@ -102,6 +131,15 @@ class ChoicesMade(object):
         """
         return simplejson.dumps(self._choices, sort_keys=True)
 
+    def __eq__(self, other):
+        return isinstance(other, ChoicesMade) and self.json() == other.json()
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self.json())
+
     def __unicode__(self):
         return "ChoicesMade(json={0})".format(
             repr(self.json()))
@@ -116,10 +154,76 @@ class ChoicesMade(object):
         return self._choices.items()
 
 
+# Methods and properties of DataSource (and its subclasses) that
+# remember their results within a request, see request_memo.py.
+MEMOIZED_PER_REQUEST = (
+    'criteria', 'options_for_criterion', 'is_drawable', 'datasource_layer')
+
+
+def filtered_locations(locations_method):
+    """Wrap a locations() method so that it accepts bbox and
+    max_points keyword arguments. If the datasource doesn't have
+    FILTERS_LOCATIONS, they aren't passed on, and the result is
+    filtered with location.filter_locations() instead."""
+
+    @wraps(locations_method)
+    def locations(self, *args, **kwargs):
+        if getattr(self, 'FILTERS_LOCATIONS', False):
+            return locations_method(self, *args, **kwargs)
+
+        bbox = kwargs.pop('bbox', None)
+        max_points = kwargs.pop('max_points', None)
+        return location.filter_locations(
+            locations_method(self, *args, **kwargs), bbox, max_points)
+
+    return locations
+
+
+class DataSourceType(type):
+    """Metaclass of DataSource. Wraps the MEMOIZED_PER_REQUEST methods
+    of every DataSource class with request_memo.per_request, and
+    locations() with filtered_locations(), so that datasources in
+    other apps get it without doing anything. Public methods are
+    instrumented (see instrumentation.py), outside the other
+    wrappers."""
+
+    def __init__(cls, name, bases, attrs):
+        super(DataSourceType, cls).__init__(name, bases, attrs)
+        if callable(attrs.get('locations')):
+            cls.locations = filtered_locations(attrs['locations'])
+        for attr_name in MEMOIZED_PER_REQUEST:
+            attr = attrs.get(attr_name)
+            if isinstance(attr, property):
+                setattr(cls, attr_name, property(
+                        request_memo.per_request(attr.fget, cls),
+                        attr.fset, attr.fdel, attr.__doc__))
+            elif callable(attr):
+                setattr(cls, attr_name, request_memo.per_request(attr, cls))
+
+        for attr_name in attrs:
+            if attr_name.startswith('_'):
+                continue
+            attr = cls.__dict__[attr_name]
+            if isinstance(attr, property):
+                if attr_name in instrumentation.INSTRUMENTED_PROPERTIES:
+                    setattr(cls, attr_name, property(
+                            instrumentation.instrumented(
+                                attr.fget, attr_name),
+                            attr.fset, attr.fdel, attr.__doc__))
+            elif isinstance(attr, types.FunctionType):
+                setattr(cls, attr_name, instrumentation.instrumented(
+                        attr, attr_name))
+
+
 class DataSource(object):
     """Base class for all the DataSource classes. Defines the interface of
     a Lizard data source. Other data sources should subclass this one.
     """
+    __metaclass__ = DataSourceType
+
+    # Set this to True if locations() handles its bbox and max_points
+    # arguments itself, e.g. because the backend can filter.
+    FILTERS_LOCATIONS = False
 
     @property
     def identifier(self):
@@ -168,13 +272,20 @@ class DataSource(object):
         return dsl
 
     def activation_for_cache_script(self):
-        """Return True if the cache script should active. If it shouldn't,
-        if will do nothing this time.
+        """Return a true value if the cache script should active. If it
+        shouldn't, if will do nothing this time.
 
-        If True is returned, it is assumed that the script will run now,
-        and that is recorded."""
+        If a true value is returned, it is assumed that the script
+        will run now, and that is recorded. If it is
+        DatasourceModel.ACTIVATED_FOR_LAYERS, only the layers with
+        their own refresh interval that are due are refreshed."""
         return self.datasource_model.activation_for_cache_script()
 
+    def release_cache_script(self):
+        """Called when the cache script is done with this datasource,
+        after activation_for_cache_script() returned True."""
+        self.datasource_model.release_cache_script()
+
     def set_choices_made(self, choices_made):
         self._choices_made = choices_made
 
@@ -265,21 +376,115 @@ class DataSource(object):
         """Should return an Exception if the datasource is not drawable.
         Should return an Exception if the datasource is not LAYER_POINTS.
 
-        Returns an iterable of lizard_datasource.location.Location objects.
+        Returns an iterable of lizard_datasource.location.Location
+        objects. Datasources with many locations should return a
+        lizard_datasource.location.LocationSet, which is one.
 
         If bare is False, other helpful information like coloring may
         be included in the locations. If bare is True, the fastest way
         to return the right locations should be used.
+
+        Clients can also pass bbox, a (minlon, minlat, maxlon, maxlat)
+        tuple, to get only the locations within it, and max_points to
+        get at most that many locations, spread over the map. Unless
+        the datasource sets FILTERS_LOCATIONS, these are handled for it
+        (see filtered_locations()).
         """
         return []
 
-    def timeseries(self, location_id, start_datetime=None, end_datetime=None):
+    def catalogued_locations(self, bbox=None):
+        """Return the locations of this layer as the cache script last
+        stored them (see models.DatasourceLayerLocation), as a
+        LocationSet, or if they weren't stored, the result of
+        locations(). The stored locations are bare (no colors).
+
+        This doesn't ask the datasource, so it is fast for datasources
+        with a slow backend."""
+        catalogue = self.datasource_layer.catalogue(bbox)
+        if catalogue is None:
+            return self.locations(bbox=bbox)
+        return catalogue
+
+    def clustered_locations(self, zoom, bbox=None):
+        """Return the locations, with those that are close together at
+        this zoom level (of web map tiles) replaced by clusters. See
+        clustering.py. If bbox is given, only the clusters and
+        locations within it are returned.
+
+        The clusters are cached for a while, so this is fast for
+        repeated requests at the same zoom level."""
+        if zoom >= clustering.MAX_CLUSTER_ZOOM:
+            return self.locations(bbox=bbox)
+
+        clusters = clustering.layer_clusters(self, zoom)
+        if bbox is not None:
+            clusters = clusters.within(bbox)
+        return clusters
+
+    def timeseries(self, location_id, start_datetime=None, end_datetime=None,
+                   max_points=None):
         """Return the relevant timeseries at that location id. Start
         and end datetimes are in UTC. Results in a
         lizard_datasource.timeseries.Timeseries object, or None if
-        there are no timeseries available."""
+        there are no timeseries available.
+
+        If max_points is given, the client can't draw more points
+        than that (e.g., it is the width of a graph in pixels), and
+        the result should be downsampled. Timeseries.downsample() can
+        be used for that, but datasources that can downsample at the
+        backend may do so."""
         return None
 
+    def history_timeseries(
+        self, location_id, start_datetime=None, end_datetime=None):
+        """Return the timeseries at that location from the history
+        kept by the cache script (see models.DatasourceHistory), or
+        None if the history doesn't cover the whole window. The window
+        counts as covered up to one schedule interval after the last
+        time the cache script checked the location.
+
+        Implementations of timeseries() can call this first, to avoid
+        a slow backend. Inside history_disabled() it always returns
+        None."""
+        if getattr(_history_state, 'disabled', False):
+            return None
+
+        datasource_model = self.datasource_model
+        if datasource_model.history_retention_days <= 0:
+            return None
+        if start_datetime is None:
+            return None
+
+        datasource_layer = self.datasource_layer
+        try:
+            cache = models.DatasourceCache.objects.get(
+                datasource_layer=datasource_layer, locationid=location_id)
+        except models.DatasourceCache.DoesNotExist:
+            return None
+
+        if cache.history_start is None or cache.last_checked is None:
+            return None
+        if dates.to_utc(start_datetime) < dates.to_utc(cache.history_start):
+            return None
+
+        covered_until = dates.to_utc(cache.last_checked) + datetime.timedelta(
+            minutes=datasource_model.minutes_between_scripts or 0)
+        if end_datetime is None:
+            end_datetime = dates.utc_now()
+        if dates.to_utc(end_datetime) > covered_until:
+            return None
+
+        rows = models.DatasourceHistory.objects.filter(
+            datasource_layer=datasource_layer, locationid=location_id,
+            timestamp__gte=start_datetime,
+            timestamp__lte=end_datetime).values_list('timestamp', 'value')
+
+        name = datasource_layer.history_series_name or 'data'
+        timestamps = [timestamp for timestamp, value in rows]
+        return timeseries.Timeseries(pandas.DataFrame(
+                {name: [value for timestamp, value in rows]},
+                index=timestamps))
+
     def location_annotations(self):
         """A datasource may add annotations (extra fields) to the
         Locations it returns.
@@ -409,11 +614,24 @@ class CombinedDataSource(DataSource):
         return self._datasources and all(ds.has_property(property)
                    for ds in self._datasources)
 
-    def locations(self):
-        """Return locations from all the underlying datasources."""
+    FILTERS_LOCATIONS = True
+
+    def clustered_locations(self, zoom, bbox=None):
+        """Clusters of each of the underlying datasources."""
         return itertools.chain(*(
-            datasource.locations()
+            datasource.clustered_locations(zoom, bbox=bbox)
+            for datasource in self._datasources))
+
+    def locations(self, bbox=None, max_points=None):
+        """Return locations from all the underlying datasources. The
+        bbox is passed on to them; max_points is passed on too, and
+        applies to the combination as well."""
+        combined = itertools.chain(*(
+            datasource.locations(bbox=bbox, max_points=max_points)
             for datasource in self._datasources))
+        if max_points:
+            return location.filter_locations(combined, max_points=max_points)
+        return combined
 
     def timeseries(self):
         pass
@@ -444,12 +662,32 @@ def datasources_from_entrypoints():
     return datasources
 
 
+def attach_datasource_models(datasources):
+    """Give each of the datasources its DatasourceModel, all loaded
+    with one query, so that asking each of them whether it is visible
+    doesn't do a query per datasource. Models that don't exist yet
+    are created when they are first needed, as usual."""
+    datasource_models = dict(
+        ((datasource_model.originating_app, datasource_model.identifier),
+         datasource_model)
+        for datasource_model in models.DatasourceModel.objects.all())
+
+    for datasource in datasources:
+        datasource_model = datasource_models.get(
+            (datasource.originating_app, datasource.identifier))
+        if datasource_model is not None:
+            datasource._dsm = datasource_model
+
+
 def get_datasources(choices_made=ChoicesMade()):
     """Return all the datasources defined by entrypoints that are
     applicable to the given choices_made."""
 
+    all_datasources = datasources_from_entrypoints()
+    attach_datasource_models(all_datasources)
+
     datasources = []
-    for datasource in datasources_from_entrypoints():
+    for datasource in all_datasources:
         if datasource.visible and datasource.is_applicable(choices_made):
             datasource.set_choices_made(choices_made)
             datasources.append(datasource)
@@ -1,5 +1,6 @@
 """Date utilities. Internally we ALWAYS work with UTC datetimes."""
 
+import calendar
 import datetime
 import pytz
 
@@ -26,3 +27,50 @@ def utc_now():
     """Ironically, standard datetime's utc_now() returns a naive
     time. We turn it into a UTC time."""
     return to_utc(datetime.datetime.utcnow())
+
+
+def scheduled_time_before(current_time, minutes_between):
+    """Things that happen every minutes_between minutes are scheduled
+    at multiples of minutes_between minutes after midnight. Return
+    the last such moment at or before current_time."""
+    minutes_since_midnight = 60 * current_time.hour + current_time.minute
+    minutes = minutes_since_midnight - (
+        minutes_since_midnight % minutes_between)
+
+    return current_time.replace(
+        hour=minutes // 60, minute=minutes % 60, second=0, microsecond=0)
+
+
+def scheduled_time_after(current_time, minutes_between):
+    """Return the first scheduled moment (see scheduled_time_before)
+    after current_time. The schedule starts over at midnight."""
+    next_time = (scheduled_time_before(current_time, minutes_between) +
+                 datetime.timedelta(minutes=minutes_between))
+    midnight = (current_time.replace(
+            hour=0, minute=0, second=0, microsecond=0) +
+                datetime.timedelta(days=1))
+    return min(next_time, midnight)
+
+
+def _epoch_seconds(datetime_object):
+    return calendar.timegm(to_utc(datetime_object).utctimetuple())
+
+
+def _from_epoch_seconds(seconds):
+    return to_utc(datetime.datetime.utcfromtimestamp(seconds))
+
+
+def floor_to_bucket(datetime_object, minutes):
+    """Return the start of the bucket of that many minutes (counted
+    from the epoch) that datetime_object is in."""
+    seconds = _epoch_seconds(datetime_object)
+    return _from_epoch_seconds(seconds - seconds % (60 * minutes))
+
+
+def ceil_to_bucket(datetime_object, minutes):
+    """Return the first bucket boundary (see floor_to_bucket) at or
+    after datetime_object."""
+    floor = floor_to_bucket(datetime_object, minutes)
+    if floor < to_utc(datetime_object):
+        return floor + datetime.timedelta(minutes=minutes)
+    return floor
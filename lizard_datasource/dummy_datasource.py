@@ -126,28 +126,26 @@ class DummyDataSource(datasource.DataSource):
 
         return 'first_letter' in choices_made
 
-    def locations(self):
+    def locations(self, bare=True):
+        # There is no coloring, so bare doesn't matter
         if not self.is_drawable():
             raise ValueError(
                 "Datasource locations() called when it wasn't drawable")
         cities = CITIES[self._choices_made['first_letter']]
 
-        return [
-            location.Location(
-                identifier=city['id'],
-                latitude=city['lat'] / 1000000.0,
-                longitude=city['lon'] / 1000000.0)
+        return location.LocationSet(
+            identifiers=[city['id'] for city in cities],
+            latitudes=[city['lat'] / 1000000.0 for city in cities],
+            longitudes=[city['lon'] / 1000000.0 for city in cities])
 
-            for city in cities
-            ]
-
-    def timeseries(self, location_id, start_datetime=None, end_datetime=None):
+    def timeseries(self, location_id, start_datetime=None, end_datetime=None,
+                   max_points=None):
         return timeseries.Timeseries({
             utc(2012, 11, 13, 11, 0): 10.0,
             utc(2012, 11, 13, 12, 0): 15.0,
             utc(2012, 11, 13, 13, 0): 20.0,
             utc(2012, 11, 13, 14, 0): 14.0
-            })
+            }).downsample(max_points)
 
 
 def factory():
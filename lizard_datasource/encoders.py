@@ -0,0 +1,173 @@
+"""Encoders that turn lizard_datasource objects into wire formats.
+
+Generic JSON encoding of Timeseries (through data() and datetime
+objects) is slow for long series. The functions here work on the
+columns of the underlying DataFrame directly.
+
+Locations are encoded as a GeoJSON FeatureCollection that is written
+in chunks, so that it can be streamed while locations() is still
+producing locations.
+
+Timestamps are always encoded as integer milliseconds since the epoch
+(UTC), which is what Javascript's Date uses. Missing values become
+null in JSON and NaN in the binary format."""
+
+# Python 3 is coming to town
+from __future__ import print_function, unicode_literals
+from __future__ import absolute_import, division
+
+import struct
+
+import numpy
+import pandas
+
+from django.utils import simplejson
+
+# Magic bytes and version that start every binary frame
+BINARY_MAGIC = b'LZTS'
+BINARY_VERSION = 1
+
+# Magic, version, two padding bytes, number of rows, number of
+# columns; little-endian. The padding makes the header 16 bytes long,
+# so that the arrays after it are 8-byte aligned (Javascript's typed
+# arrays need that).
+BINARY_HEADER = struct.Struct(str('<4sHxxII'))
+
+NANOSECONDS_PER_MILLISECOND = 1000000
+
+# Number of GeoJSON features per chunk
+GEOJSON_CHUNK_SIZE = 1000
+
+GEOJSON_HEADER = '{"type":"FeatureCollection","features":['
+GEOJSON_FOOTER = ']}'
+
+
+def _columns_dataframe(timeseries):
+    """Return the dataframe of the timeseries with its columns in the
+    right order, and its index as a DatetimeIndex."""
+    dataframe = timeseries.dataframe[list(timeseries.columns)]
+    if not isinstance(dataframe.index, pandas.DatetimeIndex):
+        dataframe.index = pandas.DatetimeIndex(dataframe.index)
+    return dataframe
+
+
+def timeseries_rows(timeseries):
+    """Return the timeseries as a list of rows of the form
+    [timestamp_ms, value_column_1, value_column_2, ...]. Missing
+    values are None."""
+    if timeseries is None or len(timeseries) == 0:
+        return []
+
+    dataframe = _columns_dataframe(timeseries)
+    values = dataframe.values.astype(object)
+    values[pandas.isnull(dataframe.values)] = None
+
+    rows = numpy.column_stack((
+            dataframe.index.asi8 // NANOSECONDS_PER_MILLISECOND, values))
+    return rows.tolist()
+
+
+def timeseries_to_json(timeseries):
+    """Encode the timeseries as a compact JSON string of the form
+
+    {"columns": ["label||unit", ...],
+     "data": [[timestamp_ms, value, ...], ...]}
+    """
+    columns = list(timeseries.columns) if timeseries is not None else []
+    return simplejson.dumps({
+            'columns': columns,
+            'data': timeseries_rows(timeseries)
+            }, separators=(',', ':'))
+
+
+def timeseries_to_binary(timeseries):
+    """Encode the timeseries as a little-endian binary frame:
+
+    - A 16-byte header: the 4 bytes 'LZTS', an uint16 version, two
+      padding bytes, an uint32 number of rows (N) and an uint32 number
+      of columns (C).
+    - N int64 timestamps, in milliseconds since the epoch.
+    - For each of the C columns, N float64 values (NaN if missing).
+
+    Column names aren't included; they are in timeseries.columns, in
+    the same order as in the frame."""
+    if timeseries is None or len(timeseries) == 0:
+        return BINARY_HEADER.pack(BINARY_MAGIC, BINARY_VERSION, 0, 0)
+
+    dataframe = _columns_dataframe(timeseries)
+    timestamps = (dataframe.index.asi8 // NANOSECONDS_PER_MILLISECOND)
+    values = dataframe.values.astype(numpy.float64)
+
+    nrows, ncols = values.shape
+    return b''.join([
+            BINARY_HEADER.pack(BINARY_MAGIC, BINARY_VERSION, nrows, ncols),
+            timestamps.astype(str('<i8')).tostring(),
+            # Transposed, so that each column's values are contiguous
+            numpy.ascontiguousarray(values.T).astype(str('<f8')).tostring()
+            ])
+
+
+def timeseries_from_binary(frame, columns=None):
+    """Decode a frame made by timeseries_to_binary() back into a
+    DataFrame with a UTC DatetimeIndex. Mostly useful for tests and
+    for Python clients."""
+    magic, version, nrows, ncols = BINARY_HEADER.unpack_from(frame)
+    if magic != BINARY_MAGIC or version != BINARY_VERSION:
+        raise ValueError("Not a timeseries frame of a known version.")
+
+    offset = BINARY_HEADER.size
+    timestamps = numpy.frombuffer(
+        frame, dtype=str('<i8'), count=nrows, offset=offset)
+    offset += 8 * nrows
+    values = numpy.frombuffer(
+        frame, dtype=str('<f8'), count=nrows * ncols, offset=offset)
+
+    index = pandas.DatetimeIndex(
+        timestamps * NANOSECONDS_PER_MILLISECOND, tz='UTC')
+    return pandas.DataFrame(
+        values.reshape((ncols, nrows)).T, index=index, columns=columns)
+
+
+def location_feature(location):
+    """Return a GeoJSON Feature dict for the location. Its extra
+    arguments and color (if any) are the properties."""
+    properties = dict(location.extra_args())
+    if location.color is not None:
+        properties['color'] = location.color
+    return {
+        'type': 'Feature',
+        'id': location.identifier,
+        'geometry': {
+            'type': 'Point',
+            'coordinates': [location.longitude, location.latitude]
+            },
+        'properties': properties
+        }
+
+
+def locations_to_geojson(locations, chunk_size=GEOJSON_CHUNK_SIZE):
+    """Generate a GeoJSON FeatureCollection of the locations (an
+    iterable of Location objects, e.g. the result of
+    DataSource.locations()) as a series of strings, each with at most
+    chunk_size features. The locations are consumed as the chunks are
+    generated, so memory use doesn't grow with the number of
+    locations. Joined together, the chunks are valid JSON.
+
+    The result can be given to an HttpResponse as its content, which
+    makes Django stream it."""
+    yield GEOJSON_HEADER
+
+    separator = ''
+    features = []
+    for location in locations:
+        features.append(simplejson.dumps(
+                location_feature(location), separators=(',', ':')))
+        if len(features) >= chunk_size:
+            yield separator + ','.join(features)
+            separator = ','
+            features = []
+
+    if features:
+        yield separator + ','.join(features)
+
+    yield GEOJSON_FOOTER
@@ -4,22 +4,88 @@
 from __future__ import print_function, unicode_literals
 from __future__ import absolute_import, division
 
+import collections
+import threading
+
 from functools import wraps
 
+from lizard_datasource import cache_backends
+
+CacheInfo = collections.namedtuple(
+    'CacheInfo', 'hits misses maxsize currsize')
+
+# Marks a cache miss; None is a valid result
+_MISSING = object()
+
 
-def memoize(f):
+def _make_key(args, kwargs):
+    """Keyword arguments are sorted, so that f(a=1, b=2) and f(b=2,
+    a=1) have the same key."""
+    return (tuple(args), tuple(sorted(kwargs.items())))
+
+
+def memoize(f=None, maxsize=None, ttl=None):
     """Remember the results of function f and immediately return a
-    remembered result if it's called with the same arguments again."""
-    memo_cache = dict()
+    remembered result if it's called with the same arguments again.
+
+    Can be used as @memoize, or as @memoize(maxsize=128, ttl=60) to
+    remember at most maxsize results (the least recently used are
+    forgotten first) for at most ttl seconds. Without them, results
+    are remembered forever.
+
+    It is thread safe. If several threads call it with the same
+    arguments at the same time, f is only called once and the others
+    wait for its result. The decorated function has cache_info() and
+    cache_clear() methods, like those of Python 3's lru_cache."""
+    if f is None:
+        return lambda f: memoize(f, maxsize=maxsize, ttl=ttl)
+
+    memo_cache = cache_backends.LRUCache(maxsize, ttl_seconds=ttl)
+    stats = {'hits': 0, 'misses': 0}
+    lock = threading.Lock()
+    key_locks = {}
 
     @wraps(f)
     def memoed(*args, **kwargs):
-        # Construct a key to use in the memo_cache
-        key = (tuple(args), tuple(kwargs.items()))
+        key = _make_key(args, kwargs)
+
+        result = memo_cache.get(key, _MISSING)
+        if result is not _MISSING:
+            with lock:
+                stats['hits'] += 1
+            return result
+
+        with lock:
+            key_lock = key_locks.setdefault(key, threading.Lock())
+
+        with key_lock:
+            # Another thread may have computed it while we waited
+            result = memo_cache.get(key, _MISSING)
+            if result is not _MISSING:
+                with lock:
+                    stats['hits'] += 1
+                return result
+
+            try:
+                result = f(*args, **kwargs)
+                memo_cache.set(key, result)
+            finally:
+                with lock:
+                    stats['misses'] += 1
+                    key_locks.pop(key, None)
+
+        return result
 
-        if key not in memo_cache:
-            memo_cache[key] = f(*args, **kwargs)
+    def cache_info():
+        with lock:
+            return CacheInfo(
+                stats['hits'], stats['misses'], maxsize, len(memo_cache))
 
-        return memo_cache[key]
+    def cache_clear():
+        with lock:
+            memo_cache.clear()
+            stats['hits'] = stats['misses'] = 0
 
+    memoed.cache_info = cache_info
+    memoed.cache_clear = cache_clear
     return memoed
@@ -0,0 +1,281 @@
+"""Instrumentation of datasource calls.
+
+Inside an instrument() context, every call of a public method of a
+DataSource (and of its datasource_model and datasource_layer
+properties) is recorded per datasource identifier and method: the
+number of calls, the wall time in seconds, the number of database
+queries and the number of backend calls. Times are inclusive, a call
+of AugmentedDataSource.timeseries() includes the timeseries() call of
+the datasource it augments. Methods that return a generator, like
+some locations() methods, are measured while the generator is used.
+
+Backend calls are counted by datasources themselves: call
+count_backend_call() each time a request goes to the backend (a
+database of another system, a web service...).
+
+Outside of a context, the instrumented methods only look up the
+current context and call the method, so that leaving it off costs
+next to nothing. Add
+'lizard_datasource.instrumentation.InstrumentationMiddleware' to
+MIDDLEWARE_CLASSES to instrument each request; it logs a line per
+request, and the results of all requests are added up in stats(),
+which the instrumentation_stats view shows to staff members.
+
+Queries are counted on the default database, using Django's debug
+cursor, which is turned on inside a context."""
+
+# Python 3 is coming to town
+from __future__ import print_function, unicode_literals
+from __future__ import absolute_import, division
+
+import contextlib
+import logging
+import threading
+import time
+import types
+
+from functools import wraps
+
+from django.db import connection
+
+from lizard_datasource import dates
+
+logger = logging.getLogger(__name__)
+
+# Properties of DataSource that are instrumented; other properties
+# (like identifier) are too cheap, or are used by the instrumentation
+INSTRUMENTED_PROPERTIES = ('datasource_model', 'datasource_layer')
+
+_state = threading.local()
+
+_totals_lock = threading.Lock()
+_totals = {}
+_totals_since = dates.utc_now()
+_totals_contexts = 0
+
+
+def _current_recorder():
+    return getattr(_state, 'recorder', None)
+
+
+def _add(calls, key, numbers):
+    """Add numbers, a (calls, seconds, queries, backend_calls) list, to
+    those of key in the dict calls."""
+    if key in calls:
+        calls[key] = [
+            total + number for total, number in zip(calls[key], numbers)]
+    else:
+        calls[key] = list(numbers)
+
+
+def _as_list(calls):
+    """Return the recorded calls as a list of dicts, the most time
+    consuming first."""
+    result = []
+    for (identifier, method), (count, seconds, queries, backend_calls) in (
+        calls.items()):
+        result.append({
+                'datasource': identifier,
+                'method': method,
+                'calls': count,
+                'seconds': seconds,
+                'queries': queries,
+                'backend_calls': backend_calls,
+                })
+    result.sort(key=lambda call: call['seconds'], reverse=True)
+    return result
+
+
+class Recorder(object):
+    """Collects the calls made within one instrument() context."""
+
+    def __init__(self):
+        self.calls = {}
+        self.backend_calls = 0
+        self.started = time.time()
+        # (id(datasource), method) of calls in progress, so that
+        # a super() call isn't counted again
+        self.active = set()
+
+    def record(self, key, measurement):
+        _add(self.calls, key, (
+                1, measurement.seconds, measurement.queries,
+                measurement.backend_calls))
+
+    def as_list(self):
+        return _as_list(self.calls)
+
+    def log_line(self):
+        return "; ".join(
+            "{datasource}.{method} {calls}x {seconds:.3f}s "
+            "{queries}q {backend_calls}b".format(**call)
+            for call in self.as_list())
+
+
+class _Measurement(object):
+    """Adds up the time, queries and backend calls of the blocks of
+    code it is used on as a context manager."""
+
+    def __init__(self, recorder):
+        self.recorder = recorder
+        self.seconds = 0.0
+        self.queries = 0
+        self.backend_calls = 0
+
+    def __enter__(self):
+        self._queries = len(connection.queries)
+        self._backend_calls = self.recorder.backend_calls
+        self._started = time.time()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.seconds += time.time() - self._started
+        # The queries may have been reset in between
+        self.queries += max(len(connection.queries) - self._queries, 0)
+        self.backend_calls += self.recorder.backend_calls - self._backend_calls
+
+
+def start():
+    """Start recording in this thread, and return the Recorder. Returns
+    None if this thread is already recording."""
+    if _current_recorder() is not None:
+        return None
+
+    recorder = Recorder()
+    recorder.use_debug_cursor = connection.use_debug_cursor
+    connection.use_debug_cursor = True
+    _state.recorder = recorder
+    return recorder
+
+
+def stop(recorder):
+    """Stop recording, and add the calls of recorder to the totals."""
+    global _totals_contexts
+    _state.recorder = None
+    connection.use_debug_cursor = recorder.use_debug_cursor
+
+    with _totals_lock:
+        for key, numbers in recorder.calls.items():
+            _add(_totals, key, numbers)
+        _totals_contexts += 1
+
+
+@contextlib.contextmanager
+def instrument():
+    """Record datasource calls in this thread until the end of this
+    context, and yield the Recorder. Nested contexts share the
+    Recorder of the outermost."""
+    recorder = _current_recorder()
+    if recorder is not None:
+        yield recorder
+        return
+
+    recorder = start()
+    try:
+        yield recorder
+    finally:
+        stop(recorder)
+
+
+def count_backend_call():
+    """Datasources call this for each call to their backend."""
+    recorder = _current_recorder()
+    if recorder is not None:
+        recorder.backend_calls += 1
+
+
+def stats():
+    """Return the calls of all finished contexts in this process,
+    added up."""
+    with _totals_lock:
+        return {
+            'since': _totals_since.isoformat(),
+            'contexts': _totals_contexts,
+            'calls': _as_list(_totals),
+            }
+
+
+def reset_stats():
+    global _totals_since, _totals_contexts
+    with _totals_lock:
+        _totals.clear()
+        _totals_since = dates.utc_now()
+        _totals_contexts = 0
+
+
+def _measured_generator(generator, measurement, recorder, key):
+    """Yield the items of generator, measuring the work done to get
+    them, and record it when the generator is done."""
+    try:
+        while True:
+            with measurement:
+                try:
+                    item = next(generator)
+                except StopIteration:
+                    return
+            yield item
+    finally:
+        recorder.record(key, measurement)
+
+
+def instrumented(method, name):
+    """Wrap a DataSource method so that its calls are recorded inside
+    an instrument() context."""
+
+    @wraps(method)
+    def instrumented_method(self, *args, **kwargs):
+        recorder = _current_recorder()
+        if recorder is None:
+            return method(self, *args, **kwargs)
+
+        active_key = (id(self), name)
+        if active_key in recorder.active:
+            return method(self, *args, **kwargs)
+
+        key = (self.identifier, name)
+        measurement = _Measurement(recorder)
+        result = None
+        recorder.active.add(active_key)
+        try:
+            with measurement:
+                result = method(self, *args, **kwargs)
+        finally:
+            recorder.active.discard(active_key)
+            if not isinstance(result, types.GeneratorType):
+                recorder.record(key, measurement)
+
+        if isinstance(result, types.GeneratorType):
+            return _measured_generator(result, measurement, recorder, key)
+        return result
+
+    return instrumented_method
+
+
+class InstrumentationMiddleware(object):
+    """Records the datasource calls of each request, and logs them
+    when it is done."""
+
+    def process_request(self, request):
+        # A context left over from a request that didn't end cleanly
+        previous = _current_recorder()
+        if previous is not None:
+            stop(previous)
+        _state.request_recorder = start()
+
+    def _stop(self, request):
+        recorder = getattr(_state, 'request_recorder', None)
+        if recorder is None:
+            return
+        _state.request_recorder = None
+        stop(recorder)
+
+        if recorder.calls:
+            logger.info(
+                "%s %s took %.3fs: %s", request.method, request.path,
+                time.time() - recorder.started, recorder.log_line())
+
+    def process_response(self, request, response):
+        self._stop(request)
+        return response
+
+    def process_exception(self, request, exception):
+        self._stop(request)
@@ -1,17 +1,124 @@
 """Module for the Location class. So what if that's Java-ish, it keeps
-modules reasonably short and readable."""
+modules reasonably short and readable.
+
+Layers can have tens of thousands of locations, so Location uses
+__slots__ and only has a dict for extra arguments if there are
+any. Datasources with many locations can return a LocationSet instead
+of a list; it keeps each attribute in one array, and yields Location
+views when iterated over.
+
+Filtering locations by bounding box and thinning them out to a
+maximum number of points is done with a GridIndex, see
+filter_locations()."""
+
+import math
+
+import numpy
+
+# The grid index of a LocationSet aims for this many locations per cell
+LOCATIONS_PER_CELL = 16
+
+
+def filter_locations(locations, bbox=None, max_points=None):
+    """Return only those locations that are within bbox, a
+    (minlon, minlat, maxlon, maxlat) tuple, and thin them out so that
+    there are at most max_points, spread evenly over the map. If
+    neither is given, locations is returned as is. Otherwise the
+    result is a LocationSet."""
+    if bbox is None and not max_points:
+        return locations
+
+    if not isinstance(locations, LocationSet):
+        locations = LocationSet.from_locations(locations)
+    if bbox is not None:
+        locations = locations.within(bbox)
+    if max_points:
+        locations = locations.thinned(max_points)
+    return locations
+
+
+class GridIndex(object):
+    """Spatial index that puts points in square cells of cell_size
+    degrees. Cells maps (column, row) tuples to sorted arrays of the
+    positions of the points in that cell; empty cells aren't
+    included."""
+
+    def __init__(self, longitudes, latitudes, cell_size):
+        self.longitudes = longitudes
+        self.latitudes = latitudes
+        self.cell_size = cell_size
+        self.cells = {}
+
+        if not len(longitudes):
+            return
+
+        columns = numpy.floor(longitudes / cell_size).astype(numpy.int64)
+        rows = numpy.floor(latitudes / cell_size).astype(numpy.int64)
+        order = numpy.lexsort((rows, columns))
+        columns, rows = columns[order], rows[order]
+
+        starts = numpy.flatnonzero(numpy.r_[
+                True, (numpy.diff(columns) != 0) | (numpy.diff(rows) != 0)])
+        ends = numpy.r_[starts[1:], len(order)]
+        for start, end in zip(starts, ends):
+            self.cells[(int(columns[start]), int(rows[start]))] = (
+                numpy.sort(order[start:end]))
+
+    def _cell(self, longitude, latitude):
+        return (int(math.floor(longitude / self.cell_size)),
+                int(math.floor(latitude / self.cell_size)))
+
+    def query(self, bbox):
+        """Return the sorted positions of the points within bbox, a
+        (minlon, minlat, maxlon, maxlat) tuple, borders included."""
+        minlon, minlat, maxlon, maxlat = bbox
+        mincolumn, minrow = self._cell(minlon, minlat)
+        maxcolumn, maxrow = self._cell(maxlon, maxlat)
+
+        if ((maxcolumn - mincolumn + 1) * (maxrow - minrow + 1) <=
+            len(self.cells)):
+            candidates = [
+                self.cells[(column, row)]
+                for column in xrange(mincolumn, maxcolumn + 1)
+                for row in xrange(minrow, maxrow + 1)
+                if (column, row) in self.cells]
+        else:
+            # The bbox is large, cheaper to look at each nonempty cell
+            candidates = [
+                positions for (column, row), positions in self.cells.items()
+                if mincolumn <= column <= maxcolumn and
+                minrow <= row <= maxrow]
+
+        if not candidates:
+            return numpy.array([], dtype=numpy.int64)
+
+        positions = numpy.concatenate(candidates)
+        longitudes = self.longitudes[positions]
+        latitudes = self.latitudes[positions]
+        inside = ((longitudes >= minlon) & (longitudes <= maxlon) &
+                  (latitudes >= minlat) & (latitudes <= maxlat))
+        return numpy.sort(positions[inside])
 
 
 class Location(object):
+    __slots__ = (
+        '_identifier', '_latitude', '_longitude', '_color', '_extra_args')
+
     def __init__(self, identifier, latitude, longitude, color=None, **kwargs):
         self._identifier = identifier
         self._latitude = latitude
         self._longitude = longitude
-        self._extra_args = kwargs.copy()
-        self.color = color
+        self._color = color
+        # Kwargs is a new dict already, no need to copy it
+        self._extra_args = kwargs or None
+
+    def extra_args(self):
+        """Return the extra keyword arguments as a dict. Don't change
+        it."""
+        return self._extra_args or {}
 
     def to_dict(self):
-        d = self._extra_args.copy()
+        d = dict(self.extra_args())
         d['identifier'] = self.identifier
         d['latitude'] = self.latitude
         d['longitude'] = self.longitude
@@ -20,9 +127,10 @@ class Location(object):
         return d
 
     def description(self):
+        extra_args = self.extra_args()
         for key in ('description', 'name'):
-            if key in self._extra_args:
-                return self._extra_args[key]
+            if key in extra_args:
+                return extra_args[key]
         return self.identifier
 
     @property
@@ -37,9 +145,176 @@ class Location(object):
     def longitude(self):
         return self._longitude
 
+    def _get_color(self):
+        return self._color
+
+    def _set_color(self, color):
+        self._color = color
+
+    color = property(_get_color, _set_color)
+
     def __unicode__(self):
         return "Location '{0}' ({1}, {2})".format(
             self.identifier, self.latitude, self.longitude)
 
     def __repr__(self):
         return unicode(self)
+
+
+class LocationView(Location):
+    """A Location that is a view on one row of a LocationSet. Setting
+    its color changes the color in the set."""
+    __slots__ = ('_location_set', '_index')
+
+    def __init__(self, location_set, index):
+        self._location_set = location_set
+        self._index = index
+
+    def extra_args(self):
+        return dict(
+            (key, values[self._index])
+            for key, values in self._location_set.extras.items())
+
+    @property
+    def identifier(self):
+        return self._location_set.identifiers[self._index]
+
+    @property
+    def latitude(self):
+        return float(self._location_set.latitudes[self._index])
+
+    @property
+    def longitude(self):
+        return float(self._location_set.longitudes[self._index])
+
+    def _get_color(self):
+        return self._location_set.colors[self._index]
+
+    def _set_color(self, color):
+        self._location_set.colors[self._index] = color
+
+    color = property(_get_color, _set_color)
+
+
+class LocationSet(object):
+    """A columnar collection of locations: parallel sequences of
+    identifiers, latitudes, longitudes (as numpy arrays) and colors,
+    and a dict of extra columns. Iterating over it yields
+    LocationViews, so it can be used wherever a list of Locations
+    was."""
+
+    def __init__(self, identifiers, latitudes, longitudes, colors=None,
+                 **extras):
+        self.identifiers = list(identifiers)
+        self.latitudes = numpy.asarray(latitudes, dtype=numpy.float64)
+        self.longitudes = numpy.asarray(longitudes, dtype=numpy.float64)
+        if colors is None:
+            colors = [None] * len(self.identifiers)
+        self.colors = list(colors)
+        self.extras = dict(
+            (key, list(values)) for key, values in extras.items())
+        self._projections = {}
+
+    @classmethod
+    def from_locations(cls, locations):
+        """Make a LocationSet out of an iterable of Locations. Extra
+        arguments that only some of them have are None for the
+        others."""
+        locations = list(locations)
+        extra_keys = set()
+        for location in locations:
+            extra_keys.update(location.extra_args())
+
+        return cls(
+            [location.identifier for location in locations],
+            [location.latitude for location in locations],
+            [location.longitude for location in locations],
+            [location.color for location in locations],
+            **dict(
+                (key, [location.extra_args().get(key)
+                       for location in locations])
+                for key in extra_keys))
+
+    def projected(self, transform):
+        """Return a tuple of arrays (xs, ys) of the locations in
+        another projection. Transform is a function like
+        lizard_map.coordinates.wgs84_to_rd that is called once with
+        the arrays of latitudes and longitudes; the result is
+        remembered for each transform."""
+        if transform not in self._projections:
+            xs, ys = transform(self.latitudes, self.longitudes)
+            self.set_projected(transform, xs, ys)
+        return self._projections[transform]
+
+    def set_projected(self, transform, xs, ys):
+        """Set the result of projected() for transform, when the
+        projected coordinates are known already."""
+        self._projections[transform] = (
+            numpy.asarray(xs, dtype=numpy.float64),
+            numpy.asarray(ys, dtype=numpy.float64))
+
+    def take(self, positions):
+        """Return a new LocationSet with only the locations at these
+        positions, in that order."""
+        positions = list(positions)
+        return LocationSet(
+            [self.identifiers[i] for i in positions],
+            self.latitudes.take(positions),
+            self.longitudes.take(positions),
+            [self.colors[i] for i in positions],
+            **dict(
+                (key, [values[i] for i in positions])
+                for key, values in self.extras.items()))
+
+    def _extent(self):
+        """Largest of the longitude and latitude spans, in degrees."""
+        if not len(self):
+            return 0.0
+        return max(self.longitudes.max() - self.longitudes.min(),
+                   self.latitudes.max() - self.latitudes.min())
+
+    def grid_index(self):
+        """Return a GridIndex of these locations, with cells that
+        contain about LOCATIONS_PER_CELL locations. It is made once."""
+        if getattr(self, '_grid_index', None) is None:
+            cells = max(1.0, len(self) / float(LOCATIONS_PER_CELL))
+            cell_size = max(self._extent() / math.sqrt(cells), 1e-9)
+            self._grid_index = GridIndex(
+                self.longitudes, self.latitudes, cell_size)
+        return self._grid_index
+
+    def within(self, bbox):
+        """Return a LocationSet of the locations within bbox, a
+        (minlon, minlat, maxlon, maxlat) tuple."""
+        return self.take(self.grid_index().query(bbox))
+
+    def thinned(self, max_points):
+        """Return a LocationSet of at most max_points of these
+        locations, one from each cell of a grid that is made coarser
+        until it has few enough nonempty cells."""
+        if len(self) <= max_points:
+            return self
+
+        cell_size = max(self._extent() / math.sqrt(max_points), 1e-9)
+        while True:
+            index = GridIndex(self.longitudes, self.latitudes, cell_size)
+            if len(index.cells) <= max_points:
+                break
+            cell_size *= 1.5
+
+        return self.take(sorted(
+                positions[0] for positions in index.cells.values()))
+
+    def __len__(self):
+        return len(self.identifiers)
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError(index)
+        return LocationView(self, index)
+
+    def __iter__(self):
+        for index in xrange(len(self)):
+            yield LocationView(self, index)
@@ -0,0 +1,71 @@
+# Python 3 is coming to town
+from __future__ import print_function, unicode_literals
+from __future__ import absolute_import, division
+
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+from django.utils import simplejson
+
+from lizard_datasource import benchmark
+
+
+class Command(BaseCommand):
+    args = ''
+    help = """Time the hot paths of lizard-datasource (criteria,
+    coloring locations, timeseries with extra lines, the cache script
+    and proximity mapping) on a synthetic datasource of the given
+    size, and write the results as JSON. Everything is rolled back
+    afterwards."""
+
+    option_list = BaseCommand.option_list + (
+        make_option('--levels',
+                    type='int',
+                    dest='levels',
+                    default=3,
+                    help='Number of levels of criteria'),
+        make_option('--fanout',
+                    type='int',
+                    dest='fanout',
+                    default=4,
+                    help='Number of options of each criterion'),
+        make_option('--locations',
+                    type='int',
+                    dest='locations',
+                    default=1000,
+                    help='Number of locations in each layer'),
+        make_option('--series-length',
+                    type='int',
+                    dest='series_length',
+                    default=24 * 7,
+                    help='Number of (hourly) values of each timeseries'),
+        make_option('--latency',
+                    type='float',
+                    dest='latency',
+                    default=0.0,
+                    help='Seconds each call to the synthetic backend takes'),
+        make_option('--repeat',
+                    type='int',
+                    dest='repeat',
+                    default=5,
+                    help='Number of times each scenario is run'),
+        make_option('--output',
+                    dest='output',
+                    default=None,
+                    help='Write the results to this file instead of stdout'),
+        )
+
+    def handle(self, *args, **options):
+        parameters = dict(
+            (key, options[key]) for key in (
+                'levels', 'fanout', 'locations', 'series_length',
+                'latency', 'repeat')
+            if options.get(key) is not None)
+        results = benchmark.Benchmark(**parameters).run()
+
+        json = simplejson.dumps(results, indent=2)
+        if options.get('output'):
+            with open(options['output'], 'w') as f:
+                f.write(json)
+        else:
+            self.stdout.write(json + '\n')
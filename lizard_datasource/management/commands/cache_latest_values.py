@@ -2,9 +2,12 @@
 from __future__ import print_function, unicode_literals
 from __future__ import absolute_import, division
 
+from optparse import make_option
+
 from django.core.management.base import BaseCommand
 
 from lizard_datasource import datasource
+from lizard_datasource import scheduler
 from lizard_datasource import scripts
 
 
@@ -13,9 +16,74 @@ class Command(BaseCommand):
     help = """Iterate over all data sources. If possible, retrieve the
     latest values of all timeseries in them, and cache them. This is
     helpful for things like colouring map layers, thresholding, and
-    similar functionality."""
+    similar functionality.
+
+    By default only layers whose latest values are used are refreshed;
+    the layers themselves are found by the discover_layers command."""
+
+    option_list = BaseCommand.option_list + (
+        make_option('--all-layers',
+                    action='store_true',
+                    dest='all_layers',
+                    default=False,
+                    help='Walk all drawable layers, not only the used ones'),
+        make_option('--workers',
+                    type='int',
+                    dest='workers',
+                    default=1,
+                    help='Run datasources in this many worker processes'),
+        make_option('--datasource',
+                    action='append',
+                    dest='datasources',
+                    default=[],
+                    help='Only run for datasources with this identifier '
+                    '(can be given more than once)'),
+        make_option('--deadline',
+                    type='int',
+                    dest='deadline',
+                    default=None,
+                    help='Stop datasources still running after this '
+                    'many seconds (each runs in a worker process then)'),
+        make_option('--daemon',
+                    action='store_true',
+                    dest='daemon',
+                    default=False,
+                    help='Keep running, and run each datasource when due'),
+        make_option('--poll-seconds',
+                    type='int',
+                    dest='poll_seconds',
+                    default=60,
+                    help='With --daemon, how often to check the schedule'),
+        )
 
     def handle(self, *args, **options):
-        for ds in datasource.datasources_from_entrypoints():
+        targeted = not options.get('all_layers')
+
+        if options.get('daemon'):
+            scheduler.CacheScheduler(
+                targeted=targeted,
+                workers=options.get('workers') or 1,
+                poll_seconds=options.get('poll_seconds') or 60,
+                deadline=options.get('deadline'),
+                identifiers=options.get('datasources') or None
+                ).run_forever()
+            return
+
+        datasources = datasource.datasources_from_entrypoints()
+        if options.get('datasources'):
+            datasources = [
+                ds for ds in datasources
+                if ds.identifier in options['datasources']]
+
+        # A deadline can only be enforced by killing a process, so
+        # then even a single worker runs in its own process
+        workers = options.get('workers') or 1
+        if workers > 1 or options.get('deadline'):
+            scripts.cache_latest_values_in_parallel(
+                datasources, workers,
+                deadline=options.get('deadline'), targeted=targeted)
+            return
+
+        for ds in datasources:
             print(ds)
-            scripts.cache_latest_values(ds)
+            scripts.cache_latest_values(ds, targeted=targeted)
@@ -0,0 +1,34 @@
+# Python 3 is coming to town
+from __future__ import print_function, unicode_literals
+from __future__ import absolute_import, division
+
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from lizard_datasource import datasource
+from lizard_datasource import scripts
+
+
+class Command(BaseCommand):
+    args = ''
+    help = """Find all drawable layers of all data sources whose latest
+    values can be cached, and create DatasourceLayer objects for them
+    so they can be configured in the admin. Only data sources whose
+    rediscovery interval has expired are walked, unless --force is
+    given."""
+
+    option_list = BaseCommand.option_list + (
+        make_option('--force',
+                    action='store_true',
+                    dest='force',
+                    default=False,
+                    help='Rediscover even if the interval has not expired'),
+        )
+
+    def handle(self, *args, **options):
+        force = bool(options.get('force'))
+        for ds in datasource.datasources_from_entrypoints():
+            layers = scripts.refresh_layer_discovery(ds, force=force)
+            if layers is not None:
+                print("{0}: {1} layers".format(ds, len(layers)))
@@ -4,7 +4,9 @@ they call and see if they commands run without error."""
 import mock
 from unittest import TestCase
 
+from lizard_datasource.management.commands import benchmark_datasources
 from lizard_datasource.management.commands import cache_latest_values
+from lizard_datasource.management.commands import discover_layers
 
 
 class TestCacheLatestValues(TestCase):
@@ -19,4 +21,88 @@ class TestCacheLatestValues(TestCase):
                 command.handle()
                 self.assertTrue(mocked1.called)
                 self.assertTrue(mocked2.called)
-                mocked2.assert_called_with(return_value[0])
+                mocked2.assert_called_with(return_value[0], targeted=True)
+
+    def test_all_layers_option(self):
+        command = cache_latest_values.Command()
+        return_value = [mock.MagicMock()]
+        with mock.patch(
+            'lizard_datasource.datasource.datasources_from_entrypoints',
+            return_value=return_value):
+            with mock.patch('lizard_datasource.scripts.cache_latest_values'
+                            ) as mocked:
+                command.handle(all_layers=True)
+                mocked.assert_called_with(return_value[0], targeted=False)
+
+    def test_datasource_option_filters(self):
+        command = cache_latest_values.Command()
+        ds1, ds2 = mock.MagicMock(), mock.MagicMock()
+        ds1.identifier, ds2.identifier = 'one', 'two'
+        with mock.patch(
+            'lizard_datasource.datasource.datasources_from_entrypoints',
+            return_value=[ds1, ds2]):
+            with mock.patch('lizard_datasource.scripts.cache_latest_values'
+                            ) as mocked:
+                command.handle(datasources=['two'])
+                mocked.assert_called_once_with(ds2, targeted=True)
+
+    def test_workers_option_runs_in_parallel(self):
+        command = cache_latest_values.Command()
+        return_value = [mock.MagicMock()]
+        with mock.patch(
+            'lizard_datasource.datasource.datasources_from_entrypoints',
+            return_value=return_value):
+            with mock.patch(
+                'lizard_datasource.scripts.cache_latest_values_in_parallel'
+                ) as mocked:
+                command.handle(workers=4, deadline=50)
+                mocked.assert_called_with(
+                    return_value, 4, deadline=50, targeted=True)
+
+    def test_deadline_without_workers_runs_in_worker(self):
+        command = cache_latest_values.Command()
+        return_value = [mock.MagicMock()]
+        with mock.patch(
+            'lizard_datasource.datasource.datasources_from_entrypoints',
+            return_value=return_value):
+            with mock.patch(
+                'lizard_datasource.scripts.cache_latest_values_in_parallel'
+                ) as mocked:
+                command.handle(deadline=50)
+                mocked.assert_called_with(
+                    return_value, 1, deadline=50, targeted=True)
+
+    def test_daemon_gets_deadline_and_datasources(self):
+        command = cache_latest_values.Command()
+        with mock.patch(
+            'lizard_datasource.scheduler.CacheScheduler') as mocked:
+            command.handle(daemon=True, deadline=50, datasources=['two'])
+            mocked.assert_called_with(
+                targeted=True, workers=1, poll_seconds=60, deadline=50,
+                identifiers=['two'])
+            self.assertTrue(mocked.return_value.run_forever.called)
+
+
+class TestDiscoverLayers(TestCase):
+    def test_run(self):
+        command = discover_layers.Command()
+        return_value = [mock.MagicMock()]
+        with mock.patch(
+            'lizard_datasource.datasource.datasources_from_entrypoints',
+            return_value=return_value):
+            with mock.patch(
+                'lizard_datasource.scripts.refresh_layer_discovery',
+                return_value=None) as mocked:
+                command.handle(force=True)
+                mocked.assert_called_with(return_value[0], force=True)
+
+
+class TestBenchmarkDatasources(TestCase):
+    def test_run(self):
+        command = benchmark_datasources.Command()
+        command.stdout = mock.MagicMock()
+        with mock.patch('lizard_datasource.benchmark.Benchmark') as mocked:
+            mocked.return_value.run.return_value = {'scenarios': {}}
+            command.handle(levels=2, locations=10)
+            mocked.assert_called_with(levels=2, locations=10)
+            self.assertTrue(command.stdout.write.called)
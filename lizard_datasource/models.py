@@ -2,19 +2,67 @@
 from __future__ import print_function, unicode_literals
 from __future__ import absolute_import, division
 
+import datetime
+import hashlib
 import logging
-import math
+import os
+import socket
 
+from django.conf import settings
 from django.db import models
+from django.db import transaction
+from django.utils import simplejson
 from django.utils.translation import ugettext_lazy as _
 import colorful.fields
+import numpy
 
 from lizard_datasource import dates
+from lizard_datasource import location
 
 
 logger = logging.getLogger(__name__)
 
 
+def rd_coordinates(latitudes, longitudes):
+    """Return arrays of the RD x and y coordinates of these WGS84
+    latitudes and longitudes, transformed in one call."""
+    # Imported here, so that importing the models doesn't need lizard_map
+    from lizard_map import coordinates
+
+    if not len(latitudes):
+        return [], []
+    return coordinates.wgs84_to_rd(
+        numpy.asarray(latitudes, dtype=numpy.float64),
+        numpy.asarray(longitudes, dtype=numpy.float64))
+
+
+# Maximum number of rows inserted by one query. SQLite (before Django
+# 1.5 splits them) can't handle many more.
+BULK_CREATE_BATCH_SIZE = 100
+
+
+def bulk_create_in_batches(model, instances):
+    """Insert the (unsaved) instances of model with one query per
+    BULK_CREATE_BATCH_SIZE of them."""
+    instances = list(instances)
+    for start in range(0, len(instances), BULK_CREATE_BATCH_SIZE):
+        model.objects.bulk_create(
+            instances[start:start + BULK_CREATE_BATCH_SIZE])
+
+
+def _timestamp_key(timestamp):
+    """A key that is the same for datetimes and pandas Timestamps of
+    the same moment."""
+    timestamp = dates.to_utc(timestamp)
+    return tuple(timestamp.utctimetuple())[:6] + (timestamp.microsecond,)
+
+
+def lease_owner(pid=None):
+    """Identifies this process (or the process with this pid on this
+    host) as the owner of a cache script lease."""
+    return "{0}:{1}".format(socket.gethostname(), pid or os.getpid())
+
+
 class DatasourceModel(models.Model):
     """Each datasource we find should have a corresponding entry in
     this table. It controls whether the datasource should be visible
@@ -39,54 +87,238 @@ class DatasourceModel(models.Model):
     script_last_run_started = models.DateTimeField(null=True)
     script_run_next_opportunity = models.BooleanField(default=False)
 
+    # A run of the cache script claims the datasource until the lease
+    # expires, so that overlapping runs skip it. Runs renew the lease
+    # while they work; a crashed run keeps its claim until it expires.
+    script_lease_owner = models.CharField(
+        max_length=100, null=True, blank=True)
+    script_lease_expires = models.DateTimeField(null=True, blank=True)
+
+    # How far back the script looks for locations that don't have a
+    # cached value yet
+    script_initial_lookback_days = models.IntegerField(default=60)
+
+    # Finding all the drawable layers of a datasource means walking
+    # its whole tree of criteria, so the result is stored (as the
+    # discovered_at of DatasourceLayers) and only redone now and then.
+    layers_discovered_at = models.DateTimeField(null=True, blank=True)
+    rediscovery_interval_hours = models.IntegerField(default=24)
+
+    # If this is more than 0, the cache script also keeps the history
+    # of the values it fetches (see DatasourceHistory), for this many
+    # days.
+    history_retention_days = models.IntegerField(default=0)
+
     def __unicode__(self):
         return "'{0}' from app '{1}'".format(
             self.identifier,
             self.originating_app)
 
+    # Length of a cache script lease, unless the
+    # LIZARD_DATASOURCE_CACHE_SCRIPT_LEASE_MINUTES setting says
+    # otherwise. Running scripts renew it well before it expires, so
+    # it only has to be longer than fetching a single location takes;
+    # it is how long a crashed run keeps the datasource locked.
+    CACHE_SCRIPT_LEASE_MINUTES = 15
+
+    # What activation_for_cache_script() returns if the script may run:
+    # because the datasource's own schedule is due, or only because
+    # some layers with their own refresh interval are.
+    ACTIVATED_ON_SCHEDULE = 'schedule'
+    ACTIVATED_FOR_LAYERS = 'layers'
+
+    # Fields that are reloaded before deciding whether the cache
+    # script may run, because other processes may have changed them.
+    SCRIPT_FIELDS = (
+        'script_times_to_run_per_day', 'script_last_run_started',
+        'script_run_next_opportunity', 'script_lease_owner',
+        'script_lease_expires')
+
     def activation_for_cache_script(self):
-        """Return True if the cache script should active. If it shouldn't,
-        if will do nothing this time.
+        """Return False if the cache script shouldn't activate; it
+        will do nothing this time. Otherwise return
+        ACTIVATED_ON_SCHEDULE if the datasource's schedule is due, or
+        ACTIVATED_FOR_LAYERS if only layers with their own refresh
+        interval are (both are true values).
+
+        If the script activates, it is assumed that it will run now,
+        and that is recorded. This is done with a single conditional
+        UPDATE that also claims the datasource for this process, so
+        that of several overlapping runs only one can activate. Call
+        release_cache_script() when done."""
+
+        fields = DatasourceModel.objects.filter(pk=self.pk).values(
+            *self.SCRIPT_FIELDS)
+        for field, value in (fields[0].items() if fields else ()):
+            setattr(self, field, value)
+
+        now = dates.utc_now()
+
+        if self.cache_script_is_due(now):
+            activation = self.ACTIVATED_ON_SCHEDULE
+        elif self.layers_due_for_refresh(now):
+            activation = self.ACTIVATED_FOR_LAYERS
+        else:
+            return False
 
-        If True is returned, it is assumed that the script will run now,
-        and that is recorded."""
+        if (self.script_lease_expires is not None and
+            dates.to_utc(self.script_lease_expires) > now):
+            # Claimed by a run that is still going
+            return False
 
-        if self.cache_script_is_due():
-            self.script_last_run_started = dates.utc_now()
-            self.script_run_next_opportunity = False
-            self.save()
-            return True
-        else:
+        owner = lease_owner()
+        expires = now + self.cache_script_lease()
+
+        # Only succeeds if nobody else changed these fields since we
+        # read them.
+        claimed = DatasourceModel.objects.filter(
+            pk=self.pk,
+            script_last_run_started=self.script_last_run_started,
+            script_run_next_opportunity=self.script_run_next_opportunity,
+            script_lease_expires=self.script_lease_expires).update(
+            script_last_run_started=now,
+            script_run_next_opportunity=False,
+            script_lease_owner=owner,
+            script_lease_expires=expires)
+
+        if claimed != 1:
+            return False
+
+        self.script_last_run_started = now
+        self.script_run_next_opportunity = False
+        self.script_lease_owner = owner
+        self.script_lease_expires = expires
+        return activation
+
+    def cache_script_lease(self):
+        """Return the length of a cache script lease, a timedelta."""
+        return datetime.timedelta(minutes=getattr(
+                settings, 'LIZARD_DATASOURCE_CACHE_SCRIPT_LEASE_MINUTES',
+                self.CACHE_SCRIPT_LEASE_MINUTES))
+
+    def renew_cache_script_lease(self):
+        """Extend this process' claim on the datasource by a whole
+        lease, with a conditional UPDATE on the owner. Returns False
+        if the claim was lost, because it expired and another run
+        claimed the datasource."""
+        expires = dates.utc_now() + self.cache_script_lease()
+        renewed = DatasourceModel.objects.filter(
+            pk=self.pk, script_lease_owner=lease_owner()).update(
+            script_lease_expires=expires)
+        if renewed != 1:
             return False
 
-    def cache_script_is_due(self):
+        self.script_lease_expires = expires
+        return True
+
+    def release_cache_script(self, owner=None):
+        """Give up this process' claim on the datasource, or that of
+        owner (see lease_owner()), if it still has it."""
+        DatasourceModel.objects.filter(
+            pk=self.pk, script_lease_owner=owner or lease_owner()).update(
+            script_lease_owner=None, script_lease_expires=None)
+        self.script_lease_owner = None
+        self.script_lease_expires = None
+
+    @property
+    def minutes_between_scripts(self):
+        """Minutes between two runs of the cache script, or None if it
+        shouldn't run on a schedule at all."""
+        if not (0 < self.script_times_to_run_per_day <= (24 * 60)):
+            return None
+
+        return (60 * 24) // self.script_times_to_run_per_day
+
+    def cache_script_is_due(self, now=None):
         if self.script_run_next_opportunity:
             return True
 
         if self.script_last_run_started is None:
             return True
 
-        if not (0 < self.script_times_to_run_per_day <= (24 * 60)):
+        minutes_between_scripts = self.minutes_between_scripts
+        if minutes_between_scripts is None:
             return False
 
-        minutes_between_scripts = (
-            (60 * 24) // self.script_times_to_run_per_day)
+        script_should_run_at = dates.scheduled_time_before(
+            now or dates.utc_now(), minutes_between_scripts)
 
-        current_time = dates.utc_now()
+        return (
+            script_should_run_at > dates.to_utc(self.script_last_run_started))
 
-        minutes_since_midnight = (
-            60 * current_time.hour + current_time.minute)
+    def cache_script_has_work(self, now=None):
+        """True if either the datasource or one of its layers with its
+        own refresh interval is due."""
+        return bool(self.cache_script_is_due(now) or
+                    self.layers_due_for_refresh(now))
+
+    def layers_due_for_refresh(self, now=None):
+        """Return the used layers that have their own refresh interval
+        and are due to be refreshed."""
+        return [
+            layer for layer in self.layers_with_latest_values_used().filter(
+                script_refresh_minutes__isnull=False)
+            if layer.refresh_is_due(False, now)]
+
+    def cache_script_next_due(self, now=None, layer_due_times=()):
+        """Return the first moment at which the cache script will be
+        due for this datasource (now, if it is due already), or None
+        if it doesn't run on a schedule. Layer_due_times are the
+        moments at which layers with their own refresh interval are
+        due (see DatasourceLayer.refresh_next_due). If another run has
+        claimed the datasource, it isn't due before that claim
+        expires."""
+        if now is None:
+            now = dates.utc_now()
+
+        if self.cache_script_is_due(now):
+            next_due = now
+        elif self.minutes_between_scripts is None:
+            next_due = None
+        else:
+            next_due = dates.scheduled_time_after(
+                now, self.minutes_between_scripts)
 
-        script_should_run_at_minutes = (
-            minutes_since_midnight -
-            (minutes_since_midnight % minutes_between_scripts))
+        for layer_next_due in layer_due_times:
+            if next_due is None or layer_next_due < next_due:
+                next_due = layer_next_due
 
-        script_should_run_at = current_time.replace(
-            hour=script_should_run_at_minutes // 60,
-            minute=script_should_run_at_minutes % 60)
+        if self.script_lease_expires is not None and next_due is not None:
+            next_due = max(next_due, dates.to_utc(self.script_lease_expires))
 
-        return (
-            script_should_run_at > dates.to_utc(self.script_last_run_started))
+        return next_due
+
+    def layer_discovery_is_due(self):
+        """Return True if the layers of this datasource haven't been
+        discovered yet, or if the last discovery is too old."""
+        if self.layers_discovered_at is None:
+            return True
+
+        return dates.utc_now() >= (
+            dates.to_utc(self.layers_discovered_at) +
+            datetime.timedelta(hours=self.rediscovery_interval_hours))
+
+    def discovered_layers(self):
+        """Return the layers that were found by the last discovery."""
+        return self.datasourcelayer_set.filter(
+            discovered_at__gte=self.layers_discovered_at)
+
+    def layers_with_latest_values_used(self):
+        """Return the layers of this datasource whose latest values
+        are used, so that the cache script can refresh only those."""
+        return self.datasourcelayer_set.filter(
+            DatasourceLayer.Q_LATEST_VALUES_USED).distinct()
+
+    def record_layer_discovery(self, layers, discovered_at):
+        """Record that a discovery that started at discovered_at has
+        found these layers. Uses update() so that fields changed in
+        the admin in the meantime aren't overwritten."""
+        DatasourceLayer.objects.filter(
+            pk__in=[layer.pk for layer in layers]).update(
+            discovered_at=discovered_at)
+        DatasourceModel.objects.filter(pk=self.pk).update(
+            layers_discovered_at=discovered_at)
+        self.layers_discovered_at = discovered_at
 
     class Meta:
         ordering = ('originating_app', 'identifier')
@@ -114,10 +346,37 @@ class DatasourceLayer(models.Model):
     # cached here.  Also allows editing it in the admin interface.
     unit_cache = models.CharField(max_length=100, null=True, blank=True)
 
-    # Helpful Q object
+    # When the layer was last found while discovering the layers of
+    # its datasource. See DatasourceModel.discovered_layers().
+    discovered_at = models.DateTimeField(null=True, blank=True)
+
+    # The cache script caches latest values of layers that are used
+    # for coloring, and of layers that have this turned on.
+    cache_latest_values = models.BooleanField(default=False)
+
+    # Layers can be refreshed on their own schedule, every so many
+    # minutes. If this is empty, the layer is refreshed whenever the
+    # datasource's cache script runs.
+    script_refresh_minutes = models.IntegerField(null=True, blank=True)
+    script_last_refreshed = models.DateTimeField(null=True, blank=True)
+
+    # Name of the timeseries column (label||unit) of the history, as
+    # it was returned by the datasource.
+    history_series_name = models.CharField(
+        max_length=255, null=True, blank=True)
+
+    # The locations of the layer are kept in DatasourceLayerLocation
+    # by the cache script. The hash is used to see if they changed.
+    locations_hash = models.CharField(max_length=32, null=True, blank=True)
+    locations_refreshed_at = models.DateTimeField(null=True, blank=True)
+
+    # Helpful Q objects
     Q_ONLY_WITH_NICKNAME = (
         models.Q(nickname__isnull=False) &
         ~(models.Q(nickname__exact="")))
+    Q_LATEST_VALUES_USED = (
+        models.Q(cache_latest_values=True) |
+        models.Q(colors_used_by__isnull=False))
 
     class Meta:
         ordering = ('nickname', 'datasource_model', 'choices_made')
@@ -132,8 +391,170 @@ class DatasourceLayer(models.Model):
     @property
     def latest_values_used(self):
         """The only thing that latest values are used for as yet is
-        for ColorFromLatestValue."""
-        return self.colors_used_by.exists()
+        for ColorFromLatestValue, but they can also be turned on by
+        hand."""
+        return self.cache_latest_values or self.colors_used_by.exists()
+
+    def refresh_is_due(self, datasource_due, now=None):
+        """Should the cache script refresh this layer now? Layers
+        without their own refresh interval are due when the datasource
+        is (datasource_due)."""
+        if self.script_refresh_minutes is None:
+            return datasource_due
+
+        if self.script_last_refreshed is None:
+            return True
+
+        if not (0 < self.script_refresh_minutes <= (24 * 60)):
+            return False
+
+        return dates.scheduled_time_before(
+            now or dates.utc_now(), self.script_refresh_minutes) > (
+            dates.to_utc(self.script_last_refreshed))
+
+    def refresh_next_due(self, now=None):
+        """The first moment this layer is due by its own refresh
+        interval, or None if it doesn't have one."""
+        if now is None:
+            now = dates.utc_now()
+
+        if self.script_refresh_minutes is None:
+            return None
+        if self.refresh_is_due(False, now):
+            return now
+        if not (0 < self.script_refresh_minutes <= (24 * 60)):
+            return None
+        return dates.scheduled_time_after(now, self.script_refresh_minutes)
+
+    def record_refresh(self, refreshed_at):
+        """Record that the cache script refreshed this layer."""
+        DatasourceLayer.objects.filter(pk=self.pk).update(
+            script_last_refreshed=refreshed_at)
+        self.script_last_refreshed = refreshed_at
+
+    def purge_history(self, cutoff):
+        """Remove the history from before cutoff, and record that the
+        history now starts there."""
+        DatasourceHistory.objects.filter(
+            datasource_layer=self, timestamp__lt=cutoff).delete()
+        DatasourceCache.objects.filter(
+            datasource_layer=self, history_start__lt=cutoff).update(
+            history_start=cutoff)
+
+    def locations_due_for_refresh(self, now):
+        """Should the cache script get the locations of this layer
+        from the datasource again? Uses the datasource's layer
+        rediscovery interval."""
+        if self.locations_refreshed_at is None:
+            return True
+        return (dates.to_utc(self.locations_refreshed_at) +
+                datetime.timedelta(
+                hours=self.datasource_model.rediscovery_interval_hours)
+                <= now)
+
+    def store_locations(self, locations, refreshed_at):
+        """Store the locations (an iterable of Location objects) in
+        DatasourceLayerLocation. If they are the same as last time,
+        nothing is written except the refresh time; otherwise only the
+        changed locations are. Returns True if anything changed.
+
+        Extra arguments that JSON can't represent (like datetimes or
+        Decimals from a backend) are stored as strings."""
+        rows = dict(
+            (l.identifier, (l.latitude, l.longitude, simplejson.dumps(
+                        l.extra_args(), sort_keys=True, default=unicode)))
+            for l in locations)
+        locations_hash = hashlib.md5(
+            repr(sorted(rows.items())).encode('utf-8')).hexdigest()
+
+        changed = locations_hash != self.locations_hash
+        if changed:
+            stored = dict(
+                (fields['identifier'], fields) for fields in
+                DatasourceLayerLocation.objects.filter(
+                    datasource_layer=self).values(
+                    'id', 'identifier', 'latitude', 'longitude', 'extra'))
+
+            DatasourceLayerLocation.objects.filter(id__in=[
+                    fields['id'] for identifier, fields in stored.items()
+                    if identifier not in rows]).delete()
+
+            changed_identifiers = [
+                identifier for identifier, row in rows.items()
+                if identifier not in stored or (
+                    stored[identifier]['latitude'],
+                    stored[identifier]['longitude'],
+                    stored[identifier]['extra']) != row]
+            rd_xs, rd_ys = rd_coordinates(
+                [rows[identifier][0] for identifier in changed_identifiers],
+                [rows[identifier][1] for identifier in changed_identifiers])
+
+            new_locations = []
+            for identifier, rd_x, rd_y in zip(
+                changed_identifiers, rd_xs, rd_ys):
+                latitude, longitude, extra = rows[identifier]
+                if identifier not in stored:
+                    new_locations.append(DatasourceLayerLocation(
+                            datasource_layer=self, identifier=identifier,
+                            latitude=latitude, longitude=longitude,
+                            rd_x=rd_x, rd_y=rd_y, extra=extra))
+                else:
+                    DatasourceLayerLocation.objects.filter(
+                        id=stored[identifier]['id']).update(
+                        latitude=latitude, longitude=longitude,
+                        rd_x=rd_x, rd_y=rd_y, extra=extra)
+            bulk_create_in_batches(DatasourceLayerLocation, new_locations)
+
+        DatasourceLayer.objects.filter(pk=self.pk).update(
+            locations_hash=locations_hash,
+            locations_refreshed_at=refreshed_at)
+        self.locations_hash = locations_hash
+        self.locations_refreshed_at = refreshed_at
+        return changed
+
+    def catalogue(self, bbox=None):
+        """Return the stored locations of this layer as a LocationSet,
+        or None if they were never stored. If bbox, a (minlon, minlat,
+        maxlon, maxlat) tuple, is given, only those within it."""
+        from lizard_map import coordinates
+
+        if self.locations_hash is None:
+            return None
+
+        rows = DatasourceLayerLocation.objects.filter(datasource_layer=self)
+        if bbox is not None:
+            minlon, minlat, maxlon, maxlat = bbox
+            rows = rows.filter(
+                longitude__gte=minlon, longitude__lte=maxlon,
+                latitude__gte=minlat, latitude__lte=maxlat)
+
+        rows = list(rows.order_by('identifier').values_list(
+                'identifier', 'latitude', 'longitude', 'extra',
+                'rd_x', 'rd_y'))
+        location_set = location.LocationSet.from_locations(
+            location.Location(
+                identifier, latitude, longitude,
+                **simplejson.loads(extra))
+            for identifier, latitude, longitude, extra, rd_x, rd_y in rows)
+        # The RD coordinates are known, no need to transform again
+        location_set.set_projected(
+            coordinates.wgs84_to_rd,
+            [row[4] for row in rows], [row[5] for row in rows])
+        return location_set
+
+    def catalogue_rd_coordinates(self):
+        """Return a dict with the RD coordinates (x, y) of the stored
+        locations of this layer, keyed on identifier, or None if they
+        were never stored."""
+        if self.locations_hash is None:
+            return None
+
+        return dict(
+            (identifier, (rd_x, rd_y))
+            for identifier, rd_x, rd_y in
+            DatasourceLayerLocation.objects.filter(
+                datasource_layer=self).values_list(
+                'identifier', 'rd_x', 'rd_y'))
 
     def save(self, *args, **kwargs):
         """In case of a missing nickname, we want it to be NULL. Not
@@ -143,12 +564,291 @@ class DatasourceLayer(models.Model):
         return super(DatasourceLayer, self).save(*args, **kwargs)
 
 
+class DatasourceLayerLocation(models.Model):
+    """A location of a layer, kept by the cache script so that maps
+    and proximity mappings don't need to ask the datasource. See
+    DatasourceLayer.store_locations() and catalogue()."""
+
+    datasource_layer = models.ForeignKey(DatasourceLayer)
+    identifier = models.CharField(max_length=100)
+
+    latitude = models.FloatField()
+    longitude = models.FloatField(db_index=True)
+
+    # Rijksdriehoek coordinates, for computing distances
+    rd_x = models.FloatField(null=True)
+    rd_y = models.FloatField(null=True)
+
+    # JSON of the extra arguments of the location
+    extra = models.TextField(default='{}')
+
+    class Meta:
+        unique_together = ('datasource_layer', 'identifier')
+
+
 class DatasourceCache(models.Model):
+    """The latest value of one location in a layer, plus bookkeeping
+    of when the cache script last looked for it.
+
+    Locations that keep returning nothing new are checked less and
+    less often: after each empty check, the time until the next check
+    doubles, up to MAX_BACKOFF_INTERVALS times the time between
+    scripts (and never more than MAX_BACKOFF_MINUTES), so that
+    stations that report less often than the script runs are still
+    picked up soon after they do.
+
+    Once a location has been checked, the next check only fetches
+    from FETCH_OVERLAP_MINUTES before the last check, no matter how
+    old its latest value is."""
+
+    MAX_BACKOFF_MINUTES = 7 * 24 * 60
+    MAX_BACKOFF_INTERVALS = 8
+    FETCH_OVERLAP_MINUTES = 30
+
+    datasource_layer = models.ForeignKey(DatasourceLayer)
+    locationid = models.CharField(max_length=100)
+
+    # Null if no value was ever found for this location
+    timestamp = models.DateTimeField(null=True)
+    value = models.FloatField(null=True)
+
+    last_checked = models.DateTimeField(null=True)
+    last_empty = models.DateTimeField(null=True)
+    # Number of checks in a row that didn't find any value
+    empty_count = models.IntegerField(default=0)
+
+    # From this moment up to last_checked, DatasourceHistory has all
+    # the values of this location. Null if no history is kept.
+    history_start = models.DateTimeField(null=True)
+
+    def fetch_is_due(self, minutes_between_checks, now):
+        """Should the script check this location now? Always true,
+        unless the last checks were empty."""
+        if not self.empty_count or self.last_checked is None:
+            return True
+
+        minutes_between_checks = minutes_between_checks or 60
+        backoff_minutes = min(
+            minutes_between_checks * 2 ** (self.empty_count - 1),
+            minutes_between_checks * self.MAX_BACKOFF_INTERVALS,
+            self.MAX_BACKOFF_MINUTES)
+
+        return now >= (dates.to_utc(self.last_checked) +
+                       datetime.timedelta(minutes=backoff_minutes))
+
+    def fetch_start(self, initial_lookback_days, now):
+        """Start of the window that needs to be fetched: a little
+        before the last check, or from the latest value if that is
+        later. If the location was never checked, from the latest
+        value if we have one, otherwise initial_lookback_days back."""
+        start = None
+        if self.last_checked is not None:
+            start = dates.to_utc(self.last_checked) - datetime.timedelta(
+                minutes=self.FETCH_OVERLAP_MINUTES)
+        if self.timestamp is not None:
+            timestamp = dates.to_utc(self.timestamp)
+            if start is None or timestamp > start:
+                start = timestamp
+        if start is None:
+            start = now - datetime.timedelta(days=initial_lookback_days)
+        return start
+
+    def append_history(self, timeseries, fetch_start):
+        """Add the values of the first series of timeseries that
+        aren't in DatasourceHistory yet. Timeseries was fetched
+        starting at fetch_start. Must be called before
+        record_check()."""
+        if self.history_start is None:
+            self.history_start = fetch_start
+            after = None
+        else:
+            # Everything up to the latest value is stored already
+            after = self.timestamp and dates.to_utc(self.timestamp)
+
+        if timeseries is None or not len(timeseries):
+            return
+
+        series = timeseries.get_series(timeseries.columns[0])
+        rows = [
+            (timestamp, value) for timestamp, value in series.iteritems()
+            if after is None or timestamp > after]
+        if not rows:
+            return
+
+        # The window can still overlap stored values, for instance if
+        # the cache line was deleted and made again, and inserting one
+        # twice would break the unique constraint
+        timestamps = [timestamp for timestamp, value in rows]
+        stored = set(
+            _timestamp_key(timestamp) for timestamp in
+            DatasourceHistory.objects.filter(
+                datasource_layer=self.datasource_layer_id,
+                locationid=self.locationid,
+                timestamp__gte=min(timestamps),
+                timestamp__lte=max(timestamps)).values_list(
+                'timestamp', flat=True))
+
+        bulk_create_in_batches(DatasourceHistory, (
+                DatasourceHistory(
+                    datasource_layer_id=self.datasource_layer_id,
+                    locationid=self.locationid,
+                    timestamp=timestamp,
+                    value=value)
+                for timestamp, value in rows
+                if _timestamp_key(timestamp) not in stored))
+
+    def record_check(self, last_valid, now):
+        """Record the result of a check. Last_valid is the (timestamp,
+        value) tuple of the latest value found, or None. A check that
+        found nothing newer than the value we already had is empty.
+        Returns True if a newer value was found. Doesn't save."""
+        self.last_checked = now
+
+        if last_valid is None or (
+            self.timestamp is not None and
+            dates.to_utc(last_valid[0]) <= dates.to_utc(self.timestamp)):
+            self.last_empty = now
+            self.empty_count += 1
+            return False
+
+        self.empty_count = 0
+        self.timestamp, self.value = last_valid
+        return True
+
+
+class DatasourceHistory(models.Model):
+    """Append-only history of the values of a location in a layer,
+    filled by the cache script if the datasource has a
+    history_retention_days. Rows are only ever added, and deleted when
+    they are older than the retention period.
+
+    Lookups are always by layer, location and time window, which is
+    exactly the index of the unique constraint."""
+
     datasource_layer = models.ForeignKey(DatasourceLayer)
     locationid = models.CharField(max_length=100)
     timestamp = models.DateTimeField()
     value = models.FloatField()
 
+    class Meta:
+        unique_together = ('datasource_layer', 'locationid', 'timestamp')
+        ordering = ('timestamp',)
+
+
+class CacheRun(models.Model):
+    """A run of the cache script for one datasource, with a
+    CacheRunLayer for each layer it refreshed, so that we can see how
+    long runs take and how close they come to the next scheduled
+    run. Runs older than KEEP_DAYS are deleted when a new run of the
+    same datasource starts."""
+
+    KEEP_DAYS = 30
+
+    datasource_model = models.ForeignKey(DatasourceModel)
+    # Host and process that did the run, like the lease owner
+    owner = models.CharField(max_length=100)
+    targeted = models.BooleanField(default=True)
+
+    started = models.DateTimeField(db_index=True)
+    finished = models.DateTimeField(null=True, blank=True)
+
+    # Totals of the layers
+    layers_refreshed = models.IntegerField(default=0)
+    locations_processed = models.IntegerField(default=0)
+    locations_updated = models.IntegerField(default=0)
+
+    # Traceback, if the run failed
+    error = models.TextField(null=True, blank=True)
+
+    class Meta:
+        ordering = ('-started',)
+
+    def __unicode__(self):
+        return "Cache run of {0} at {1}".format(
+            self.datasource_model, self.started)
+
+    @classmethod
+    def start(cls, datasource_model, targeted):
+        """Create and return the run of the cache script that starts
+        now, and delete old runs of the datasource."""
+        now = dates.utc_now()
+        cls.objects.filter(
+            datasource_model=datasource_model,
+            started__lt=now - datetime.timedelta(days=cls.KEEP_DAYS)
+            ).delete()
+        return cls.objects.create(
+            datasource_model=datasource_model, owner=lease_owner(),
+            targeted=targeted, started=now)
+
+    def finish(self, error=None):
+        """Record the end of the run, and add up the numbers of its
+        layers."""
+        self.finished = dates.utc_now()
+        self.error = error
+        layers = list(self.cacherunlayer_set.all())
+        self.layers_refreshed = len(layers)
+        self.locations_processed = sum(
+            layer.locations_processed for layer in layers)
+        self.locations_updated = sum(
+            layer.locations_updated for layer in layers)
+        self.save()
+
+    def duration_seconds(self):
+        if self.finished is None:
+            return None
+        return (self.finished - self.started).total_seconds()
+
+    def schedule_margin_seconds(self):
+        """Seconds left between the end of this run and the start of
+        the next scheduled one. Negative if the run took longer than
+        the schedule allows."""
+        duration = self.duration_seconds()
+        minutes = self.datasource_model.minutes_between_scripts
+        if duration is None or minutes is None:
+            return None
+        return minutes * 60 - duration
+
+
+class CacheRunLayer(models.Model):
+    """What a cache run did for one layer. Locations are processed
+    (looked at), and fetched unless their backoff wasn't over yet;
+    fetched locations are updated (a newer value was found) or empty
+    (nothing newer was found). Backend_seconds is the time spent
+    waiting for the datasource, db_seconds the time spent reading and
+    writing the cache."""
+
+    cache_run = models.ForeignKey(CacheRun)
+    datasource_layer = models.ForeignKey(DatasourceLayer)
+
+    started = models.DateTimeField()
+    finished = models.DateTimeField(null=True, blank=True)
+
+    locations_processed = models.IntegerField(default=0)
+    locations_fetched = models.IntegerField(default=0)
+    locations_updated = models.IntegerField(default=0)
+    locations_empty = models.IntegerField(default=0)
+
+    backend_seconds = models.FloatField(default=0.0)
+    db_seconds = models.FloatField(default=0.0)
+
+    error = models.TextField(null=True, blank=True)
+
+    def __unicode__(self):
+        return "{0}: {1}".format(self.cache_run, self.datasource_layer)
+
+    def duration_seconds(self):
+        if self.finished is None:
+            return None
+        return (self.finished - self.started).total_seconds()
+
+    def locations_per_second(self):
+        """Fetched locations per second, the throughput of the
+        layer."""
+        duration = self.duration_seconds()
+        if not duration:
+            return None
+        return self.locations_fetched / duration
+
 
 class AugmentedDataSource(models.Model):
     """Model holding the configuration of an AugmentedDataSource; see
@@ -175,8 +875,15 @@ class ColorMap(models.Model):
     def __unicode__(self):
         return self.name
 
+    def lines(self):
+        """The ColorMapLines of this colormap. They are loaded once per
+        instance, so that coloring many locations is one query."""
+        if getattr(self, '_lines', None) is None:
+            self._lines = list(self.colormapline_set.all())
+        return self._lines
+
     def color_for(self, value):
-        for colormapline in self.colormapline_set.all():
+        for colormapline in self.lines():
             color = colormapline.color_for(value)
             if color:
                 return color
@@ -185,7 +892,7 @@ class ColorMap(models.Model):
     def legend(self):
         l = [
             (line.color, line.line_description)
-            for line in self.colormapline_set.all()]
+            for line in self.lines()]
         if self.defaultcolor:
             description = self.defaultdescription or _("Default")
             l.append((self.defaultcolor, description))
@@ -230,7 +937,8 @@ class ExtraGraphLine(models.Model):
     max_distance_for_mapping = models.FloatField(null=True, blank=True)
 
     def map_identifier(self, identifier):
-        if not self.identifier_mapping:
+        # Checking the id doesn't need a query
+        if self.identifier_mapping_id is None:
             return identifier
         else:
             return self.identifier_mapping.map(identifier)
@@ -300,13 +1008,10 @@ class IdentifierMapping(models.Model):
         max_length=30, null=False, blank=False, unique=True)
 
     def map(self, identifier):
-        try:
-            line = IdentifierMappingLine.objects.get(
-                mapping=self,
-                identifier_from=identifier)
-            return line.identifier_to
-        except IdentifierMappingLine.DoesNotExist:
-            return None
+        identifiers_to = IdentifierMappingLine.objects.filter(
+            mapping=self, identifier_from=identifier).values_list(
+            'identifier_to', flat=True)[:1]
+        return identifiers_to[0] if identifiers_to else None
 
     def map_to(self, identifier_from, identifier_to):
         line, created = IdentifierMappingLine.objects.get_or_create(
@@ -314,6 +1019,33 @@ class IdentifierMapping(models.Model):
         line.identifier_to = identifier_to
         line.save()
 
+    @transaction.commit_on_success
+    def map_all_to(self, identifiers):
+        """Like map_to() for each item of identifiers, a dict from
+        identifiers to the identifiers they map to, with a constant
+        number of queries (per BULK_CREATE_BATCH_SIZE lines). Changed
+        lines are deleted and inserted again, in one transaction so
+        that a failed insert doesn't lose them."""
+        existing = dict(IdentifierMappingLine.objects.filter(
+                mapping=self).values_list('identifier_from', 'identifier_to'))
+
+        changed = [
+            identifier_from for identifier_from, identifier_to in
+            identifiers.items()
+            if identifier_from in existing and
+            existing[identifier_from] != identifier_to]
+        for start in range(0, len(changed), BULK_CREATE_BATCH_SIZE):
+            IdentifierMappingLine.objects.filter(
+                mapping=self, identifier_from__in=changed[
+                    start:start + BULK_CREATE_BATCH_SIZE]).delete()
+
+        bulk_create_in_batches(IdentifierMappingLine, (
+                IdentifierMappingLine(
+                    mapping=self, identifier_from=identifier_from,
+                    identifier_to=identifier_to)
+                for identifier_from, identifier_to in identifiers.items()
+                if existing.get(identifier_from) != identifier_to))
+
     def create_proximity_map(
         self, identifiers_from, identifiers_to, max_distance):
         """Identifiers_from and identifiers_to are dicts, with
@@ -325,22 +1057,27 @@ class IdentifierMapping(models.Model):
         For each identifier in identifiers_from, calculate the point
         in identifiers_to that is closest to it, and add an
         identifiermapping line for it."""
-        def distance(p1, p2):
-            return math.sqrt((p1[0] - p2[0]) ** 2 +
-                             (p1[1] - p2[1]) ** 2)
-
         if not identifiers_to:
             return
 
+        # Sorted, so that ties go to the lowest identifier as before
+        identifiers = sorted(identifiers_to)
+        points_to = numpy.array(
+            [identifiers_to[identifier] for identifier in identifiers],
+            dtype=numpy.float64)
+
+        mapped = {}
         for identifier, p1 in identifiers_from.items():
-            # Find closest point
-            mindistance, closest_identifier_to = min(
-                (distance(p1, p2), identifier_to)
-                for identifier_to, p2 in identifiers_to.items())
+            # Find closest point, comparing with all points at once
+            distances = numpy.hypot(
+                points_to[:, 0] - p1[0], points_to[:, 1] - p1[1])
+            closest = distances.argmin()
 
             # If it is in range, map it
-            if not max_distance or mindistance <= max_distance:
-                self.map_to(identifier, closest_identifier_to)
+            if not max_distance or distances[closest] <= max_distance:
+                mapped[identifier] = identifiers[closest]
+
+        self.map_all_to(mapped)
 
     def __unicode__(self):
         return self.name
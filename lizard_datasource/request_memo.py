@@ -0,0 +1,101 @@
+"""Request-scoped memoization of datasource calls.
+
+Within one HTTP request, methods like criteria(),
+options_for_criterion() and is_drawable() are called many times for
+the same datasource and choices (through chooseable_criteria(),
+visible_criteria() and CombinedDataSource). Their results can't be
+remembered for long, because the configuration may change, but they
+don't change during a request.
+
+Inside a request_memo() context, the methods of DataSource listed in
+datasource.MEMOIZED_PER_REQUEST remember their results. When the
+outermost context ends, everything is forgotten. Outside of a context,
+they are called as usual.
+
+Add RequestMemoMiddleware to MIDDLEWARE_CLASSES to use a context for
+each request."""
+
+# Python 3 is coming to town
+from __future__ import print_function, unicode_literals
+from __future__ import absolute_import, division
+
+import contextlib
+import threading
+
+from functools import wraps
+
+_state = threading.local()
+
+
+def _current_memo():
+    return getattr(_state, 'memo', None)
+
+
+@contextlib.contextmanager
+def request_memo():
+    """Remember the results of per_request methods until the end of
+    this context. Nested contexts share the memo of the outermost."""
+    previous = _current_memo()
+    if previous is None:
+        _state.memo = {}
+    try:
+        yield
+    finally:
+        _state.memo = previous
+
+
+class RequestMemoMiddleware(object):
+    """Starts a fresh memo at the start of each request, and throws it
+    away at the end."""
+
+    def process_request(self, request):
+        # Always start fresh, even if the previous request in this
+        # thread didn't end cleanly
+        _state.memo = {}
+
+    def process_response(self, request, response):
+        _state.memo = None
+        return response
+
+    def process_exception(self, request, exception):
+        _state.memo = None
+
+
+def _datasource_key(ds):
+    """Datasources are created anew often, so they are identified by
+    what they are, not by their identity. A CombinedDataSource is what
+    its datasources are."""
+    choices_made = getattr(ds, '_choices_made', None)
+    datasources = getattr(ds, '_datasources', None)
+    return (ds.originating_app, ds.identifier,
+            choices_made.json() if choices_made is not None else None,
+            tuple((child.originating_app, child.identifier)
+                  for child in datasources)
+            if datasources is not None else None)
+
+
+def per_request(method, owner=None):
+    """Wrap a DataSource method so that it remembers its results
+    inside a request_memo() context. Owner is the class the method is
+    defined in, so that a super() call has its own entry."""
+
+    @wraps(method)
+    def memoed(self, *args, **kwargs):
+        memo = _current_memo()
+        if memo is None:
+            return method(self, *args, **kwargs)
+
+        key = (owner, method.__name__, _datasource_key(self),
+               args, tuple(sorted(kwargs.items())))
+        try:
+            return memo[key]
+        except KeyError:
+            pass
+        except TypeError:
+            # Unhashable arguments, can't remember this one
+            return method(self, *args, **kwargs)
+
+        result = memo[key] = method(self, *args, **kwargs)
+        return result
+
+    return memoed
@@ -0,0 +1,167 @@
+"""A long running scheduler for the cache script.
+
+Starting Django every minute from cron just to find out that nothing
+is due is expensive. The CacheScheduler instead keeps running, and
+keeps a priority queue of the moments at which each datasource is
+due next. It sleeps until the earliest of those, and polls the
+schedule (one query on DatasourceModel) now and then so that changes
+made in the admin, like "run at the next opportunity", are noticed.
+
+The database connection is closed after each poll, so that the
+scheduler doesn't keep an idle connection (that the database server
+may drop) or an old transaction open while it sleeps. An error in one
+poll is logged, and the scheduler tries again at the next one."""
+
+# Python 3 is coming to town
+from __future__ import print_function, unicode_literals
+from __future__ import absolute_import, division
+
+import collections
+import heapq
+import logging
+import time
+
+from django.db import connection
+
+from lizard_datasource import datasource
+from lizard_datasource import dates
+from lizard_datasource import models
+from lizard_datasource import scripts
+
+logger = logging.getLogger(__name__)
+
+
+def cacheable_keys(datasources, identifiers=None):
+    """Return the set of (originating_app, identifier) keys of the
+    datasources the cache script can do something for, only those
+    with one of identifiers if that is given. Also makes sure their
+    DatasourceModels exist, so that due_queue finds them."""
+    keys = set()
+    for ds in datasources:
+        if identifiers and ds.identifier not in identifiers:
+            continue
+        if scripts.has_cacheable_layers(ds):
+            ds.datasource_model
+            keys.add((ds.originating_app, ds.identifier))
+    return keys
+
+
+def due_queue(keys, now):
+    """Return a heap of (next_due, key) tuples, one for each of the
+    datasources with these keys whose cache script runs on a
+    schedule. This does two queries, one for the datasources and one
+    for layers that have their own refresh interval."""
+    layer_due_times = collections.defaultdict(list)
+    for fields in models.DatasourceLayer.objects.filter(
+        models.DatasourceLayer.Q_LATEST_VALUES_USED,
+        script_refresh_minutes__isnull=False).values(
+        'datasource_model__originating_app',
+        'datasource_model__identifier',
+        'script_refresh_minutes', 'script_last_refreshed').distinct():
+        key = (fields.pop('datasource_model__originating_app'),
+               fields.pop('datasource_model__identifier'))
+        next_due = models.DatasourceLayer(**fields).refresh_next_due(now)
+        if next_due is not None:
+            layer_due_times[key].append(next_due)
+
+    queue = []
+    for fields in models.DatasourceModel.objects.values(
+        'originating_app', 'identifier',
+        *models.DatasourceModel.SCRIPT_FIELDS):
+        key = (fields['originating_app'], fields['identifier'])
+        if key not in keys:
+            continue
+
+        next_due = models.DatasourceModel(**fields).cache_script_next_due(
+            now, layer_due_times[key])
+        if next_due is not None:
+            queue.append((next_due, key))
+
+    heapq.heapify(queue)
+    return queue
+
+
+class CacheScheduler(object):
+    """Runs the cache script for each datasource when it is due.
+
+    Poll_seconds is the longest time the scheduler sleeps before
+    looking at the schedule again. If workers is more than 1, or a
+    deadline (in seconds) is given, due datasources are run in worker
+    processes, and those still running after the deadline are
+    stopped. If identifiers are given, only datasources with those
+    identifiers are run."""
+
+    def __init__(self, targeted=True, workers=1, poll_seconds=60,
+                 deadline=None, identifiers=None):
+        self.targeted = targeted
+        self.workers = workers
+        self.poll_seconds = poll_seconds
+        self.deadline = deadline
+        self.identifiers = identifiers
+        self.keys = None
+
+    def run_due(self, keys):
+        """Run the cache script for the datasources with these keys.
+        Datasources are loaded fresh, so that their configuration is
+        up to date. This is also when newly configured datasources
+        are noticed."""
+        all_datasources = datasource.datasources_from_entrypoints()
+        self.keys = cacheable_keys(all_datasources, self.identifiers)
+
+        datasources = [
+            ds for ds in all_datasources
+            if (ds.originating_app, ds.identifier) in keys]
+
+        if self.workers > 1 or self.deadline:
+            scripts.cache_latest_values_in_parallel(
+                datasources, self.workers, deadline=self.deadline,
+                targeted=self.targeted)
+            return
+
+        for ds in datasources:
+            try:
+                scripts.cache_latest_values(ds, targeted=self.targeted)
+            except Exception:
+                logger.exception("Cache script failed for %s", ds)
+
+    def run_once(self):
+        """Run everything that is due, and return the number of
+        seconds to sleep until something may be due next."""
+        if self.keys is None:
+            self.keys = cacheable_keys(
+                datasource.datasources_from_entrypoints(), self.identifiers)
+
+        now = dates.utc_now()
+        queue = due_queue(self.keys, now)
+
+        due = set()
+        while queue and queue[0][0] <= now:
+            due.add(heapq.heappop(queue)[1])
+
+        if due:
+            self.run_due(due)
+            # Running may have taken a while, look again right away
+            return 0
+
+        if not queue:
+            return self.poll_seconds
+
+        seconds_until_due = (queue[0][0] - now).total_seconds()
+        return max(1, min(self.poll_seconds, seconds_until_due))
+
+    def poll(self):
+        """Call run_once(), and return the number of seconds to sleep.
+        Errors are logged, then the scheduler waits a whole poll
+        interval before trying again."""
+        try:
+            return self.run_once()
+        except Exception:
+            logger.exception("Cache script scheduler poll failed.")
+            return self.poll_seconds
+        finally:
+            connection.close()
+
+    def run_forever(self):
+        logger.info("Starting cache script scheduler.")
+        while True:
+            time.sleep(self.poll())
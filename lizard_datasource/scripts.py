@@ -1,96 +1,470 @@
+import collections
+import contextlib
 import datetime
 import logging
+import multiprocessing
 import time
+import traceback
+
+from django.db import connection
 
 from lizard_datasource import datasource
 from lizard_datasource import dates
 from lizard_datasource import models
 from lizard_datasource import properties
+from lizard_datasource import timeseries_cache
 
 logger = logging.getLogger(__name__)
 
+# Pause between fetching the timeseries of two locations, to be nice
+# to the backend
+SECONDS_BETWEEN_FETCHES = 1
+
+
+class LeaseLost(Exception):
+    """The claim of this run of the cache script on its datasource
+    expired, and another run claimed the datasource."""
+
+
+class _LeaseRenewer(object):
+    """Call it often while working on a datasource: whenever a third of
+    the lease has passed since the last renewal, it renews this
+    process' claim on the datasource. Raises LeaseLost if that claim
+    was lost."""
+
+    def __init__(self, datasource_model):
+        self.datasource_model = datasource_model
+        self.interval = (
+            datasource_model.cache_script_lease().total_seconds() / 3)
+        self.renewed = time.time()
+
+    def __call__(self):
+        if time.time() - self.renewed < self.interval:
+            return
+
+        if not self.datasource_model.renew_cache_script_lease():
+            raise LeaseLost(
+                "Another run claimed {0}".format(self.datasource_model))
+        self.renewed = time.time()
+
 
 def _yield_drawable_datasources(ds):
     # This implements a breadth-first search that tries to visit all
     # drawable layers and yields their choices made objects. The case
     # where ChoicesMade is empty functions as the root of the tree.
-    choices_mades = [datasource.ChoicesMade()]
+    choices_mades = collections.deque([datasource.ChoicesMade()])
+    seen = set()
 
     while choices_mades:
-        choices_made = choices_mades.pop(0)
+        choices_made = choices_mades.popleft()
         ds.set_choices_made(choices_made)
 
         if ds.is_drawable(choices_made):
             yield ds
-        else:
-            criteria = ds.chooseable_criteria()
-            print("CHOICES_MADE: {0}".format(choices_made))
-            if criteria:
-                criterion = criteria[0]['criterion']
-                print("CRITERION: {0}".format(criterion))
-                options = criteria[0]['options']
-                for option in options.iter_options():
-                    print("CHOICE: {0}".format(option))
-                    choices_mades.append(choices_made.add(
-                            criterion.identifier, option.identifier))
-
-
-def cache_latest_values(ds):
-    """IF the datasource has both LAYER_POINTS and
-    DATA_CAN_HAVE_VALUE_LAYER_SCRIPT source, then we can make an
-    instance of DatasourceLayer for each of its layers, get a
-    timeseries for each location in each layer and cache its latest
-    value. Then this information can be used for colouring,
-    thresholding, et cetera."""
-
-    if (not ds.has_property(properties.LAYER_POINTS) or
-        not ds.has_property(
-            properties.DATA_CAN_HAVE_VALUE_LAYER_SCRIPT)):
-        return  # For now, we don't know what to do in this case
+            continue
 
-    # Only actually do something if the script is due.
-    if not ds.activation_for_cache_script():
-        return
+        criteria = ds.chooseable_criteria()
+        logger.debug("Choices made: %s", choices_made)
+        if not criteria:
+            continue
+
+        criterion = criteria[0]['criterion']
+        options = criteria[0]['options']
+        logger.debug("Criterion: %s", criterion)
+        for option in options.iter_options():
+            logger.debug("Choice: %s", option)
+            new_choices_made = choices_made.add(
+                criterion.identifier, option.identifier)
+
+            # Different paths may lead to the same choices; only
+            # visit those once.
+            json = new_choices_made.json()
+            if json not in seen:
+                seen.add(json)
+                choices_mades.append(new_choices_made)
+
+
+def discover_layers(ds):
+    """Walk the whole tree of choices of the datasource, and return
+    the DatasourceLayer instances of all drawable layers found. They
+    are created if they didn't exist yet, and the discovery is
+    recorded so that drawable_layers() can reuse it."""
+    discovered_at = dates.utc_now()
+    layers = []
 
     for drawable in _yield_drawable_datasources(ds):
         # This creates the datasource layer in the database, if it
         # didn't exist yet
-        datasource_layer = drawable.datasource_layer
+        layers.append(drawable.datasource_layer)
 
         # Cache the datasource layer's unit, if it wasn't filled in yet
         drawable.cached_unit()
 
+    logger.info("Discovered %d layers of %s", len(layers), ds.identifier)
+    ds.datasource_model.record_layer_discovery(layers, discovered_at)
+    return layers
+
+
+def drawable_layers(ds):
+    """Return the DatasourceLayers of all drawable layers of the
+    datasource. The result of the last discovery is used, unless its
+    rediscovery interval has expired."""
+    datasource_model = ds.datasource_model
+    if datasource_model.layer_discovery_is_due():
+        return discover_layers(ds)
+    return list(datasource_model.discovered_layers())
+
+
+def has_cacheable_layers(ds):
+    """Only datasources that have both LAYER_POINTS and
+    DATA_CAN_HAVE_VALUE_LAYER_SCRIPT have layers whose latest values
+    the cache script can cache."""
+    return (ds.has_property(properties.LAYER_POINTS) and
+            ds.has_property(properties.DATA_CAN_HAVE_VALUE_LAYER_SCRIPT))
+
+
+def refresh_layer_discovery(ds, force=False):
+    """Discover the layers of the datasource if that is due (or
+    forced). Returns the layers found, or None if nothing was done."""
+    if not has_cacheable_layers(ds):
+        return None
+
+    if force or ds.datasource_model.layer_discovery_is_due():
+        return discover_layers(ds)
+
+    return None
+
+
+def cache_latest_values(ds, targeted=True):
+    """IF the datasource has both LAYER_POINTS and
+    DATA_CAN_HAVE_VALUE_LAYER_SCRIPT source, then we can get a
+    timeseries for each location in each of its layers and cache its
+    latest value. Then this information can be used for colouring,
+    thresholding, et cetera.
+
+    If targeted is True, only the existing DatasourceLayers whose
+    latest values are used are refreshed; finding all the layers is
+    left to refresh_layer_discovery(). Otherwise, all drawable layers
+    are walked (see drawable_layers())."""
+
+    if not has_cacheable_layers(ds):
+        return  # For now, we don't know what to do in this case
+
+    # Only actually do something if the script is due.
+    activation = ds.activation_for_cache_script()
+    if not activation:
+        return
+
+    # If the datasource's own schedule isn't due, only layers with
+    # their own refresh interval that are due are refreshed
+    schedule_due = (
+        activation != models.DatasourceModel.ACTIVATED_FOR_LAYERS)
+
+    cache_run = models.CacheRun.start(ds.datasource_model, targeted)
+    error = None
+    try:
+        _cache_layers(
+            ds, targeted, cache_run, schedule_due,
+            _LeaseRenewer(ds.datasource_model))
+    except Exception:
+        error = traceback.format_exc()
+        raise
+    finally:
+        cache_run.finish(error)
+        ds.release_cache_script()
+        logger.info(
+            "Cache run of %s: %d layers, %d locations processed, "
+            "%d updated in %.1f seconds%s", ds.identifier,
+            cache_run.layers_refreshed, cache_run.locations_processed,
+            cache_run.locations_updated, cache_run.duration_seconds(),
+            " (failed)" if error else "")
+
+
+@contextlib.contextmanager
+def _timed(report, attribute):
+    """Add the time spent in this context to the attribute (a number
+    of seconds) of report."""
+    started = time.time()
+    try:
+        yield
+    finally:
+        setattr(report, attribute,
+                getattr(report, attribute) + time.time() - started)
+
+
+def _cache_layers(ds, targeted, cache_run, schedule_due=True,
+                  renew_lease=None):
+    """Refresh the cached latest values of the layers of ds, and
+    record what was done for each in a CacheRunLayer of
+    cache_run. Schedule_due says whether the datasource's own schedule
+    is due, or only layers with their own refresh interval may
+    be. Renew_lease is called before each layer and after each
+    location. See cache_latest_values()."""
+    datasource_model = ds.datasource_model
+    if targeted:
+        layers = datasource_model.layers_with_latest_values_used()
+    else:
+        layers = drawable_layers(ds)
+
+    now = dates.utc_now()
+
+    for datasource_layer in layers:
         # If we don't actually use the latest values of this layer, we
         # should skip it.
-        if not datasource_layer.latest_values_used:
+        if not targeted and not datasource_layer.latest_values_used:
             continue
 
-        locations = drawable.locations()
+        # Layers with their own refresh interval may not be due, even
+        # if the datasource is, and the other way around.
+        if not datasource_layer.refresh_is_due(schedule_due, now):
+            continue
+
+        if renew_lease is not None:
+            renew_lease()
+
+        ds.set_choices_made(
+            datasource.ChoicesMade(json=datasource_layer.choices_made))
+        report = models.CacheRunLayer(
+            cache_run=cache_run, datasource_layer=datasource_layer,
+            started=dates.utc_now())
+        try:
+            _cache_layer(ds, datasource_layer, report, renew_lease)
+        except Exception:
+            report.error = traceback.format_exc()
+            raise
+        finally:
+            report.finished = dates.utc_now()
+            report.save()
+            logger.info(
+                "Layer %s: %d locations processed, %d fetched, %d updated, "
+                "%d empty; %.1fs backend, %.1fs database",
+                datasource_layer, report.locations_processed,
+                report.locations_fetched, report.locations_updated,
+                report.locations_empty, report.backend_seconds,
+                report.db_seconds)
+        datasource_layer.record_refresh(now)
+
+
+def _cache_layer(ds, datasource_layer, report=None, renew_lease=None):
+    """Cache the latest value of each location in the layer. The
+    choices made of ds must already be set to those of the layer.
+
+    The numbers of locations and the time spent are added to report,
+    an (unsaved) CacheRunLayer. If renew_lease is given, it is called
+    after each location (see _LeaseRenewer)."""
+    if report is None:
+        report = models.CacheRunLayer(datasource_layer=datasource_layer)
+
+    datasource_model = ds.datasource_model
+    keep_history = datasource_model.history_retention_days > 0
+
+    with _timed(report, 'db_seconds'):
+        cache_lines = dict(
+            (cache.locationid, cache) for cache in
+            models.DatasourceCache.objects.filter(
+                datasource_layer=datasource_layer))
+
+        if keep_history:
+            datasource_layer.purge_history(
+                dates.utc_now() - datetime.timedelta(
+                    days=datasource_model.history_retention_days))
+
+    now = dates.utc_now()
+    if datasource_layer.locations_due_for_refresh(now):
+        with _timed(report, 'backend_seconds'):
+            locations = list(ds.locations())
+        with _timed(report, 'db_seconds'):
+            datasource_layer.store_locations(locations, now)
+    else:
+        with _timed(report, 'db_seconds'):
+            locations = datasource_layer.catalogue()
+
+    pause = _pause_between_fetches(datasource_layer, len(locations))
+
+    # New cache lines are inserted in batches, existing ones are
+    # updated one by one (without the SELECT a plain save() does)
+    new_cache_lines = []
+    try:
         for location in locations:
-            try:
-                cache = models.DatasourceCache.objects.get(
-                    datasource_layer=datasource_layer,
-                    locationid=location.identifier)
-            except models.DatasourceCache.DoesNotExist:
-                cache = models.DatasourceCache(
-                    datasource_layer=datasource_layer,
-                    locationid=location.identifier)
-
-            if cache.timestamp:
-                start_datetime = cache.timestamp
-            else:
-                start_datetime = dates.utc_now() - datetime.timedelta(days=60)
+            _cache_location(
+                ds, datasource_layer, location, cache_lines,
+                new_cache_lines, report, pause)
+            if len(new_cache_lines) >= models.BULK_CREATE_BATCH_SIZE:
+                _insert_cache_lines(new_cache_lines, report)
+            if renew_lease is not None:
+                renew_lease()
+    finally:
+        _insert_cache_lines(new_cache_lines, report)
+
+
+def _pause_between_fetches(datasource_layer, number_of_locations):
+    """Seconds to pause after each fetch of the layer. A layer with its
+    own refresh interval pauses less if needed, so that the pauses
+    take at most half of that interval."""
+    pause = SECONDS_BETWEEN_FETCHES
+    if datasource_layer.script_refresh_minutes and number_of_locations:
+        pause = min(pause, datasource_layer.script_refresh_minutes * 30.0 /
+                    number_of_locations)
+    return pause
+
+
+def _insert_cache_lines(new_cache_lines, report):
+    """Insert the new DatasourceCache lines, and empty the list."""
+    with _timed(report, 'db_seconds'):
+        models.bulk_create_in_batches(models.DatasourceCache, new_cache_lines)
+    del new_cache_lines[:]
+
+
+def _cache_location(
+    ds, datasource_layer, location, cache_lines, new_cache_lines, report,
+    pause=0):
+    """Fetch the latest value of one location, if that is due, and
+    pause for that many seconds afterwards. See _cache_layer()."""
+    datasource_model = ds.datasource_model
+    minutes_between_checks = datasource_model.minutes_between_scripts
+    initial_lookback_days = datasource_model.script_initial_lookback_days
+    keep_history = datasource_model.history_retention_days > 0
+
+    now = dates.utc_now()
+    report.locations_processed += 1
+
+    cache = cache_lines.get(location.identifier)
+    if cache is None:
+        cache = models.DatasourceCache(
+            datasource_layer=datasource_layer,
+            locationid=location.identifier)
+    elif not cache.fetch_is_due(minutes_between_checks, now):
+        return
 
-            timeseries = drawable.timeseries(
+    fetch_start = cache.fetch_start(initial_lookback_days, now)
+    with _timed(report, 'backend_seconds'):
+        with timeseries_cache.disabled(), datasource.history_disabled():
+            timeseries = ds.timeseries(
                 location.identifier,
-                start_datetime=start_datetime,
-                end_datetime=dates.utc_now())
-            if timeseries is None or len(timeseries) == 0:
-                continue
+                start_datetime=fetch_start,
+                end_datetime=now)
+    report.locations_fetched += 1
 
-            latest = timeseries.latest()
+    if timeseries is None:
+        last_valid = None
+    else:
+        last_valid = timeseries.last_valid()
+
+    with _timed(report, 'db_seconds'):
+        if keep_history:
+            cache.append_history(timeseries, fetch_start)
+            if (timeseries is not None and
+                datasource_layer.history_series_name is None):
+                datasource_layer.history_series_name = timeseries.columns[0]
+                models.DatasourceLayer.objects.filter(
+                    pk=datasource_layer.pk).update(
+                    history_series_name=datasource_layer.history_series_name)
+
+        updated = cache.record_check(last_valid, now)
+        if cache.pk is None:
+            new_cache_lines.append(cache)
+        else:
+            cache.save(force_update=True)
+
+    if updated:
+        report.locations_updated += 1
+    else:
+        report.locations_empty += 1
+
+    if pause:
+        time.sleep(pause)
+
+
+def _cache_latest_values_worker(key, targeted):
+    """Run cache_latest_values() for the datasource identified by key,
+    an (originating_app, identifier) tuple. This runs in a worker
+    process, that can't be sent datasource objects."""
+    # A database connection inherited from the parent process can't
+    # be shared, so make sure this process opens its own.
+    connection.close()
+    try:
+        for ds in datasource.datasources_from_entrypoints():
+            if (ds.originating_app, ds.identifier) == key:
+                cache_latest_values(ds, targeted=targeted)
+                return
+        logger.warn("Datasource %s not found in worker.", key)
+    finally:
+        connection.close()
+
+
+def cache_latest_values_in_parallel(
+    datasources, workers, deadline=None, targeted=True):
+    """Run cache_latest_values() for each of the datasources that is
+    due, each in its own worker process, with at most `workers`
+    processes at the same time. If deadline (in seconds) is given,
+    workers still running after it has passed are killed, so that one
+    stuck backend doesn't hold up the next run. Killed workers can't
+    clean up after themselves, so their claims on datasources are
+    released here."""
+    keys = [
+        (ds.originating_app, ds.identifier) for ds in datasources
+        if has_cacheable_layers(ds) and
+        ds.datasource_model.cache_script_has_work()]
+    if not keys:
+        return
+
+    end_time = time.time() + deadline if deadline else None
+
+    # Children would inherit the connection otherwise
+    connection.close()
+    pool = multiprocessing.Pool(min(workers, len(keys)), maxtasksperchild=1)
+    results = []
+    try:
+        results = [
+            (key, pool.apply_async(
+                    _cache_latest_values_worker, (key, targeted)))
+            for key in keys]
+        pool.close()
+
+        for key, result in results:
+            if end_time is None:
+                result.wait()
+            else:
+                result.wait(max(end_time - time.time(), 0))
+
+            if not result.ready():
+                logger.error(
+                    "Deadline passed, stopping cache script for %s and "
+                    "the datasources after it.", key)
+                break
+
+            try:
+                result.get()
+            except Exception:
+                logger.exception("Cache script failed for %s", key)
+    finally:
+        # Only the workers that are still busy are alive now
+        owners = [
+            models.lease_owner(child.pid)
+            for child in multiprocessing.active_children()]
+        pool.terminate()
+        pool.join()
+        _release_killed_workers(
+            [key for key, result in results if not result.ready()], owners)
+
+
+def _release_killed_workers(keys, owners):
+    """Release the claims that the killed worker processes, with these
+    lease owners, had on the datasources of keys, and record that
+    their CacheRuns failed."""
+    if not keys or not owners:
+        return
+
+    for datasource_model in models.DatasourceModel.objects.filter(
+        script_lease_owner__in=owners):
+        key = (datasource_model.originating_app, datasource_model.identifier)
+        if key not in keys:
+            continue
 
-            cache.timestamp = latest.keys()[0]
-            cache.value = latest[0]
-            cache.save()
-            time.sleep(1)
+        logger.warn("Releasing %s, its worker was killed.", key)
+        owner = datasource_model.script_lease_owner
+        for cache_run in models.CacheRun.objects.filter(
+            datasource_model=datasource_model, owner=owner,
+            finished__isnull=True):
+            cache_run.finish("Stopped, the deadline had passed.")
+        datasource_model.release_cache_script(owner)
@@ -0,0 +1,192 @@
+"""A synthetic datasource of any size, for benchmarks and load tests.
+
+Its tree of choices has `levels` criteria (level_0, level_1, ...),
+each with `fanout` options; every combination of options is a
+drawable layer. Each layer has `locations_per_layer` locations spread
+over the Netherlands, and each location has an hourly timeseries of
+`series_length` values with daily and weekly cycles. Everything is
+deterministic, the same layer always has the same locations, and the
+same value at the same hour.
+
+Calls that would go to a backend in a real datasource (locations()
+and timeseries()) sleep `latency` seconds first, and are counted in
+SyntheticDataSource.backend_calls.
+
+Datasources are made from the LIZARD_DATASOURCE_SYNTHETIC setting, a
+list of dicts of keyword arguments for SyntheticDataSource (by default
+there are none), and from those passed to register(), which is what
+the benchmark does. Like other factories, factory() makes new
+instances each time it is called."""
+
+# Python 3 is coming to town
+from __future__ import print_function, unicode_literals
+from __future__ import absolute_import, division
+
+import datetime
+import time
+import zlib
+
+import numpy
+import pandas
+
+from django.conf import settings
+
+from lizard_datasource import criteria
+from lizard_datasource import datasource
+from lizard_datasource import dates
+from lizard_datasource import instrumentation
+from lizard_datasource import location
+from lizard_datasource import properties
+from lizard_datasource import timeseries
+
+# Roughly the bounding box of the Netherlands,
+# (minlon, minlat, maxlon, maxlat)
+BBOX = (3.4, 50.8, 7.2, 53.5)
+
+_registered = []
+
+
+def _seed(*parts):
+    """A deterministic seed for numpy's random generator."""
+    return zlib.crc32(
+        '|'.join(unicode(part) for part in parts).encode('utf8')
+        ) & 0xffffffff
+
+
+class SyntheticDataSource(datasource.DataSource):
+    PROPERTIES = (
+        properties.LAYER_POINTS,
+        properties.DATA_CAN_HAVE_VALUE_LAYER_SCRIPT
+        )
+
+    # Calls to the pretend backend, by all instances
+    backend_calls = 0
+
+    def __init__(self, levels=2, fanout=3, locations_per_layer=100,
+                 series_length=24 * 7, latency=0.0, identifier=None):
+        self.levels = levels
+        self.fanout = fanout
+        self.locations_per_layer = locations_per_layer
+        self.series_length = series_length
+        self.latency = latency
+        self._identifier = identifier or 'synthetic_{0}x{1}'.format(
+            levels, fanout)
+
+    @property
+    def identifier(self):
+        return self._identifier
+
+    @property
+    def description(self):
+        return "Synthetic data source ({0} levels of {1} options)".format(
+            self.levels, self.fanout)
+
+    def criteria(self):
+        return tuple(
+            criteria.Criterion(
+                identifier='level_{0}'.format(level),
+                description='Level {0}'.format(level),
+                datatype=criteria.Criterion.TYPE_SELECT,
+                prerequisites=(
+                    ('level_{0}'.format(level - 1),) if level else ()))
+            for level in range(self.levels))
+
+    def options_for_criterion(self, criterion):
+        if not criterion.identifier.startswith('level_'):
+            return criteria.EmptyOptions()
+
+        return criteria.OptionList(
+            criteria.Option(
+                '{0}_{1}'.format(criterion.identifier, option),
+                'Option {0}'.format(option))
+            for option in range(self.fanout))
+
+    def is_drawable(self, choices_made=None):
+        if choices_made is None:
+            choices_made = self._choices_made
+
+        return all(
+            'level_{0}'.format(level) in choices_made
+            for level in range(self.levels))
+
+    def _layer_name(self):
+        return '-'.join(
+            self._choices_made['level_{0}'.format(level)]
+            for level in range(self.levels))
+
+    def _backend_call(self):
+        SyntheticDataSource.backend_calls += 1
+        instrumentation.count_backend_call()
+        if self.latency:
+            time.sleep(self.latency)
+
+    def locations(self, bare=False):
+        # Bare is passed by AugmentedDataSource; these locations are
+        # always bare
+        if not self.is_drawable():
+            raise ValueError(
+                "Datasource locations() called when it wasn't drawable")
+        self._backend_call()
+
+        # Each layer has the same locations; ask a real datasource for
+        # two layers and you often get the same stations too.
+        random = numpy.random.RandomState(_seed(self.identifier))
+        minlon, minlat, maxlon, maxlat = BBOX
+        identifiers = [
+            'loc_{0}'.format(i) for i in range(self.locations_per_layer)]
+
+        return location.LocationSet(
+            identifiers=identifiers,
+            latitudes=random.uniform(
+                minlat, maxlat, self.locations_per_layer),
+            longitudes=random.uniform(
+                minlon, maxlon, self.locations_per_layer),
+            name=['Location {0}'.format(i)
+                  for i in range(self.locations_per_layer)])
+
+    def timeseries(self, location_id, start_datetime=None, end_datetime=None,
+                   max_points=None):
+        self._backend_call()
+
+        # Hourly values, up to the last whole hour before end_datetime
+        if end_datetime is None:
+            end_datetime = dates.utc_now()
+        last = dates.floor_to_bucket(end_datetime, 60)
+        times = pandas.DatetimeIndex([
+                last - datetime.timedelta(hours=hours)
+                for hours in range(self.series_length - 1, -1, -1)])
+
+        # Daily and weekly cycles with a phase per location, so the
+        # value at each hour is the same on every call
+        random = numpy.random.RandomState(
+            _seed(self.identifier, self._layer_name(), location_id))
+        daily_phase, weekly_phase = random.uniform(0, 2 * numpy.pi, 2)
+        hours = times.asi8 / (3600 * 10 ** 9)
+        values = (10 +
+                  2 * numpy.sin(2 * numpy.pi * hours / 24 + daily_phase) +
+                  numpy.sin(2 * numpy.pi * hours / (24 * 7) + weekly_phase))
+
+        series_name = '{0}||m'.format(self._layer_name())
+        result = timeseries.Timeseries(pandas.DataFrame(
+                {series_name: values}, index=times))
+        return result.window(start_datetime, end_datetime).downsample(
+            max_points)
+
+
+def register(options):
+    """Make factory() also return a SyntheticDataSource made with
+    options, a dict of keyword arguments, until it is unregistered."""
+    _registered.append(options)
+
+
+def unregister(options):
+    if options in _registered:
+        _registered.remove(options)
+
+
+def factory():
+    return [
+        SyntheticDataSource(**options)
+        for options in (
+            list(getattr(settings, 'LIZARD_DATASOURCE_SYNTHETIC', ())) +
+            _registered)]
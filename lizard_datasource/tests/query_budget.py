@@ -0,0 +1,41 @@
+"""Helpers for tests that put an upper bound on the number of database
+queries code does."""
+
+import contextlib
+
+from django.db import connection
+
+
+class QueryBudgetMixin(object):
+    """Mixin for TestCases. Queries are counted on the default
+    database, using Django's debug cursor."""
+
+    @contextlib.contextmanager
+    def assertMaxQueries(self, budget):
+        """Fail if the code inside this context does more than budget
+        queries. The message lists the queries that were done."""
+        use_debug_cursor = connection.use_debug_cursor
+        connection.use_debug_cursor = True
+        start = len(connection.queries)
+        try:
+            yield
+            queries = connection.queries[start:]
+        finally:
+            connection.use_debug_cursor = use_debug_cursor
+
+        if len(queries) > budget:
+            self.fail("{0} queries done, at most {1} expected:\n{2}".format(
+                    len(queries), budget,
+                    "\n".join(query['sql'] for query in queries)))
+
+    def count_queries(self, function, *args, **kwargs):
+        """Call function and return the number of queries it did.
+        Generators must be consumed by function itself."""
+        use_debug_cursor = connection.use_debug_cursor
+        connection.use_debug_cursor = True
+        start = len(connection.queries)
+        try:
+            function(*args, **kwargs)
+            return len(connection.queries) - start
+        finally:
+            connection.use_debug_cursor = use_debug_cursor
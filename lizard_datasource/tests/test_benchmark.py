@@ -0,0 +1,29 @@
+import mock
+
+from django.test import TestCase
+
+from lizard_datasource import augmented_datasource
+from lizard_datasource import benchmark
+from lizard_datasource import synthetic_datasource
+
+
+class TestBenchmark(TestCase):
+    def test_needs_two_options(self):
+        self.assertRaises(ValueError, benchmark.Benchmark, fanout=1)
+
+    def test_run_has_result_per_scenario(self):
+        bench = benchmark.Benchmark(
+            levels=1, fanout=2, locations=5, series_length=24, repeat=1)
+        with mock.patch(
+            'lizard_datasource.datasource.datasources_from_entrypoints',
+            side_effect=lambda: (
+                synthetic_datasource.factory() +
+                augmented_datasource.factory())):
+            results = bench.run()
+
+        self.assertEquals(
+            set(results['scenarios']),
+            set(scenario.name for scenario in bench.scenarios()))
+        coloring = results['scenarios']['locations_coloring']
+        self.assertEquals(coloring['backend_calls'], 1)
+        self.assertTrue(coloring['queries'] > 0)
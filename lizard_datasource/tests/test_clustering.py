@@ -0,0 +1,57 @@
+"""Tests for lizard_datasource.clustering"""
+
+import mock
+
+from django.test import TestCase
+
+from lizard_datasource import clustering
+from lizard_datasource import datasource
+from lizard_datasource import location
+
+
+class TestClusterLocations(TestCase):
+    def setUp(self):
+        self.locations = [
+            location.Location('a', 52.0, 4.0, color='ff0000'),
+            location.Location('b', 52.01, 4.01, color='ff0000'),
+            location.Location('c', 52.02, 4.02, color='00ff00'),
+            location.Location('d', 10.0, 100.0, name='far away')]
+
+    def test_close_locations_form_a_cluster(self):
+        clusters = clustering.cluster_locations(self.locations, 5)
+        self.assertEquals(len(clusters), 2)
+
+        cluster = [c for c in clusters if c.extra_args()['cluster']][0]
+        self.assertEquals(cluster.extra_args()['count'], 3)
+        self.assertAlmostEquals(cluster.latitude, 52.01)
+        self.assertEquals(cluster.color, 'ff0000')
+
+    def test_single_locations_stay_as_they_are(self):
+        clusters = clustering.cluster_locations(self.locations, 5)
+        single = [c for c in clusters if c.identifier == 'd'][0]
+        self.assertEquals(single.description(), 'far away')
+
+    def test_nothing_clustered_when_zoomed_in(self):
+        clusters = clustering.cluster_locations(self.locations, 14)
+        self.assertEquals(len(clusters), 4)
+
+    def test_cell_size_halves_per_zoom_level(self):
+        self.assertEquals(
+            clustering.cell_size_degrees(3),
+            2 * clustering.cell_size_degrees(4))
+
+
+class TestClusteredLocations(TestCase):
+    def setUp(self):
+        clustering._cluster_cache.clear()
+
+    def test_clusters_are_cached_per_layer_and_zoom(self):
+        ds = datasource.DataSource()
+        ds.set_choices_made(datasource.ChoicesMade(dict={}))
+        ds.locations = mock.MagicMock(return_value=[
+                location.Location('a', 52.0, 4.0)])
+
+        ds.clustered_locations(5)
+        ds.clustered_locations(5, bbox=(3, 51, 5, 53))
+        # Not bare, the clusters need the colors
+        ds.locations.assert_called_once_with(bare=False)
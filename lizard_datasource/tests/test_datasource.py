@@ -5,6 +5,7 @@ from unittest import TestCase
 from lizard_datasource import datasource
 from lizard_datasource import dummy_datasource
 from lizard_datasource import criteria
+from lizard_datasource import location
 
 
 class TestChoicesMade(TestCase):
@@ -26,6 +27,13 @@ class TestChoicesMade(TestCase):
         cm = datasource.ChoicesMade(test="value", json="whee")
         self.assertTrue('json' in cm)
 
+    def test_equal_choices_are_equal_and_hash_the_same(self):
+        cm1 = datasource.ChoicesMade(json="""{"test": "value"}""")
+        cm2 = datasource.ChoicesMade(test="value")
+        self.assertEquals(cm1, cm2)
+        self.assertEquals(hash(cm1), hash(cm2))
+        self.assertNotEquals(cm1, datasource.ChoicesMade())
+
     def test_getitem(self):
         cm = datasource.ChoicesMade(test="value")
         self.assertEquals(cm['test'], 'value')
@@ -246,6 +254,24 @@ class TestCombinedDatasource(TestCase):
         cds = datasource.CombinedDataSource([ds1, ds2])
         self.assertTrue(cds.has_property("TESTING"))
 
+    def test_locations_passes_bbox_on(self):
+        ds1 = dummy_datasource.DummyDataSource()
+        ds1.locations = mock.MagicMock(return_value=[])
+        cds = datasource.CombinedDataSource([ds1])
+        list(cds.locations(bbox=(0, 0, 1, 1)))
+        ds1.locations.assert_called_with(bbox=(0, 0, 1, 1), max_points=None)
+
+
+class TestLocationsFiltering(TestCase):
+    def test_locations_are_filtered_for_datasource(self):
+        class PointsDataSource(datasource.DataSource):
+            def locations(self, bare=True):
+                return [location.Location('a', 52.0, 4.0),
+                        location.Location('b', 53.0, 5.0)]
+
+        locations = PointsDataSource().locations(bbox=(4.5, 52.5, 5.5, 53.5))
+        self.assertEquals([l.identifier for l in locations], ['b'])
+
 
 class TestDatasourceEntrypointsFunction(TestCase):
     def test_returns_tuple(self):
@@ -44,3 +44,38 @@ class TestUtcNow(TestCase):
     def test_returns_utc(self):
         now = dates.utc_now()
         self.assertEquals(now.tzinfo, pytz.UTC)
+
+
+class TestSchedule(TestCase):
+    def test_scheduled_time_before(self):
+        self.assertEquals(
+            dates.scheduled_time_before(dates.utc(2013, 1, 1, 1, 10, 30), 60),
+            dates.utc(2013, 1, 1, 1, 0))
+
+    def test_scheduled_time_after(self):
+        self.assertEquals(
+            dates.scheduled_time_after(dates.utc(2013, 1, 1, 1, 10), 60),
+            dates.utc(2013, 1, 1, 2, 0))
+
+    def test_schedule_starts_over_at_midnight(self):
+        # Every 7 hours: 0:00, 7:00, 14:00 and 21:00, then 0:00 again
+        self.assertEquals(
+            dates.scheduled_time_after(dates.utc(2013, 1, 1, 22, 0), 7 * 60),
+            dates.utc(2013, 1, 2, 0, 0))
+
+
+class TestBuckets(TestCase):
+    def test_floor_to_bucket(self):
+        self.assertEquals(
+            dates.floor_to_bucket(dates.utc(2013, 1, 1, 1, 10, 30), 15),
+            dates.utc(2013, 1, 1, 1, 0))
+
+    def test_ceil_to_bucket(self):
+        self.assertEquals(
+            dates.ceil_to_bucket(dates.utc(2013, 1, 1, 1, 10, 30), 15),
+            dates.utc(2013, 1, 1, 1, 15))
+
+    def test_boundary_stays_the_same(self):
+        boundary = dates.utc(2013, 1, 1, 1, 15)
+        self.assertEquals(dates.ceil_to_bucket(boundary, 15), boundary)
+        self.assertEquals(dates.floor_to_bucket(boundary, 15), boundary)
@@ -0,0 +1,93 @@
+"""Tests for lizard_datasource.encoders"""
+
+import math
+
+from django.test import TestCase
+from django.utils import simplejson
+
+from lizard_datasource import dates
+from lizard_datasource import encoders
+from lizard_datasource import location
+from lizard_datasource import timeseries
+
+
+class TestTimeseriesEncoders(TestCase):
+    def setUp(self):
+        self.date1 = dates.utc(2012, 12, 6, 17, 0)
+        self.date2 = dates.utc(2012, 12, 6, 18, 0)
+        # 2012-12-06 17:00 UTC in milliseconds since the epoch
+        self.ms1 = 1354813200000
+        self.ts = timeseries.Timeseries([
+                {self.date1: 1.0, self.date2: 2.0},
+                {self.date1: 3.0}])
+
+    def test_rows_have_milliseconds_and_all_columns(self):
+        rows = encoders.timeseries_rows(self.ts)
+        self.assertEquals(rows[0], [self.ms1, 1.0, 3.0])
+
+    def test_missing_values_are_none(self):
+        rows = encoders.timeseries_rows(self.ts)
+        self.assertEquals(rows[1], [self.ms1 + 3600000, 2.0, None])
+
+    def test_empty_timeseries_gives_no_rows(self):
+        self.assertEquals(encoders.timeseries_rows(None), [])
+
+    def test_json_has_columns_and_data(self):
+        decoded = simplejson.loads(encoders.timeseries_to_json(self.ts))
+        self.assertEquals(decoded['columns'], ['data_0', 'data_1'])
+        self.assertEquals(len(decoded['data']), 2)
+
+    def test_binary_roundtrip(self):
+        frame = encoders.timeseries_to_binary(self.ts)
+        dataframe = encoders.timeseries_from_binary(
+            frame, columns=self.ts.columns)
+        self.assertEquals(dataframe['data_0'][self.date2], 2.0)
+        self.assertTrue(math.isnan(dataframe['data_1'][self.date2]))
+
+    def test_binary_frame_size(self):
+        frame = encoders.timeseries_to_binary(self.ts)
+        # Header, 2 timestamps, 2 columns of 2 values
+        self.assertEquals(
+            len(frame), encoders.BINARY_HEADER.size + 2 * 8 + 4 * 8)
+
+    def test_binary_rejects_garbage(self):
+        self.assertRaises(
+            ValueError, encoders.timeseries_from_binary, b'x' * 20)
+
+
+class TestGeojsonEncoder(TestCase):
+    def setUp(self):
+        self.locations = location.LocationSet(
+            ['a', 'b', 'c'], [52.0, 53.0, 54.0], [4.0, 5.0, 6.0],
+            colors=['ff0000', None, None])
+
+    def test_chunks_join_to_feature_collection(self):
+        decoded = simplejson.loads(''.join(
+                encoders.locations_to_geojson(self.locations, chunk_size=2)))
+        self.assertEquals(decoded['type'], 'FeatureCollection')
+        self.assertEquals(
+            [feature['id'] for feature in decoded['features']],
+            ['a', 'b', 'c'])
+
+    def test_feature_has_lon_lat_coordinates_and_color(self):
+        feature = encoders.location_feature(self.locations[0])
+        self.assertEquals(feature['geometry']['coordinates'], [4.0, 52.0])
+        self.assertEquals(feature['properties'], {'color': 'ff0000'})
+
+    def test_locations_are_consumed_lazily(self):
+        consumed = []
+
+        def locations():
+            for loc in self.locations:
+                consumed.append(loc.identifier)
+                yield loc
+
+        chunks = encoders.locations_to_geojson(locations(), chunk_size=1)
+        next(chunks)  # The header
+        next(chunks)
+        self.assertEquals(consumed, ['a'])
+
+    def test_no_locations(self):
+        decoded = simplejson.loads(''.join(
+                encoders.locations_to_geojson([])))
+        self.assertEquals(decoded['features'], [])
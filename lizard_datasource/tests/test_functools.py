@@ -1,5 +1,7 @@
 """Tests for lizard_datasource.functools"""
 
+import threading
+
 from django.test import TestCase
 
 from lizard_datasource import functools
@@ -24,3 +26,61 @@ class TestMemoized(TestCase):
         o1 = helper(1)
         o2 = helper(2)
         self.assertFalse(o1 is o2)
+
+    def test_keyword_order_doesnt_matter(self):
+        @functools.memoize
+        def helper(a, b):
+            return object()
+
+        self.assertTrue(helper(a=1, b=2) is helper(b=2, a=1))
+
+    def test_maxsize_evicts_least_recently_used(self):
+        @functools.memoize(maxsize=2)
+        def helper(arg):
+            return object()
+
+        o1 = helper(1)
+        helper(2)
+        helper(1)
+        helper(3)
+        self.assertTrue(helper(1) is o1)
+        self.assertEquals(helper.cache_info().currsize, 2)
+
+    def test_cache_info_counts_hits_and_misses(self):
+        @functools.memoize
+        def helper(arg):
+            return object()
+
+        helper(1)
+        helper(1)
+        helper(2)
+        info = helper.cache_info()
+        self.assertEquals((info.hits, info.misses), (1, 2))
+
+    def test_cache_clear_forgets_results(self):
+        @functools.memoize
+        def helper(arg):
+            return object()
+
+        o1 = helper(1)
+        helper.cache_clear()
+        self.assertFalse(helper(1) is o1)
+
+    def test_concurrent_calls_compute_once(self):
+        calls = []
+        started = threading.Event()
+
+        @functools.memoize
+        def helper(arg):
+            calls.append(arg)
+            started.wait(1)
+            return arg
+
+        threads = [
+            threading.Thread(target=helper, args=(1,)) for i in range(5)]
+        for thread in threads:
+            thread.start()
+        started.set()
+        for thread in threads:
+            thread.join()
+        self.assertEquals(calls, [1])
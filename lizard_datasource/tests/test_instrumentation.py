@@ -0,0 +1,106 @@
+"""Tests for lizard_datasource.instrumentation"""
+
+import mock
+
+from django.db import connection
+from django.test import TestCase
+
+from lizard_datasource import datasource
+from lizard_datasource import instrumentation
+from lizard_datasource import location
+
+
+class BackendDataSource(datasource.DataSource):
+    identifier = 'backend'
+
+    def timeseries(self, location_id, start_datetime=None, end_datetime=None,
+                   max_points=None):
+        instrumentation.count_backend_call()
+        return None
+
+    def locations(self):
+        for i in range(3):
+            instrumentation.count_backend_call()
+            yield location.Location('loc_{0}'.format(i), 52.0, 5.0)
+
+
+class SubclassedDataSource(BackendDataSource):
+    def timeseries(self, *args, **kwargs):
+        return super(SubclassedDataSource, self).timeseries(*args, **kwargs)
+
+
+def calls_of(recorder, method):
+    return [call for call in recorder.as_list() if call['method'] == method]
+
+
+class TestInstrumentation(TestCase):
+    def setUp(self):
+        instrumentation.reset_stats()
+
+    def test_nothing_recorded_outside_context(self):
+        BackendDataSource().timeseries('loc_0')
+        self.assertEquals(instrumentation.stats()['calls'], [])
+
+    def test_records_calls_and_backend_calls(self):
+        ds = BackendDataSource()
+        with instrumentation.instrument() as recorder:
+            ds.timeseries('loc_0')
+            ds.timeseries('loc_1')
+
+        call, = calls_of(recorder, 'timeseries')
+        self.assertEquals(call['datasource'], 'backend')
+        self.assertEquals(call['calls'], 2)
+        self.assertEquals(call['backend_calls'], 2)
+
+    def test_generators_are_measured_while_used(self):
+        ds = BackendDataSource()
+        with instrumentation.instrument() as recorder:
+            locations = ds.locations()
+            self.assertEquals(calls_of(recorder, 'locations'), [])
+            list(locations)
+
+        call, = calls_of(recorder, 'locations')
+        self.assertEquals(call['backend_calls'], 3)
+
+    def test_super_call_is_counted_once(self):
+        with instrumentation.instrument() as recorder:
+            SubclassedDataSource().timeseries('loc_0')
+        self.assertEquals(calls_of(recorder, 'timeseries')[0]['calls'], 1)
+
+    def test_nested_contexts_share_recorder(self):
+        with instrumentation.instrument() as outer:
+            with instrumentation.instrument() as inner:
+                self.assertTrue(inner is outer)
+
+    def test_stats_add_up_contexts(self):
+        ds = BackendDataSource()
+        for i in range(2):
+            with instrumentation.instrument():
+                ds.timeseries('loc_0')
+
+        stats = instrumentation.stats()
+        self.assertEquals(stats['contexts'], 2)
+        self.assertEquals(stats['calls'][0]['calls'], 2)
+
+    def test_debug_cursor_is_restored(self):
+        use_debug_cursor = connection.use_debug_cursor
+        with instrumentation.instrument():
+            self.assertTrue(connection.use_debug_cursor)
+        self.assertEquals(connection.use_debug_cursor, use_debug_cursor)
+
+
+class TestInstrumentationMiddleware(TestCase):
+    def test_logs_line_per_request(self):
+        middleware = instrumentation.InstrumentationMiddleware()
+        request = mock.MagicMock()
+        response = object()
+
+        with mock.patch.object(instrumentation.logger, 'info') as info:
+            middleware.process_request(request)
+            BackendDataSource().timeseries('loc_0')
+            self.assertTrue(
+                middleware.process_response(request, response) is response)
+
+        self.assertTrue(info.called)
+        self.assertTrue('backend.timeseries 1x' in info.call_args[0][-1])
+        self.assertTrue(instrumentation._current_recorder() is None)
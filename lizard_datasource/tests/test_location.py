@@ -47,3 +47,89 @@ class TestLocation(TestCase):
         l = location.Location(
             'identifier', 0.0, 1.0)
         self.assertEquals(unicode(l), repr(l))
+
+    def test_location_has_no_dict(self):
+        l = location.Location('identifier', 0.0, 1.0)
+        self.assertFalse(hasattr(l, '__dict__'))
+
+
+class TestLocationSet(TestCase):
+    def setUp(self):
+        self.location_set = location.LocationSet(
+            ['a', 'b'], [52.0, 53.0], [4.0, 5.0], name=['A', 'B'])
+
+    def test_iterating_yields_locations(self):
+        locations = list(self.location_set)
+        self.assertEquals(len(locations), 2)
+        self.assertEquals(locations[1].identifier, 'b')
+        self.assertEquals(locations[1].latitude, 53.0)
+        self.assertEquals(locations[1].description(), 'B')
+
+    def test_setting_color_of_view_changes_set(self):
+        self.location_set[0].color = 'ff0000'
+        self.assertEquals(self.location_set.colors, ['ff0000', None])
+
+    def test_to_dict_of_view(self):
+        self.assertEquals(self.location_set[0].to_dict(), {
+                'identifier': 'a', 'latitude': 52.0, 'longitude': 4.0,
+                'name': 'A'})
+
+    def test_from_locations(self):
+        location_set = location.LocationSet.from_locations([
+                location.Location('a', 0.0, 1.0, name='A'),
+                location.Location('b', 2.0, 3.0, color='ffffff')])
+        self.assertEquals(location_set.extras['name'], ['A', None])
+        self.assertEquals(location_set.colors, [None, 'ffffff'])
+
+    def test_projected_transforms_once(self):
+        calls = []
+
+        def transform(latitudes, longitudes):
+            calls.append(len(latitudes))
+            return longitudes * 2, latitudes * 2
+
+        xs, ys = self.location_set.projected(transform)
+        self.location_set.projected(transform)
+        self.assertEquals(list(xs), [8.0, 10.0])
+        self.assertEquals(calls, [2])
+
+    def test_take(self):
+        taken = self.location_set.take([1])
+        self.assertEquals(len(taken), 1)
+        self.assertEquals(taken[0].identifier, 'b')
+        self.assertEquals(taken.extras['name'], ['B'])
+
+
+class TestFiltering(TestCase):
+    def setUp(self):
+        # A 10 x 10 grid of points, 0.1 degrees apart
+        self.location_set = location.LocationSet(
+            ['{0}_{1}'.format(x, y) for x in range(10) for y in range(10)],
+            [52.0 + y / 10.0 for x in range(10) for y in range(10)],
+            [4.0 + x / 10.0 for x in range(10) for y in range(10)])
+
+    def test_grid_index_query(self):
+        index = location.GridIndex(
+            self.location_set.longitudes, self.location_set.latitudes, 0.25)
+        positions = index.query((4.0, 52.0, 4.15, 52.15))
+        self.assertEquals(list(positions), [0, 1, 10, 11])
+
+    def test_within_bbox(self):
+        within = self.location_set.within((4.45, 52.45, 4.65, 52.55))
+        self.assertEquals(within.identifiers, ['5_5', '6_5'])
+
+    def test_thinned_has_at_most_max_points(self):
+        thinned = self.location_set.thinned(10)
+        self.assertTrue(0 < len(thinned) <= 10)
+
+    def test_filter_locations_accepts_lists(self):
+        filtered = location.filter_locations(
+            [location.Location('a', 52.0, 4.0),
+             location.Location('b', 53.0, 5.0)],
+            bbox=(3.0, 51.0, 4.5, 52.5))
+        self.assertEquals(filtered.identifiers, ['a'])
+
+    def test_filter_locations_without_arguments_does_nothing(self):
+        self.assertTrue(
+            location.filter_locations(self.location_set) is
+            self.location_set)
@@ -4,7 +4,9 @@ import mock
 
 from django.test import TestCase
 from lizard_datasource import dates
+from lizard_datasource import location
 from lizard_datasource import models
+from lizard_datasource import timeseries
 
 
 ## Factories, keep them in the same order as in models.py
@@ -28,6 +30,13 @@ class DatasourceLayerF(factory.Factory):
     datasource_model = factory.SubFactory(DatasourceModelF)
 
 
+class DatasourceCacheF(factory.Factory):
+    FACTORY_FOR = models.DatasourceCache
+
+    datasource_layer = factory.SubFactory(DatasourceLayerF)
+    locationid = "some_location"
+
+
 class AugmentedDataSourceF(factory.Factory):
     FACTORY_FOR = models.AugmentedDataSource
 
@@ -118,11 +127,370 @@ class TestDatasourceModel(TestCase):
                     script_last_run_started=dtlast,
                     script_run_next_opportunity=False).cache_script_is_due())
 
+    def test_cache_script_next_due_is_next_slot(self):
+        dtnow = dates.utc(2013, 1, 1, 1, 10)
+        with mock.patch('lizard_datasource.dates.utc_now', return_value=dtnow):
+            dsm = DatasourceModelF.build(
+                script_last_run_started=dates.utc(2013, 1, 1, 1, 5))
+            self.assertEquals(
+                dsm.cache_script_next_due(), dates.utc(2013, 1, 1, 2, 0))
+
+    def test_cache_script_next_due_waits_for_lease(self):
+        dtnow = dates.utc(2013, 1, 1, 1, 10)
+        expires = dates.utc(2013, 1, 1, 1, 30)
+        with mock.patch('lizard_datasource.dates.utc_now', return_value=dtnow):
+            dsm = DatasourceModelF.build(
+                script_run_next_opportunity=True,
+                script_lease_expires=expires)
+            self.assertEquals(dsm.cache_script_next_due(), expires)
+
+    def test_activation_claims_datasource(self):
+        dsm = DatasourceModelF.create()
+        self.assertTrue(dsm.activation_for_cache_script())
+        self.assertTrue(dsm.script_lease_owner)
+        # Another run that read the model before the claim can't claim
+        other = models.DatasourceModel.objects.get(pk=dsm.pk)
+        other.script_run_next_opportunity = True
+        models.DatasourceModel.objects.filter(pk=dsm.pk).update(
+            script_run_next_opportunity=True)
+        self.assertFalse(other.activation_for_cache_script())
+
+    def test_released_datasource_can_be_claimed_again(self):
+        dsm = DatasourceModelF.create()
+        self.assertTrue(dsm.activation_for_cache_script())
+        dsm.release_cache_script()
+        models.DatasourceModel.objects.filter(pk=dsm.pk).update(
+            script_run_next_opportunity=True)
+        self.assertTrue(dsm.activation_for_cache_script())
+
+    def test_expired_lease_can_be_claimed(self):
+        dsm = DatasourceModelF.create(
+            script_run_next_opportunity=True,
+            script_lease_owner="crashed",
+            script_lease_expires=dates.utc_now() - datetime.timedelta(
+                minutes=1))
+        self.assertTrue(dsm.activation_for_cache_script())
+
+    def test_activation_says_why(self):
+        dsm = DatasourceModelF.create()
+        self.assertEquals(
+            dsm.activation_for_cache_script(),
+            models.DatasourceModel.ACTIVATED_ON_SCHEDULE)
+        dsm.release_cache_script()
+
+        # The schedule isn't due anymore, but this layer is
+        DatasourceLayerF.create(
+            datasource_model=dsm, cache_latest_values=True,
+            script_refresh_minutes=5)
+        self.assertEquals(
+            dsm.activation_for_cache_script(),
+            models.DatasourceModel.ACTIVATED_FOR_LAYERS)
+
+    def test_lease_length_is_a_setting(self):
+        with self.settings(LIZARD_DATASOURCE_CACHE_SCRIPT_LEASE_MINUTES=5):
+            self.assertEquals(
+                DatasourceModelF.build().cache_script_lease(),
+                datetime.timedelta(minutes=5))
+
+    def test_renewal_extends_lease(self):
+        dsm = DatasourceModelF.create()
+        self.assertTrue(dsm.activation_for_cache_script())
+        expires = dsm.script_lease_expires
+        later = dates.utc_now() + datetime.timedelta(minutes=10)
+        with mock.patch('lizard_datasource.dates.utc_now', return_value=later):
+            self.assertTrue(dsm.renew_cache_script_lease())
+        self.assertTrue(models.DatasourceModel.objects.get(
+                pk=dsm.pk).script_lease_expires > expires)
+
+    def test_renewal_fails_if_claimed_by_another_run(self):
+        dsm = DatasourceModelF.create()
+        self.assertTrue(dsm.activation_for_cache_script())
+        models.DatasourceModel.objects.filter(pk=dsm.pk).update(
+            script_lease_owner="other")
+        self.assertFalse(dsm.renew_cache_script_lease())
+
+    def test_release_for_other_owner(self):
+        dsm = DatasourceModelF.create(
+            script_lease_owner=models.lease_owner(12345),
+            script_lease_expires=dates.utc_now())
+        dsm.release_cache_script(models.lease_owner(12345))
+        self.assertEquals(models.DatasourceModel.objects.get(
+                pk=dsm.pk).script_lease_owner, None)
+
+    def test_layer_discovery_is_due_if_never_done(self):
+        self.assertTrue(DatasourceModelF.build().layer_discovery_is_due())
+
+    def test_layer_discovery_not_due_within_interval(self):
+        dsm = DatasourceModelF.build(
+            layers_discovered_at=dates.utc_now() - datetime.timedelta(
+                hours=1),
+            rediscovery_interval_hours=24)
+        self.assertFalse(dsm.layer_discovery_is_due())
+
+    def test_discovered_layers_are_those_of_last_discovery(self):
+        dsm = DatasourceModelF.create()
+        old = DatasourceLayerF.create(datasource_model=dsm, choices_made="1")
+        new = DatasourceLayerF.create(datasource_model=dsm, choices_made="2")
+        earlier = dates.utc_now() - datetime.timedelta(days=2)
+        dsm.record_layer_discovery([old], earlier)
+        dsm.record_layer_discovery([new], dates.utc_now())
+        self.assertEquals(list(dsm.discovered_layers()), [new])
+
 
 class TestDatasourceLayer(TestCase):
     def test_has_unicode(self):
         self.assertTrue(unicode(DatasourceLayerF.build()))
 
+    def test_layer_without_interval_follows_datasource(self):
+        layer = DatasourceLayerF.build()
+        self.assertTrue(layer.refresh_is_due(True))
+        self.assertFalse(layer.refresh_is_due(False))
+
+    def test_layer_with_interval_uses_own_schedule(self):
+        now = dates.utc(2013, 1, 1, 1, 10)
+        layer = DatasourceLayerF.build(
+            script_refresh_minutes=5,
+            script_last_refreshed=dates.utc(2013, 1, 1, 1, 6))
+        self.assertTrue(layer.refresh_is_due(False, now))
+        layer.script_last_refreshed = dates.utc(2013, 1, 1, 1, 10)
+        self.assertFalse(layer.refresh_is_due(True, now))
+        self.assertEquals(
+            layer.refresh_next_due(now), dates.utc(2013, 1, 1, 1, 15))
+
+    def test_datasource_has_work_if_layer_due(self):
+        dsm = DatasourceModelF.create(
+            script_last_run_started=dates.utc_now())
+        self.assertFalse(dsm.cache_script_has_work())
+        DatasourceLayerF.create(
+            datasource_model=dsm, cache_latest_values=True,
+            script_refresh_minutes=5)
+        self.assertTrue(dsm.cache_script_has_work())
+
+    def test_latest_values_used_if_turned_on(self):
+        layer = DatasourceLayerF.create(cache_latest_values=True)
+        self.assertTrue(layer.latest_values_used)
+
+    def test_layers_with_latest_values_used(self):
+        dsm = DatasourceModelF.create()
+        used = DatasourceLayerF.create(
+            datasource_model=dsm, choices_made="1", cache_latest_values=True)
+        DatasourceLayerF.create(datasource_model=dsm, choices_made="2")
+        self.assertEquals(
+            list(dsm.layers_with_latest_values_used()), [used])
+
+
+class TestLocationCatalogue(TestCase):
+    def setUp(self):
+        self.layer = DatasourceLayerF.create()
+        self.now = dates.utc(2013, 6, 10, 12, 0)
+        self.locations = [
+            location.Location('a', 52.0, 5.0, name='A'),
+            location.Location('b', 53.0, 6.0)]
+
+    def test_never_stored_has_no_catalogue(self):
+        self.assertEquals(self.layer.catalogue(), None)
+        self.assertTrue(self.layer.locations_due_for_refresh(self.now))
+
+    def test_stored_locations_are_in_catalogue(self):
+        self.assertTrue(self.layer.store_locations(self.locations, self.now))
+        catalogue = self.layer.catalogue()
+        self.assertEquals(catalogue.identifiers, ['a', 'b'])
+        self.assertEquals(catalogue[0].description(), 'A')
+
+    def test_same_locations_dont_change(self):
+        self.layer.store_locations(self.locations, self.now)
+        self.assertFalse(self.layer.store_locations(self.locations, self.now))
+
+    def test_changed_locations_are_updated(self):
+        self.layer.store_locations(self.locations, self.now)
+        self.layer.store_locations(
+            [location.Location('b', 53.5, 6.0)], self.now)
+        catalogue = self.layer.catalogue()
+        self.assertEquals(catalogue.identifiers, ['b'])
+        self.assertEquals(catalogue[0].latitude, 53.5)
+
+    def test_extras_that_arent_json_are_stored_as_strings(self):
+        self.layer.store_locations(
+            [location.Location('a', 52.0, 5.0, measured=self.now)],
+            self.now)
+        self.assertEquals(
+            self.layer.catalogue()[0].extra_args()['measured'],
+            unicode(self.now))
+
+    def test_catalogue_bbox(self):
+        self.layer.store_locations(self.locations, self.now)
+        self.assertEquals(
+            self.layer.catalogue(bbox=(5.5, 52.5, 6.5, 53.5)).identifiers,
+            ['b'])
+
+    def test_rd_coordinates_are_stored(self):
+        self.layer.store_locations(self.locations, self.now)
+        rd_x, rd_y = self.layer.catalogue_rd_coordinates()['a']
+        # Somewhere in the Netherlands
+        self.assertTrue(0 < rd_x < 300000)
+        self.assertTrue(300000 < rd_y < 625000)
+
+
+class TestDatasourceCache(TestCase):
+    def setUp(self):
+        self.now = dates.utc(2013, 6, 10, 12, 0)
+
+    def test_fetch_is_due_if_never_checked(self):
+        self.assertTrue(DatasourceCacheF.build().fetch_is_due(60, self.now))
+
+    def test_fetch_backs_off_after_empty_checks(self):
+        cache = DatasourceCacheF.build(
+            last_checked=self.now - datetime.timedelta(hours=3),
+            empty_count=3)
+        # Three empty checks in a row: wait 4 hours
+        self.assertFalse(cache.fetch_is_due(60, self.now))
+        cache.empty_count = 2
+        self.assertTrue(cache.fetch_is_due(60, self.now))
+
+    def test_backoff_has_a_maximum(self):
+        cache = DatasourceCacheF.build(
+            last_checked=self.now - datetime.timedelta(days=8),
+            empty_count=100)
+        self.assertTrue(cache.fetch_is_due(60 * 24 * 7, self.now))
+
+    def test_backoff_is_at_most_a_few_intervals(self):
+        cache = DatasourceCacheF.build(
+            last_checked=self.now - datetime.timedelta(hours=7),
+            empty_count=100)
+        self.assertFalse(cache.fetch_is_due(60, self.now))
+        cache.last_checked = self.now - datetime.timedelta(hours=8)
+        self.assertTrue(cache.fetch_is_due(60, self.now))
+
+    def test_fetch_start_uses_lookback_if_nothing_known(self):
+        self.assertEquals(
+            DatasourceCacheF.build().fetch_start(30, self.now),
+            self.now - datetime.timedelta(days=30))
+
+    def test_fetch_start_uses_last_check_if_no_value(self):
+        last_checked = self.now - datetime.timedelta(hours=1)
+        cache = DatasourceCacheF.build(last_checked=last_checked)
+        self.assertEquals(
+            cache.fetch_start(30, self.now),
+            last_checked - datetime.timedelta(minutes=30))
+
+    def test_fetch_start_uses_value_after_last_check(self):
+        cache = DatasourceCacheF.build(
+            last_checked=self.now - datetime.timedelta(hours=1),
+            timestamp=self.now - datetime.timedelta(minutes=70))
+        self.assertEquals(
+            cache.fetch_start(30, self.now), cache.timestamp)
+
+    def test_station_with_old_value_has_bounded_window_and_backs_off(self):
+        old = self.now - datetime.timedelta(days=60)
+        cache = DatasourceCacheF.build(timestamp=old, value=3.0)
+
+        # The first check starts at the old value, later ones don't
+        self.assertEquals(cache.fetch_start(30, self.now), old)
+        self.assertFalse(cache.record_check((old, 3.0), self.now))
+        self.assertEquals(
+            cache.fetch_start(30, self.now),
+            self.now - datetime.timedelta(minutes=30))
+
+        later = self.now + datetime.timedelta(hours=1)
+        self.assertTrue(cache.fetch_is_due(60, later))
+        self.assertFalse(cache.record_check(None, later))
+        self.assertEquals(cache.empty_count, 2)
+        self.assertFalse(cache.fetch_is_due(
+                60, later + datetime.timedelta(hours=1)))
+        self.assertEquals(cache.timestamp, old)
+
+    def test_record_check_stores_new_value(self):
+        cache = DatasourceCacheF.build(empty_count=2)
+        self.assertTrue(cache.record_check((self.now, 3.0), self.now))
+        self.assertEquals(cache.value, 3.0)
+        self.assertEquals(cache.empty_count, 0)
+        self.assertEquals(cache.last_checked, self.now)
+
+    def test_record_check_nothing_found_counts_as_empty(self):
+        cache = DatasourceCacheF.build(timestamp=self.now, value=3.0)
+        self.assertFalse(cache.record_check(None, self.now))
+        self.assertEquals(cache.empty_count, 1)
+        self.assertEquals(cache.last_empty, self.now)
+
+    def test_record_check_nothing_newer_counts_as_empty(self):
+        cache = DatasourceCacheF.build(
+            timestamp=self.now, value=3.0, empty_count=2)
+        self.assertFalse(cache.record_check((self.now, 3.0), self.now))
+        self.assertEquals(cache.empty_count, 3)
+        self.assertEquals(cache.last_empty, self.now)
+        self.assertEquals(cache.value, 3.0)
+
+
+class TestDatasourceHistory(TestCase):
+    def setUp(self):
+        self.now = dates.utc(2013, 6, 10, 12, 0)
+        self.hour_ago = self.now - datetime.timedelta(hours=1)
+        self.cache = DatasourceCacheF.create()
+
+    def history(self):
+        return list(models.DatasourceHistory.objects.values_list(
+                'timestamp', 'value'))
+
+    def test_first_append_stores_everything_and_sets_start(self):
+        self.cache.append_history(timeseries.Timeseries(
+                {self.hour_ago: 1.0, self.now: 2.0}), self.hour_ago)
+        self.assertEquals(len(self.history()), 2)
+        self.assertEquals(self.cache.history_start, self.hour_ago)
+
+    def test_append_skips_values_already_stored(self):
+        self.cache.history_start = self.hour_ago
+        self.cache.timestamp = self.hour_ago
+        self.cache.append_history(timeseries.Timeseries(
+                {self.hour_ago: 1.0, self.now: 2.0}), self.hour_ago)
+        self.assertEquals(self.history(), [(self.now, 2.0)])
+
+    def test_append_skips_overlap_with_stored_values(self):
+        self.cache.append_history(timeseries.Timeseries(
+                {self.hour_ago: 1.0}), self.hour_ago)
+        # A new cache line for the same location knows nothing
+        cache = DatasourceCacheF.build(
+            datasource_layer=self.cache.datasource_layer)
+        cache.append_history(timeseries.Timeseries(
+                {self.hour_ago: 1.0, self.now: 2.0}), self.hour_ago)
+        self.assertEquals(
+            self.history(), [(self.hour_ago, 1.0), (self.now, 2.0)])
+
+    def test_purge_removes_old_values_and_moves_start(self):
+        self.cache.append_history(timeseries.Timeseries(
+                {self.hour_ago: 1.0, self.now: 2.0}), self.hour_ago)
+        self.cache.save()
+        self.cache.datasource_layer.purge_history(self.now)
+        self.assertEquals(self.history(), [(self.now, 2.0)])
+        self.assertEquals(
+            models.DatasourceCache.objects.get(
+                pk=self.cache.pk).history_start, self.now)
+
+
+class TestCacheRun(TestCase):
+    def test_schedule_margin(self):
+        cache_run = models.CacheRun(
+            datasource_model=DatasourceModelF.build(
+                script_times_to_run_per_day=24),
+            started=dates.utc(2013, 1, 1, 12, 0),
+            finished=dates.utc(2013, 1, 1, 12, 10))
+        self.assertEquals(cache_run.duration_seconds(), 600)
+        self.assertEquals(cache_run.schedule_margin_seconds(), 3000)
+
+    def test_unfinished_run_has_no_margin(self):
+        cache_run = models.CacheRun(
+            datasource_model=DatasourceModelF.build(),
+            started=dates.utc(2013, 1, 1, 12, 0))
+        self.assertEquals(cache_run.schedule_margin_seconds(), None)
+
+    def test_start_deletes_old_runs(self):
+        datasource_model = DatasourceModelF.create()
+        old = models.CacheRun.objects.create(
+            datasource_model=datasource_model, owner='test',
+            started=dates.utc_now() - datetime.timedelta(
+                days=models.CacheRun.KEEP_DAYS + 1))
+        models.CacheRun.start(datasource_model, targeted=True)
+        self.assertFalse(models.CacheRun.objects.filter(pk=old.pk).exists())
+
 
 class TestAugmentedDataSource(TestCase):
     def test_has_unicode(self):
@@ -191,3 +559,14 @@ class TestColorMap(TestCase):
 
         color = cm.color_for(25)
         self.assertEquals(color, "00ff00")
+
+
+class TestIdentifierMapping(TestCase):
+    def test_proximity_map_maps_to_closest_in_range(self):
+        mapping = models.IdentifierMapping.objects.create(name="test")
+        mapping.create_proximity_map(
+            identifiers_from={'a': (0, 0), 'b': (100, 100)},
+            identifiers_to={'x': (1, 1), 'y': (5, 5)},
+            max_distance=10)
+        self.assertEquals(mapping.map('a'), 'x')
+        self.assertEquals(mapping.map('b'), None)
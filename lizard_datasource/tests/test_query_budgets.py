@@ -0,0 +1,192 @@
+"""Upper bounds on the number of queries of the hot paths. Where there
+is a bulk path, the number of queries shouldn't grow with the number
+of locations or datasources, so those tests compare a small and a
+larger case as well."""
+
+import datetime
+
+import mock
+
+from django.test import TestCase
+
+from lizard_datasource import augmented_datasource
+from lizard_datasource import datasource
+from lizard_datasource import dates
+from lizard_datasource import models
+from lizard_datasource import request_memo
+from lizard_datasource import scripts
+from lizard_datasource import synthetic_datasource
+from lizard_datasource.tests.query_budget import QueryBudgetMixin
+
+COLOR_CHOICES = datasource.ChoicesMade(dict={'level_0': 'level_0_0'})
+LINE_CHOICES = datasource.ChoicesMade(dict={'level_0': 'level_0_1'})
+
+
+class TestQueryBudgets(QueryBudgetMixin, TestCase):
+    def setUp(self):
+        patchers = (
+            mock.patch(
+                'lizard_datasource.datasource.datasources_from_entrypoints',
+                side_effect=lambda: (
+                    synthetic_datasource.factory() +
+                    augmented_datasource.factory())),
+            mock.patch.object(scripts, 'SECONDS_BETWEEN_FETCHES', 0),
+            )
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def synthetic(self, identifier, locations=5):
+        """A synthetic datasource with one level of two options, that
+        factory() returns until the end of the test."""
+        options = {
+            'levels': 1,
+            'fanout': 2,
+            'locations_per_layer': locations,
+            'series_length': 24,
+            'identifier': identifier,
+            }
+        synthetic_datasource.register(options)
+        self.addCleanup(synthetic_datasource.unregister, options)
+
+        ds = synthetic_datasource.SyntheticDataSource(**options)
+        ds.datasource_model.visible = True
+        ds.datasource_model.save()
+        return ds
+
+    def augmented(self, locations, hidden_colorfroms=0):
+        """An augmented datasource on a synthetic one with this many
+        locations. Its first layer is colored by the cached values of
+        the synthetic first layer, and gets the line of the second
+        layer in its graphs."""
+        ds = self.synthetic('budget_{0}'.format(locations), locations)
+
+        ds.set_choices_made(COLOR_CHOICES)
+        color_layer = ds.datasource_layer
+        identifiers = ds.locations().identifiers
+        now = dates.utc_now()
+        models.bulk_create_in_batches(models.DatasourceCache, (
+                models.DatasourceCache(
+                    datasource_layer=color_layer, locationid=identifier,
+                    timestamp=now, value=float(i), last_checked=now)
+                for i, identifier in enumerate(identifiers)))
+
+        ds.set_choices_made(LINE_CHOICES)
+        line_layer = ds.datasource_layer
+
+        colormap = models.ColorMap.objects.create(
+            name='budget', defaultcolor='888888')
+        models.ColorMapLine.objects.create(
+            colormap=colormap, minvalue=None, maxvalue=10.0, color='0000ff')
+        models.ColorMapLine.objects.create(
+            colormap=colormap, minvalue=10.0, maxvalue=None, color='ff0000')
+
+        config = models.AugmentedDataSource.objects.create(
+            augmented_source=ds.datasource_model,
+            name='budget {0}'.format(locations))
+        augmented = augmented_datasource.AugmentedDataSource(config)
+        augmented.set_choices_made(COLOR_CHOICES)
+        augmented_layer = augmented.datasource_layer
+
+        models.ColorFromLatestValue.objects.create(
+            augmented_source=config, layer_to_add_color_to=augmented_layer,
+            layer_to_get_color_from=color_layer, colormap=colormap)
+        for i in range(hidden_colorfroms):
+            models.ColorFromLatestValue.objects.create(
+                augmented_source=config,
+                layer_to_add_color_to=augmented_layer,
+                layer_to_get_color_from=line_layer, colormap=colormap,
+                hide_from_layer=True)
+
+        mapping = models.IdentifierMapping.objects.create(
+            name='budget {0}'.format(locations))
+        mapping.map_all_to(dict(
+                (identifier, identifier) for identifier in identifiers))
+        models.ExtraGraphLine.objects.create(
+            augmented_source=config, layer_to_add_line_to=augmented_layer,
+            layer_to_get_line_from=line_layer, identifier_mapping=mapping)
+
+        return augmented
+
+    def in_request(self, function, budget):
+        """Call function in its own request_memo() like in a view, fail
+        if that does more than budget queries and return the number of
+        queries. It is called once before, so that models that are
+        created on first use exist."""
+        function()
+        with request_memo.request_memo():
+            with self.assertMaxQueries(budget):
+                return self.count_queries(function)
+
+    def cached_layer(self, locations):
+        """A synthetic datasource with this many locations, and the
+        layer whose latest values the tests cache."""
+        ds = self.synthetic('cache_{0}'.format(locations), locations)
+        ds.set_choices_made(COLOR_CHOICES)
+        return ds, ds.datasource_layer
+
+    def test_get_datasources(self):
+        for i in range(2):
+            self.synthetic('few_{0}'.format(i))
+        few = self.count_queries(datasource.get_datasources)
+
+        for i in range(8):
+            self.synthetic('many_{0}'.format(i))
+        self.assertEquals(self.count_queries(datasource.get_datasources), few)
+
+        # The DatasourceModels, and the AugmentedDataSource models
+        with self.assertMaxQueries(2):
+            self.assertEquals(len(datasource.get_datasources()), 10)
+
+    def test_augmented_locations(self):
+        def colored_locations(augmented):
+            return lambda: list(augmented.locations(bare=False))
+
+        few = self.in_request(colored_locations(self.augmented(5)), 10)
+        many = self.in_request(colored_locations(self.augmented(50)), 10)
+        self.assertEquals(few, many)
+
+    def test_visible_criteria(self):
+        one = self.augmented(5, hidden_colorfroms=1)
+        three = self.augmented(6, hidden_colorfroms=3)
+
+        self.assertEquals(
+            self.in_request(one.visible_criteria, 8),
+            self.in_request(three.visible_criteria, 8))
+
+    def test_timeseries_with_extras(self):
+        augmented = self.augmented(5)
+        end_datetime = dates.utc_now()
+        start_datetime = end_datetime - datetime.timedelta(hours=24)
+
+        self.in_request(
+            lambda: augmented.timeseries(
+                'loc_0', start_datetime, end_datetime), 10)
+
+    def test_cache_layer(self):
+        # More locations than fit in one batch, to include the batching
+        few = self.cached_layer(5)
+        many = self.cached_layer(models.BULK_CREATE_BATCH_SIZE + 50)
+
+        with self.assertMaxQueries(12):
+            scripts._cache_layer(*few)
+
+        # New cache lines and locations are inserted in bulk; the
+        # second batch of each costs one more query
+        with self.assertMaxQueries(12 + 2):
+            scripts._cache_layer(*many)
+
+    def test_cache_layer_again_updates_each_line_once(self):
+        ds, datasource_layer = self.cached_layer(20)
+        scripts._cache_layer(ds, datasource_layer)
+
+        # Three hours later, each location has newer values
+        later = dates.utc_now() + datetime.timedelta(hours=3)
+        report = models.CacheRunLayer(datasource_layer=datasource_layer)
+        with mock.patch.object(dates, 'utc_now', return_value=later):
+            # There is no bulk update; at most one query per line
+            with self.assertMaxQueries(20 + 5):
+                scripts._cache_layer(ds, datasource_layer, report)
+
+        self.assertEquals(report.locations_fetched, 20)
+        self.assertEquals(report.locations_updated, 20)
@@ -0,0 +1,95 @@
+"""Tests for lizard_datasource.request_memo"""
+
+from django.test import TestCase
+
+from lizard_datasource import datasource
+from lizard_datasource import request_memo
+
+
+class CountingDataSource(datasource.DataSource):
+    identifier = 'counting'
+
+    def __init__(self):
+        self.calls = 0
+        self.set_choices_made(datasource.ChoicesMade(dict={}))
+
+    def criteria(self):
+        self.calls += 1
+        return ()
+
+    def is_drawable(self, choices_made=None):
+        self.calls += 1
+        return False
+
+
+class OtherCountingDataSource(CountingDataSource):
+    identifier = 'other_counting'
+
+
+class SubclassedDataSource(CountingDataSource):
+    def criteria(self):
+        return super(SubclassedDataSource, self).criteria() + ('extra',)
+
+
+class TestRequestMemo(TestCase):
+    def test_calls_are_remembered_inside_context(self):
+        ds = CountingDataSource()
+        with request_memo.request_memo():
+            ds.criteria()
+            ds.criteria()
+        self.assertEquals(ds.calls, 1)
+
+    def test_other_instances_share_results(self):
+        ds1 = CountingDataSource()
+        ds2 = CountingDataSource()
+        with request_memo.request_memo():
+            ds1.criteria()
+            ds2.criteria()
+        self.assertEquals(ds2.calls, 0)
+
+    def test_other_choices_made_have_own_results(self):
+        ds = CountingDataSource()
+        with request_memo.request_memo():
+            ds.criteria()
+            ds.set_choices_made(datasource.ChoicesMade(dict={'a': 'b'}))
+            ds.criteria()
+        self.assertEquals(ds.calls, 2)
+
+    def test_equal_choices_made_arguments_share_results(self):
+        ds = CountingDataSource()
+        with request_memo.request_memo():
+            ds.is_drawable(datasource.ChoicesMade(dict={'a': 'b'}))
+            ds.is_drawable(datasource.ChoicesMade(dict={'a': 'b'}))
+        self.assertEquals(ds.calls, 1)
+
+    def test_combined_datasources_of_other_datasources_dont_share(self):
+        ds1 = CountingDataSource()
+        ds2 = OtherCountingDataSource()
+        with request_memo.request_memo():
+            datasource.CombinedDataSource([ds1]).criteria()
+            datasource.CombinedDataSource([ds2]).criteria()
+        self.assertEquals(ds2.calls, 1)
+
+    def test_nothing_remembered_outside_context(self):
+        ds = CountingDataSource()
+        with request_memo.request_memo():
+            ds.criteria()
+        ds.criteria()
+        self.assertEquals(ds.calls, 2)
+
+    def test_super_calls_have_own_entry(self):
+        ds = SubclassedDataSource()
+        with request_memo.request_memo():
+            ds.criteria()
+            self.assertEquals(ds.criteria(), ('extra',))
+        self.assertEquals(ds.calls, 1)
+
+    def test_middleware_forgets_at_end_of_request(self):
+        middleware = request_memo.RequestMemoMiddleware()
+        ds = CountingDataSource()
+        middleware.process_request(None)
+        ds.criteria()
+        ds.criteria()
+        middleware.process_response(None, None)
+        ds.criteria()
+        self.assertEquals(ds.calls, 2)
@@ -0,0 +1,95 @@
+"""Tests for lizard_datasource.scheduler."""
+
+import datetime
+import mock
+
+from django.test import TestCase
+
+from lizard_datasource import dates
+from lizard_datasource import scheduler
+from lizard_datasource.tests import test_models
+
+
+class TestDueQueue(TestCase):
+    def setUp(self):
+        self.now = dates.utc(2013, 6, 10, 12, 30)
+        self.key = ("lizard_datasource_tests", "some_identifier")
+
+    def test_never_run_datasource_is_due_now(self):
+        test_models.DatasourceModelF.create()
+        queue = scheduler.due_queue(set([self.key]), self.now)
+        self.assertEquals(queue, [(self.now, self.key)])
+
+    def test_unknown_datasources_are_left_out(self):
+        test_models.DatasourceModelF.create()
+        self.assertEquals(scheduler.due_queue(set(), self.now), [])
+
+    def test_earliest_due_comes_first(self):
+        test_models.DatasourceModelF.create(
+            script_last_run_started=self.now)
+        test_models.DatasourceModelF.create(identifier="other")
+        queue = scheduler.due_queue(
+            set([self.key, (self.key[0], "other")]), self.now)
+        self.assertEquals(queue[0][1], (self.key[0], "other"))
+
+
+class TestCacheScheduler(TestCase):
+    def test_run_once_runs_due_datasources(self):
+        key = ("app", "identifier")
+        now = dates.utc_now()
+        cache_scheduler = scheduler.CacheScheduler()
+        cache_scheduler.keys = set([key])
+
+        with mock.patch('lizard_datasource.scheduler.due_queue',
+                        return_value=[(now, key)]):
+            with mock.patch('lizard_datasource.dates.utc_now',
+                            return_value=now):
+                with mock.patch.object(cache_scheduler, 'run_due') as m:
+                    self.assertEquals(cache_scheduler.run_once(), 0)
+                    m.assert_called_with(set([key]))
+
+    def test_run_once_sleeps_until_next_due(self):
+        now = dates.utc_now()
+        later = now + datetime.timedelta(seconds=30)
+        cache_scheduler = scheduler.CacheScheduler(poll_seconds=60)
+        cache_scheduler.keys = set()
+
+        with mock.patch('lizard_datasource.scheduler.due_queue',
+                        return_value=[(later, ("app", "identifier"))]):
+            with mock.patch('lizard_datasource.dates.utc_now',
+                            return_value=now):
+                self.assertEquals(cache_scheduler.run_once(), 30)
+
+    def test_poll_survives_errors_and_closes_connection(self):
+        cache_scheduler = scheduler.CacheScheduler(poll_seconds=60)
+        with mock.patch.object(
+            cache_scheduler, 'run_once', side_effect=ValueError("db gone")):
+            with mock.patch('lizard_datasource.scheduler.connection') as conn:
+                self.assertEquals(cache_scheduler.poll(), 60)
+                self.assertTrue(conn.close.called)
+
+    def test_deadline_runs_in_worker_processes(self):
+        cache_scheduler = scheduler.CacheScheduler(deadline=600)
+        ds = mock.MagicMock()
+        ds.originating_app, ds.identifier = "app", "identifier"
+        with mock.patch(
+            'lizard_datasource.datasource.datasources_from_entrypoints',
+            return_value=[ds]):
+            with mock.patch(
+                'lizard_datasource.scripts.cache_latest_values_in_parallel'
+                ) as mocked:
+                cache_scheduler.run_due(set([("app", "identifier")]))
+                mocked.assert_called_with(
+                    [ds], 1, deadline=600, targeted=True)
+
+
+class TestCacheableKeys(TestCase):
+    def test_only_given_identifiers(self):
+        ds1, ds2 = mock.MagicMock(), mock.MagicMock()
+        ds1.originating_app = ds2.originating_app = "app"
+        ds1.identifier, ds2.identifier = "one", "two"
+        with mock.patch('lizard_datasource.scripts.has_cacheable_layers',
+                        return_value=True):
+            self.assertEquals(
+                scheduler.cacheable_keys([ds1, ds2], ["two"]),
+                set([("app", "two")]))
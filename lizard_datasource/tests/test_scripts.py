@@ -1,11 +1,17 @@
 """Tests for lizard_datasource.scripts."""
 
+import datetime
 import mock
 
 from django.test import TestCase
 
+from lizard_datasource import criteria
 from lizard_datasource import datasource
+from lizard_datasource import dates
+from lizard_datasource import dummy_datasource
+from lizard_datasource import models
 from lizard_datasource import scripts
+from lizard_datasource import synthetic_datasource
 
 
 class TestYieldLayers(TestCase):
@@ -15,3 +21,220 @@ class TestYieldLayers(TestCase):
         layers = list(scripts._yield_drawable_datasources(ds))
         self.assertEquals(len(layers), 1)
         self.assertTrue(layers[0] is ds)
+
+    def test_all_drawable_layers_of_dummy_found(self):
+        ds = dummy_datasource.DummyDataSource()
+        choices = [
+            drawable.get_choices_made().json()
+            for drawable in scripts._yield_drawable_datasources(ds)]
+        self.assertEquals(len(choices), 2)
+
+    def test_same_choices_visited_once(self):
+        ds = mock.MagicMock()
+        ds.is_drawable = lambda choices_made: 'test' in choices_made
+        option = criteria.Option('value', 'description')
+        ds.chooseable_criteria.return_value = [{
+                'criterion': criteria.Criterion('test', 'Test'),
+                'options': mock.MagicMock(
+                    iter_options=lambda: iter([option, option]))
+                }]
+        layers = list(scripts._yield_drawable_datasources(ds))
+        self.assertEquals(len(layers), 1)
+
+
+class TestDrawableLayers(TestCase):
+    def test_stored_layers_used_if_discovery_not_due(self):
+        ds = mock.MagicMock()
+        ds.datasource_model.layer_discovery_is_due.return_value = False
+        ds.datasource_model.discovered_layers.return_value = ['layer']
+        with mock.patch('lizard_datasource.scripts.discover_layers') as m:
+            self.assertEquals(scripts.drawable_layers(ds), ['layer'])
+            self.assertFalse(m.called)
+
+    def test_discovery_runs_if_due(self):
+        ds = mock.MagicMock()
+        ds.datasource_model.layer_discovery_is_due.return_value = True
+        with mock.patch(
+            'lizard_datasource.scripts.discover_layers',
+            return_value=['layer']) as m:
+            self.assertEquals(scripts.drawable_layers(ds), ['layer'])
+            m.assert_called_with(ds)
+
+
+class TestCacheLatestValuesInParallel(TestCase):
+    def test_nothing_started_if_nothing_due(self):
+        ds = mock.MagicMock()
+        ds.datasource_model.cache_script_has_work.return_value = False
+        with mock.patch('multiprocessing.Pool') as pool:
+            scripts.cache_latest_values_in_parallel([ds], 4)
+            self.assertFalse(pool.called)
+
+    def test_worker_runs_matching_datasource(self):
+        ds1, ds2 = mock.MagicMock(), mock.MagicMock()
+        ds1.originating_app = ds2.originating_app = 'app'
+        ds1.identifier, ds2.identifier = 'one', 'two'
+        with mock.patch(
+            'lizard_datasource.datasource.datasources_from_entrypoints',
+            return_value=[ds1, ds2]):
+            with mock.patch(
+                'lizard_datasource.scripts.cache_latest_values') as mocked:
+                scripts._cache_latest_values_worker(('app', 'two'), False)
+                mocked.assert_called_once_with(ds2, targeted=False)
+
+
+class HistoryFirstDataSource(synthetic_datasource.SyntheticDataSource):
+    """Answers from the history when it covers the window, like
+    AugmentedDataSource does."""
+    def timeseries(self, location_id, start_datetime=None, end_datetime=None,
+                   max_points=None):
+        history = self.history_timeseries(
+            location_id, start_datetime, end_datetime)
+        if history is not None:
+            return history
+        return super(HistoryFirstDataSource, self).timeseries(
+            location_id, start_datetime, end_datetime, max_points)
+
+
+class TestCacheLayerHistory(TestCase):
+    def test_refresh_inside_schedule_interval_asks_backend(self):
+        ds = HistoryFirstDataSource(
+            levels=1, fanout=2, locations_per_layer=3, series_length=24,
+            identifier='history_first')
+        datasource_model = ds.datasource_model
+        datasource_model.history_retention_days = 7
+        datasource_model.minutes_between_scripts = 60
+        datasource_model.save()
+        ds.set_choices_made(
+            datasource.ChoicesMade(dict={'level_0': 'level_0_0'}))
+        datasource_layer = ds.datasource_layer
+
+        with mock.patch('lizard_datasource.scripts.SECONDS_BETWEEN_FETCHES',
+                        0):
+            scripts._cache_layer(ds, datasource_layer)
+            # The history covers the next hour now, but the cache
+            # script must not read it back
+            backend_calls = ds.backend_calls
+            scripts._cache_layer(ds, datasource_layer)
+
+        self.assertEquals(ds.backend_calls, backend_calls + 3)
+        self.assertTrue(ds.history_timeseries(
+                'loc_0', dates.utc_now() - datetime.timedelta(hours=1),
+                dates.utc_now()) is not None)
+
+    def test_overlapping_windows_dont_store_values_twice(self):
+        ds = synthetic_datasource.SyntheticDataSource(
+            levels=1, fanout=2, locations_per_layer=3, series_length=24,
+            identifier='history')
+        datasource_model = ds.datasource_model
+        datasource_model.history_retention_days = 7
+        datasource_model.script_initial_lookback_days = 2
+        datasource_model.save()
+        ds.set_choices_made(
+            datasource.ChoicesMade(dict={'level_0': 'level_0_0'}))
+        datasource_layer = ds.datasource_layer
+
+        with mock.patch('lizard_datasource.scripts.SECONDS_BETWEEN_FETCHES',
+                        0):
+            scripts._cache_layer(ds, datasource_layer)
+            stored = models.DatasourceHistory.objects.count()
+            # Without cache lines the next window starts at the
+            # lookback again, and overlaps everything stored
+            models.DatasourceCache.objects.filter(
+                datasource_layer=datasource_layer).delete()
+            scripts._cache_layer(ds, datasource_layer)
+
+        self.assertEquals(stored, 3 * 24)
+        self.assertEquals(models.DatasourceHistory.objects.count(), stored)
+
+
+class TestPauseBetweenFetches(TestCase):
+    def test_layer_interval_shortens_pause(self):
+        layer = models.DatasourceLayer(script_refresh_minutes=10)
+        with mock.patch('lizard_datasource.scripts.SECONDS_BETWEEN_FETCHES',
+                        1):
+            self.assertEquals(scripts._pause_between_fetches(layer, 100), 1)
+            # 3000 seconds of pauses would take more than half of 10
+            # minutes
+            self.assertEquals(
+                scripts._pause_between_fetches(layer, 3000), 0.1)
+            self.assertEquals(scripts._pause_between_fetches(
+                    models.DatasourceLayer(), 3000), 1)
+
+
+class TestLease(TestCase):
+    def test_renewer_raises_if_lease_lost(self):
+        datasource_model = mock.MagicMock()
+        datasource_model.cache_script_lease.return_value = (
+            datetime.timedelta(minutes=15))
+        datasource_model.renew_cache_script_lease.return_value = False
+        renew_lease = scripts._LeaseRenewer(datasource_model)
+
+        # Not renewed until a third of the lease has passed
+        renew_lease()
+        self.assertFalse(datasource_model.renew_cache_script_lease.called)
+        renew_lease.renewed -= 5 * 60
+        self.assertRaises(scripts.LeaseLost, renew_lease)
+
+    def test_killed_workers_are_released_and_their_runs_finished(self):
+        owner = models.lease_owner(12345)
+        killed = models.DatasourceModel.objects.create(
+            originating_app='app', identifier='killed',
+            script_lease_owner=owner, script_lease_expires=dates.utc_now())
+        finished = models.DatasourceModel.objects.create(
+            originating_app='app', identifier='finished',
+            script_lease_owner='other', script_lease_expires=dates.utc_now())
+
+        cache_run = models.CacheRun.objects.create(
+            datasource_model=killed, owner=owner, started=dates.utc_now())
+
+        scripts._release_killed_workers(
+            [('app', 'killed'), ('app', 'finished')], [owner])
+
+        cache_run = models.CacheRun.objects.get(pk=cache_run.pk)
+        self.assertTrue(cache_run.finished is not None)
+        self.assertTrue('deadline' in cache_run.error)
+
+        self.assertEquals(models.DatasourceModel.objects.get(
+                pk=killed.pk).script_lease_owner, None)
+        self.assertEquals(models.DatasourceModel.objects.get(
+                pk=finished.pk).script_lease_owner, 'other')
+
+
+class TestCacheRunReports(TestCase):
+    def setUp(self):
+        self.ds = dummy_datasource.DummyDataSource()
+        self.ds.set_choices_made(datasource.ChoicesMade(dict={
+                    'appname': 'lizard_datasource', 'first_letter': 'ae'}))
+        layer = self.ds.datasource_layer
+        layer.cache_latest_values = True
+        layer.save()
+
+    def test_run_and_layer_are_reported(self):
+        with mock.patch('lizard_datasource.scripts.SECONDS_BETWEEN_FETCHES',
+                        0):
+            scripts.cache_latest_values(self.ds)
+
+        cache_run = models.CacheRun.objects.get()
+        self.assertTrue(cache_run.finished is not None)
+        self.assertEquals(cache_run.layers_refreshed, 1)
+        self.assertEquals(
+            cache_run.locations_processed,
+            len(dummy_datasource.CITIES['ae']))
+
+        layer_report = cache_run.cacherunlayer_set.get()
+        self.assertEquals(
+            layer_report.locations_fetched,
+            layer_report.locations_updated + layer_report.locations_empty)
+        self.assertEquals(layer_report.error, None)
+
+    def test_error_is_recorded(self):
+        with mock.patch.object(
+            dummy_datasource.DummyDataSource, 'timeseries',
+            side_effect=ValueError("backend down")):
+            self.assertRaises(
+                ValueError, scripts.cache_latest_values, self.ds)
+
+        cache_run = models.CacheRun.objects.get()
+        self.assertTrue('backend down' in cache_run.error)
+        self.assertTrue(
+            'backend down' in cache_run.cacherunlayer_set.get().error)
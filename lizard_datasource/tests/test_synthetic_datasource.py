@@ -0,0 +1,61 @@
+import datetime
+
+from django.test import TestCase
+
+from lizard_datasource import datasource
+from lizard_datasource import dates
+from lizard_datasource import synthetic_datasource
+
+
+class TestSyntheticDatasource(TestCase):
+    def setUp(self):
+        self.ds = synthetic_datasource.SyntheticDataSource(
+            levels=2, fanout=3, locations_per_layer=50, series_length=48)
+        self.ds.set_choices_made(datasource.ChoicesMade(dict={
+                    'level_0': 'level_0_1', 'level_1': 'level_1_2'}))
+
+    def test_has_a_criterion_per_level(self):
+        criteria = self.ds.criteria()
+        self.assertEquals(len(criteria), 2)
+        self.assertEquals(criteria[1].prerequisites, ('level_0',))
+
+    def test_has_fanout_options(self):
+        options = self.ds.options_for_criterion(self.ds.criteria()[0])
+        self.assertEquals(len(options), 3)
+
+    def test_drawable_when_all_levels_chosen(self):
+        self.assertTrue(self.ds.is_drawable())
+        self.assertFalse(self.ds.is_drawable(datasource.ChoicesMade(
+                    dict={'level_0': 'level_0_1'})))
+
+    def test_locations_are_deterministic(self):
+        locations = self.ds.locations()
+        self.assertEquals(len(locations), 50)
+        self.assertEquals(
+            list(locations.latitudes), list(self.ds.locations().latitudes))
+
+    def test_timeseries_has_same_value_at_same_hour(self):
+        end = dates.utc(2013, 1, 10, 12, 30)
+        timeseries = self.ds.timeseries('loc_1', end_datetime=end)
+        self.assertEquals(len(timeseries), 48)
+
+        earlier = self.ds.timeseries(
+            'loc_1', end_datetime=end - datetime.timedelta(hours=5))
+        self.assertEquals(timeseries.values()[0], earlier.values()[5])
+
+    def test_counts_backend_calls(self):
+        calls = synthetic_datasource.SyntheticDataSource.backend_calls
+        self.ds.locations()
+        self.assertEquals(
+            synthetic_datasource.SyntheticDataSource.backend_calls,
+            calls + 1)
+
+    def test_factory_returns_registered(self):
+        options = {'identifier': 'registered_synthetic'}
+        synthetic_datasource.register(options)
+        try:
+            identifiers = [
+                ds.identifier for ds in synthetic_datasource.factory()]
+        finally:
+            synthetic_datasource.unregister(options)
+        self.assertTrue('registered_synthetic' in identifiers)
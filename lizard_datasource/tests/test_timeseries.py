@@ -1,5 +1,6 @@
 """Tests for lizard_datasource.timeseries"""
 
+import datetime
 import pandas
 
 from django.test import TestCase
@@ -37,6 +38,24 @@ class TestTimeseries(TestCase):
         self.assertEquals(len(latest), 1)
         self.assertEquals(latest[self.some_date], self.some_value)
 
+    def test_last_valid_returns_timestamp_and_value(self):
+        ts = timeseries.Timeseries({
+                self.some_date: self.some_value,
+                self.some_date - datetime.timedelta(hours=1): 1.0})
+        self.assertEquals(
+            ts.last_valid(), (self.some_date, self.some_value))
+
+    def test_last_valid_skips_missing_values(self):
+        earlier = self.some_date - datetime.timedelta(hours=1)
+        ts = timeseries.Timeseries({
+                earlier: 1.0,
+                self.some_date: float('nan')})
+        self.assertEquals(ts.last_valid(), (earlier, 1.0))
+
+    def test_last_valid_of_empty_timeseries_is_none(self):
+        ts = timeseries.Timeseries({})
+        self.assertEquals(ts.last_valid(), None)
+
     def test_data_returns_list_of_lists(self):
         ts = timeseries.Timeseries({self.some_date: self.some_value})
         self.assertEquals(ts.data(), [[self.some_date, self.some_value]])
@@ -44,3 +63,80 @@ class TestTimeseries(TestCase):
     def test_timeseries_has_a_length(self):
         ts = timeseries.Timeseries({self.some_date: self.some_value})
         self.assertEquals(len(ts), 1)
+
+
+class TestWindow(TestCase):
+    def setUp(self):
+        self.date1 = dates.utc(2012, 12, 6, 17, 0)
+        self.date2 = dates.utc(2012, 12, 6, 18, 0)
+        self.date3 = dates.utc(2012, 12, 6, 19, 0)
+        self.ts = timeseries.Timeseries({
+                self.date1: 1.0, self.date2: 2.0, self.date3: 3.0})
+
+    def test_window_includes_both_ends(self):
+        self.assertEquals(
+            self.ts.window(self.date1, self.date2).dates(),
+            [self.date1, self.date2])
+
+    def test_window_without_limits_is_a_copy(self):
+        window = self.ts.window()
+        self.assertFalse(window is self.ts)
+        self.assertEquals(len(window), 3)
+
+
+class TestConcat(TestCase):
+    def test_concat_splices_and_drops_duplicate_rows(self):
+        date1 = dates.utc(2012, 12, 6, 17, 0)
+        date2 = dates.utc(2012, 12, 6, 18, 0)
+        date3 = dates.utc(2012, 12, 6, 19, 0)
+        ts = timeseries.concat([
+                timeseries.Timeseries({date1: 1.0, date2: 2.0}),
+                timeseries.Timeseries({date2: 5.0, date3: 3.0})])
+        self.assertEquals(ts.values(), [1.0, 2.0, 3.0])
+
+    def test_concat_of_nothing_is_none(self):
+        self.assertEquals(timeseries.concat([]), None)
+
+
+class TestDownsample(TestCase):
+    def setUp(self):
+        start = dates.utc(2012, 1, 1)
+        # A saw tooth with one high peak in the middle
+        self.data = dict(
+            (start + datetime.timedelta(minutes=5 * i), float(i % 10))
+            for i in range(1000))
+        self.peak_date = start + datetime.timedelta(minutes=5 * 500)
+        self.data[self.peak_date] = 100.0
+        self.ts = timeseries.Timeseries(self.data)
+
+    def test_small_timeseries_returned_as_is(self):
+        self.assertTrue(self.ts.downsample(1000) is self.ts)
+        self.assertTrue(self.ts.downsample(None) is self.ts)
+
+    def test_unknown_method_raises(self):
+        self.assertRaises(
+            ValueError, lambda: self.ts.downsample(10, method='median'))
+
+    def test_minmax_is_bounded_and_keeps_peak(self):
+        downsampled = self.ts.downsample(100, method='minmax')
+        self.assertTrue(len(downsampled) <= 100)
+        self.assertEquals(max(downsampled.values()), 100.0)
+
+    def test_lttb_keeps_first_last_and_peak(self):
+        downsampled = self.ts.downsample(50, method='lttb')
+        self.assertEquals(len(downsampled), 50)
+        dates_ = list(downsampled.dates())
+        self.assertEquals(dates_[0], min(self.data))
+        self.assertEquals(dates_[-1], max(self.data))
+        self.assertTrue(self.peak_date in dates_)
+
+    def test_mean_averages(self):
+        downsampled = self.ts.downsample(10, method='mean')
+        self.assertTrue(len(downsampled) <= 10)
+        # Without the peak, every bucket of 100 values averages 4.5
+        self.assertEquals(downsampled.values()[0], 4.5)
+
+    def test_columns_keep_their_order(self):
+        ts = timeseries.Timeseries([self.data, self.data])
+        downsampled = ts.downsample(20)
+        self.assertEquals(downsampled.columns, ts.columns)
@@ -0,0 +1,144 @@
+"""Tests for lizard_datasource.cache_backends and
+lizard_datasource.timeseries_cache"""
+
+import datetime
+
+from django.test import TestCase
+from django.test.utils import override_settings
+
+from lizard_datasource import cache_backends
+from lizard_datasource import dates
+from lizard_datasource import datasource
+from lizard_datasource import timeseries
+from lizard_datasource import timeseries_cache
+
+
+class CountingDataSource(datasource.DataSource):
+    """Returns four hourly values, and remembers which windows it was
+    asked for."""
+    identifier = 'counting'
+
+    def __init__(self):
+        self.windows = []
+
+    @property
+    def calls(self):
+        return len(self.windows)
+
+    def get_choices_made(self):
+        return datasource.ChoicesMade(dict={})
+
+    @timeseries_cache.cached
+    def timeseries(self, location_id, start_datetime=None, end_datetime=None,
+                   max_points=None):
+        self.windows.append((start_datetime, end_datetime))
+        return timeseries.Timeseries(dict(
+                (dates.utc(2013, 6, 10, hour), float(hour))
+                for hour in range(10, 14)
+                if start_datetime <= dates.utc(2013, 6, 10, hour) and
+                dates.utc(2013, 6, 10, hour) <= end_datetime))
+
+
+class TestLRUCache(TestCase):
+    def setUp(self):
+        self.time = 0
+        self.cache = cache_backends.LRUCache(
+            2, ttl_seconds=10, timer=lambda: self.time)
+
+    def test_returns_stored_value(self):
+        self.cache.set('a', 1)
+        self.assertEquals(self.cache.get('a'), 1)
+
+    def test_evicts_least_recently_used(self):
+        self.cache.set('a', 1)
+        self.cache.set('b', 2)
+        self.cache.get('a')
+        self.cache.set('c', 3)
+        self.assertEquals(self.cache.get('b'), None)
+        self.assertEquals(self.cache.get('a'), 1)
+
+    def test_values_expire(self):
+        self.cache.set('a', 1)
+        self.time = 11
+        self.assertEquals(self.cache.get('a', 'missing'), 'missing')
+
+
+@override_settings(LIZARD_DATASOURCE_TIMESERIES_CACHE={'BACKEND': 'lru'})
+class TestCached(TestCase):
+    def setUp(self):
+        timeseries_cache.reset()
+        self.ds = CountingDataSource()
+
+    def tearDown(self):
+        timeseries_cache.reset()
+
+    def test_overlapping_windows_share_an_entry(self):
+        start = dates.utc(2013, 6, 10, 10, 1)
+        end = dates.utc(2013, 6, 10, 13, 1)
+        self.ds.timeseries('loc', start, end)
+        self.ds.timeseries('loc', start + datetime.timedelta(minutes=5), end)
+        self.assertEquals(self.ds.calls, 1)
+
+    def test_result_is_cut_to_requested_window(self):
+        ts = self.ds.timeseries(
+            'loc', dates.utc(2013, 6, 10, 10, 30),
+            dates.utc(2013, 6, 10, 12, 30))
+        self.assertEquals(ts.values(), [11.0, 12.0])
+
+    def test_other_locations_have_other_entries(self):
+        end = dates.utc(2013, 6, 10, 13, 0)
+        self.ds.timeseries('loc1', dates.utc(2013, 6, 10, 10, 0), end)
+        self.ds.timeseries('loc2', dates.utc(2013, 6, 10, 10, 0), end)
+        self.assertEquals(self.ds.calls, 2)
+
+    def test_disabled_goes_to_backend(self):
+        start = dates.utc(2013, 6, 10, 10, 0)
+        end = dates.utc(2013, 6, 10, 13, 0)
+        self.ds.timeseries('loc', start, end)
+        with timeseries_cache.disabled():
+            self.ds.timeseries('loc', start, end)
+        self.assertEquals(self.ds.calls, 2)
+
+    def test_max_points_downsamples_cached_result(self):
+        ts = self.ds.timeseries(
+            'loc', dates.utc(2013, 6, 10, 10, 0),
+            dates.utc(2013, 6, 10, 13, 0), max_points=2)
+        self.assertTrue(len(ts) <= 2)
+
+    def test_panning_only_fetches_the_new_part(self):
+        self.ds.timeseries(
+            'loc', dates.utc(2013, 6, 10, 10, 0),
+            dates.utc(2013, 6, 10, 12, 0))
+        ts = self.ds.timeseries(
+            'loc', dates.utc(2013, 6, 10, 11, 0),
+            dates.utc(2013, 6, 10, 13, 0))
+        self.assertEquals(self.ds.windows[-1], (
+                dates.utc(2013, 6, 10, 12, 0), dates.utc(2013, 6, 10, 13, 0)))
+        self.assertEquals(ts.values(), [11.0, 12.0, 13.0])
+
+
+class TestMissingRanges(TestCase):
+    def setUp(self):
+        self.hours = [dates.utc(2013, 6, 10, hour) for hour in range(24)]
+
+    def segment(self, start, end):
+        return timeseries_cache.Segment(
+            self.hours[start], self.hours[end], None, None)
+
+    def test_nothing_cached_everything_missing(self):
+        self.assertEquals(
+            timeseries_cache.missing_ranges([], self.hours[1], self.hours[5]),
+            [(self.hours[1], self.hours[5])])
+
+    def test_gaps_between_segments_are_missing(self):
+        segments = [self.segment(0, 2), self.segment(3, 4)]
+        self.assertEquals(
+            timeseries_cache.missing_ranges(
+                segments, self.hours[1], self.hours[6]),
+            [(self.hours[2], self.hours[3]), (self.hours[4], self.hours[6])])
+
+    def test_covered_window_misses_nothing(self):
+        self.assertEquals(
+            timeseries_cache.missing_ranges(
+                [self.segment(0, 10)], self.hours[1], self.hours[5]),
+            [])
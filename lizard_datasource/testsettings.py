@@ -13,6 +13,12 @@ DATABASES = {
 }
 
 SITE_ID = 1
+
+# Lizard-datasource stores timezone-aware UTC datetimes (dates.py), and
+# the SQLite backend refuses to store those unless USE_TZ is on. Sites
+# need it too, see the README.
+USE_TZ = True
+
 INSTALLED_APPS = [
     'lizard_datasource',
     'lizard_security',
@@ -100,6 +106,9 @@ MAP_SETTINGS = {
         'http://tile.openstreetmap.nl/tiles/${z}/${x}/${y}.png'),
     }
 
+# Tests that need the timeseries cache turn it on themselves.
+LIZARD_DATASOURCE_TIMESERIES_CACHE = {'BACKEND': None}
+
 # Set the default period in days.
 DEFAULT_START_DAYS = -20
 DEFAULT_END_DAYS = 5
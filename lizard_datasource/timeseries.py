@@ -2,6 +2,7 @@
 DataFrame."""
 
 import logging
+import numpy
 import pandas
 
 from itertools import izip
@@ -11,6 +12,90 @@ from pandas import Series
 
 logger = logging.getLogger(__name__)
 
+DOWNSAMPLE_METHODS = ('minmax', 'lttb', 'mean')
+
+
+def _index_as_int64(dataframe):
+    """Return the index of the dataframe as nanoseconds since the epoch."""
+    return pandas.DatetimeIndex(dataframe.index).asi8
+
+
+def _run_starts(buckets):
+    """Return the positions where a new run of equal values starts in
+    the (sorted) array buckets."""
+    return numpy.flatnonzero(numpy.r_[True, numpy.diff(buckets) != 0])
+
+
+def _minmax_positions(values, max_points):
+    """Split values into max_points / 2 buckets of equal size, and
+    return the positions of the minimum and maximum of each bucket."""
+    nbuckets = max(max_points // 2, 1)
+    buckets = numpy.arange(len(values)) * nbuckets // len(values)
+
+    # Sort by bucket first, then by value; the first element of each
+    # bucket is then its minimum and the last its maximum.
+    order = numpy.lexsort((values, buckets))
+    starts = _run_starts(buckets[order])
+    ends = numpy.r_[starts[1:], len(values)] - 1
+
+    return numpy.union1d(order[starts], order[ends])
+
+
+def _lttb_positions(x, y, max_points):
+    """Largest-Triangle-Three-Buckets: choose max_points points from
+    (x, y) that keep the visual shape of the line. The first and last
+    point are always kept. Each bucket is handled with array
+    operations, only the loop over the buckets is in Python."""
+    n = len(x)
+    if max_points < 3:
+        return numpy.array([0, n - 1])
+
+    every = (n - 2) / float(max_points - 2)
+    selected = [0]
+    a = 0
+
+    for i in range(max_points - 2):
+        # Average of the next bucket
+        avg_start = int((i + 1) * every) + 1
+        avg_end = min(int((i + 2) * every) + 1, n)
+        avg_x = x[avg_start:avg_end].mean()
+        avg_y = y[avg_start:avg_end].mean()
+
+        # The point in this bucket that makes the largest triangle
+        # with the previously selected point and the average
+        range_start = int(i * every) + 1
+        range_end = int((i + 1) * every) + 1
+        areas = numpy.abs(
+            (x[a] - avg_x) * (y[range_start:range_end] - y[a]) -
+            (x[a] - x[range_start:range_end]) * (avg_y - y[a]))
+
+        a = range_start + int(areas.argmax())
+        selected.append(a)
+
+    selected.append(n - 1)
+    return numpy.array(selected)
+
+
+def concat(timeseries_list):
+    """Splice timeseries that cover different periods into one, that
+    has the columns of all of them (in order of first appearance). If
+    a timestamp occurs in more than one, its row is taken from the
+    first. Return None if timeseries_list is empty."""
+    if not timeseries_list:
+        return None
+
+    columns = []
+    for timeseries in timeseries_list:
+        for column in timeseries.columns:
+            if column not in columns:
+                columns.append(column)
+
+    dataframe = pandas.concat([
+            timeseries.dataframe for timeseries in timeseries_list])
+    unique_times, first_positions = numpy.unique(
+        _index_as_int64(dataframe), return_index=True)
+    return Timeseries(dataframe.take(first_positions)[columns])
+
 
 class Timeseries(object):
     def __init__(self, data):
@@ -42,11 +127,21 @@ class Timeseries(object):
             self._columns = tuple(
                 'data_{0}'.format(i) for i, series in enumerate(data))
 
+        self._last_valid = None
+
+    def _with_dataframe(self, dataframe):
+        """Return a new Timeseries for this dataframe, with the same
+        column order as this one."""
+        timeseries = Timeseries(dataframe)
+        timeseries._columns = self._columns
+        return timeseries
+
     def add(self, timeseries):
         """Add the columns from timeseries to the dataframe of this
         timeseries."""
         self._dataframe = self._dataframe.combineAdd(timeseries._dataframe)
         self._columns = self.columns + timeseries.columns
+        self._last_valid = None
 
     @property
     def dataframe(self):
@@ -81,9 +176,88 @@ class Timeseries(object):
     def latest(self):
         return self.timeseries.tail(1)
 
+    def last_valid(self):
+        """Return a (timestamp, value) tuple of the last non-missing
+        value of the first series, or None if there is none. Unlike
+        latest(), this doesn't copy the series. The result is
+        remembered until columns are added."""
+        if self._last_valid is None:
+            if not len(self):
+                return None
+            series = self._dataframe[self._columns[0]]
+            timestamp = series.last_valid_index()
+            if timestamp is None:
+                return None
+            self._last_valid = (timestamp, series[timestamp])
+        return self._last_valid
+
     def data(self):
         return [[key, value]
                 for key, value in izip(self.dates(), self.values())]
 
+    def downsample(self, max_points, method='minmax'):
+        """Return a Timeseries that has at most about max_points points
+        per column, for drawing graphs that are only so many pixels
+        wide. If this timeseries is small enough, it is returned as is.
+
+        Methods:
+        - 'minmax' keeps the minimum and maximum of each of
+          max_points / 2 buckets, so that peaks remain visible.
+        - 'lttb' uses the Largest-Triangle-Three-Buckets algorithm,
+          which keeps the visual shape of the line.
+        - 'mean' averages the values in max_points equally long
+          periods of time, and places them at the start of each period.
+
+        For 'minmax' and 'lttb' each column is downsampled on its own,
+        and the result has the union of the chosen rows."""
+        if method not in DOWNSAMPLE_METHODS:
+            raise ValueError(
+                "Unknown downsample method: {0}".format(method))
+
+        if not max_points or len(self) <= max_points:
+            return self
+
+        dataframe = self._dataframe
+
+        if method == 'mean':
+            times = _index_as_int64(dataframe)
+            span = float(times[-1] - times[0] + 1)
+            buckets = ((times - times[0]) / span * max_points).astype(
+                numpy.int64)
+            means = dataframe.groupby(buckets).mean()
+            means.index = dataframe.index[_run_starts(buckets)]
+            return self._with_dataframe(means)
+
+        times = _index_as_int64(dataframe).astype(numpy.float64)
+        rows = numpy.array([], dtype=numpy.int64)
+        for column in self._columns:
+            values = dataframe[column].values.astype(numpy.float64)
+            positions = numpy.flatnonzero(~numpy.isnan(values))
+            if len(positions) <= max_points:
+                chosen = numpy.arange(len(positions))
+            elif method == 'minmax':
+                chosen = _minmax_positions(values[positions], max_points)
+            else:
+                chosen = _lttb_positions(
+                    times[positions], values[positions], max_points)
+            rows = numpy.union1d(rows, positions[chosen])
+
+        return self._with_dataframe(dataframe.take(rows))
+
+    def window(self, start_datetime=None, end_datetime=None):
+        """Return a new Timeseries with only the rows from
+        start_datetime up to and including end_datetime. None means
+        no limit on that side."""
+        if not len(self):
+            return self._with_dataframe(self._dataframe.copy())
+
+        times = _index_as_int64(self._dataframe)
+        mask = numpy.ones(len(times), dtype=bool)
+        if start_datetime is not None:
+            mask &= times >= pandas.Timestamp(start_datetime).value
+        if end_datetime is not None:
+            mask &= times <= pandas.Timestamp(end_datetime).value
+        return self._with_dataframe(self._dataframe[mask])
+
     def __len__(self):
         return len(self._dataframe) if self._dataframe is not None else 0
@@ -0,0 +1,228 @@
+"""A read-through cache for DataSource.timeseries().
+
+Graphs of the same location are often requested by several users
+within minutes of each other, and each request used to go to the
+backend. Timeseries() methods decorated with cached() first look in a
+cache, that has an entry per layer and location.
+
+An entry is a list of segments: periods of time for which the
+timeseries was fetched, with the result. A request only fetches the
+parts of its window that no segment covers yet, and the result is
+spliced together from the segments. When a user pans a graph by an
+hour, only that hour is fetched. Segments expire after TTL_SECONDS.
+
+Windows are widened to whole buckets (BUCKET_MINUTES) before they are
+fetched, so that segment boundaries line up and requests for slightly
+different windows (e.g. "the last 48 hours", asked a minute apart)
+don't fetch tiny slivers.
+
+Configure it with the LIZARD_DATASOURCE_TIMESERIES_CACHE setting, a
+dict with these keys (all optional):
+
+- 'BACKEND': 'lru' (in-process, the default), 'django' (one of the
+  caches in CACHES) or None to turn the cache off.
+- 'TTL_SECONDS': how long entries are used, default 300.
+- 'MAX_ENTRIES': maximum number of locations kept by 'lru', default
+  256.
+- 'CACHE_ALIAS': the Django cache used by 'django', default 'default'.
+- 'BUCKET_MINUTES': size of the buckets windows are snapped to,
+  default 15."""
+
+# Python 3 is coming to town
+from __future__ import print_function, unicode_literals
+from __future__ import absolute_import, division
+
+import collections
+import contextlib
+import datetime
+import threading
+import time
+
+from functools import wraps
+
+from django.conf import settings
+
+from lizard_datasource import cache_backends
+from lizard_datasource import dates
+from lizard_datasource import timeseries
+
+DEFAULT_SETTINGS = {
+    'BACKEND': 'lru',
+    'TTL_SECONDS': 300,
+    'MAX_ENTRIES': 256,
+    'CACHE_ALIAS': 'default',
+    'BUCKET_MINUTES': 15,
+    }
+
+# Maximum number of segments kept per layer and location; if there are
+# more, those that expire first are dropped
+MAX_SEGMENTS = 16
+
+# Stands in for a missing start of a window (all history)
+EARLIEST = dates.utc(1900, 1, 1)
+
+# A period of time (start and end included) for which the timeseries
+# was fetched, the result (None if there was none) and the moment
+# (time.time()) after which it can't be used anymore (None: never).
+Segment = collections.namedtuple(
+    'Segment', 'start end expires timeseries')
+
+_backend = None
+_state = threading.local()
+
+
+def cache_settings():
+    result = dict(DEFAULT_SETTINGS)
+    result.update(getattr(
+            settings, 'LIZARD_DATASOURCE_TIMESERIES_CACHE', {}))
+    return result
+
+
+def get_backend():
+    """Return the configured cache backend, or None if caching is
+    turned off. The backend is made once per process."""
+    global _backend
+    if _backend is None:
+        config = cache_settings()
+        if config['BACKEND'] == 'lru':
+            _backend = cache_backends.LRUCache(
+                config['MAX_ENTRIES'], config['TTL_SECONDS'])
+        elif config['BACKEND'] == 'django':
+            _backend = cache_backends.DjangoCache(
+                config['CACHE_ALIAS'], config['TTL_SECONDS'])
+        elif config['BACKEND'] is not None:
+            raise ValueError("Unknown timeseries cache backend: {0}".format(
+                    config['BACKEND']))
+    return _backend
+
+
+def reset():
+    """Forget the backend (and with an in-process backend, all cached
+    timeseries). The settings are read again on next use."""
+    global _backend
+    _backend = None
+
+
+@contextlib.contextmanager
+def disabled():
+    """Within this context, cached() timeseries methods go straight
+    to the backend in this thread. The cache script uses this, it
+    needs fresh data."""
+    previous = getattr(_state, 'disabled', False)
+    _state.disabled = True
+    try:
+        yield
+    finally:
+        _state.disabled = previous
+
+
+def layer_key(ds):
+    """Identifies the layer of a datasource, for use in cache keys."""
+    return (ds.originating_app, ds.identifier,
+            ds.get_choices_made().json())
+
+
+def snap_window(start_datetime, end_datetime, bucket_minutes):
+    """Widen the window to whole buckets, at least one. A missing end
+    means now, which is snapped as well; a missing start stays
+    missing."""
+    if end_datetime is None:
+        end_datetime = dates.utc_now()
+    end_datetime = dates.ceil_to_bucket(end_datetime, bucket_minutes)
+    if start_datetime is not None:
+        start_datetime = dates.floor_to_bucket(start_datetime, bucket_minutes)
+        if start_datetime >= end_datetime:
+            end_datetime = start_datetime + datetime.timedelta(
+                minutes=bucket_minutes)
+    return start_datetime, end_datetime
+
+
+def missing_ranges(segments, start_datetime, end_datetime):
+    """Return (start, end) tuples of the parts of the window that
+    aren't covered by any of the segments, in order. Segments must be
+    sorted by their start."""
+    missing = []
+    covered_until = start_datetime
+    for segment in segments:
+        if segment.end < covered_until:
+            continue
+        if segment.start > end_datetime:
+            break
+        if segment.start > covered_until:
+            missing.append((covered_until, segment.start))
+        covered_until = max(covered_until, segment.end)
+    if covered_until < end_datetime:
+        missing.append((covered_until, end_datetime))
+    return missing
+
+
+def _keep_segments(segments):
+    """Return at most MAX_SEGMENTS of the segments, sorted by start."""
+    if len(segments) > MAX_SEGMENTS:
+        segments = sorted(
+            segments, key=lambda segment: segment.expires,
+            reverse=True)[:MAX_SEGMENTS]
+    return sorted(segments, key=lambda segment: segment.start)
+
+
+def cached(timeseries_method):
+    """Decorator for the timeseries() method of a DataSource.
+
+    The decorated method is called for the missing parts of the
+    snapped window, without max_points; downsampling happens after the
+    result is spliced and cut back to the requested window. The
+    returned Timeseries is always a new object, so callers can add()
+    to it."""
+
+    @wraps(timeseries_method)
+    def cached_timeseries(
+        ds, location_id, start_datetime=None, end_datetime=None,
+        max_points=None):
+        backend = get_backend()
+        if backend is None or getattr(_state, 'disabled', False):
+            return timeseries_method(
+                ds, location_id, start_datetime, end_datetime,
+                max_points=max_points)
+
+        config = cache_settings()
+        snapped_start, snapped_end = snap_window(
+            start_datetime, end_datetime, config['BUCKET_MINUTES'])
+        if snapped_start is None:
+            snapped_start = EARLIEST
+
+        now = time.time()
+        if config['TTL_SECONDS'] is None:
+            expires = None
+        else:
+            expires = now + config['TTL_SECONDS']
+
+        key = (layer_key(ds), location_id)
+        cached_segments = backend.get(key) or []
+        segments = [
+            segment for segment in cached_segments
+            if segment.expires is None or segment.expires > now]
+
+        missing = missing_ranges(segments, snapped_start, snapped_end)
+        for missing_start, missing_end in missing:
+            segments.append(Segment(
+                    missing_start, missing_end, expires,
+                    timeseries_method(
+                        ds, location_id,
+                        None if missing_start == EARLIEST else missing_start,
+                        missing_end)))
+
+        segments = _keep_segments(segments)
+        if missing or len(segments) != len(cached_segments):
+            backend.set(key, segments)
+
+        spliced = timeseries.concat([
+                segment.timeseries for segment in segments
+                if segment.timeseries is not None and
+                segment.start <= snapped_end and
+                segment.end >= snapped_start])
+        if spliced is None:
+            return None
+        return spliced.window(start_datetime, end_datetime).downsample(
+            max_points)
+
+    return cached_timeseries
@@ -0,0 +1,12 @@
+# Python 3 is coming to town
+from __future__ import print_function, unicode_literals
+from __future__ import absolute_import, division
+
+from django.conf.urls import patterns
+from django.conf.urls import url
+
+urlpatterns = patterns(
+    'lizard_datasource.views',
+    url(r'^instrumentation/$', 'instrumentation_stats',
+        name='lizard_datasource_instrumentation_stats'),
+    )
@@ -0,0 +1,18 @@
+# Python 3 is coming to town
+from __future__ import print_function, unicode_literals
+from __future__ import absolute_import, division
+
+from django.contrib.admin.views.decorators import staff_member_required
+from django.http import HttpResponse
+from django.utils import simplejson
+
+from lizard_datasource import instrumentation
+
+
+@staff_member_required
+def instrumentation_stats(request):
+    """The added up datasource calls of all instrumented requests
+    handled by this process, as JSON."""
+    return HttpResponse(
+        simplejson.dumps(instrumentation.stats(), indent=2),
+        content_type='application/json')
@@ -48,6 +48,8 @@ setup(name='lizard-datasource',
           ],
           'lizard_datasource': [
             'dummy_datasource = lizard_datasource.dummy_datasource:factory',
+            ('synthetic_datasource = ' +
+             'lizard_datasource.synthetic_datasource:factory'),
             ('augmented_datasource = ' +
              'lizard_datasource.augmented_datasource:factory'),
             ],